@@ -0,0 +1,149 @@
+"""
+This module implements data augmentation for batches of images of shape
+(batch_size, channels, height, width). Every step works on the whole batch
+at once with NumPy indexing, there is no loop over the images.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+def random_crop(images, padding, out=None, padded=None):
+    """
+    Pads every image with zeros on each side and crops it back to its size
+    at a random offset.
+
+    Args:
+      images: batch of images
+      padding: number of zeros added to every side
+      out: optional array the crops are written into, may be images
+      padded: optional scratch array of shape (batch_size, channels,
+              height + 2 * padding, width + 2 * padding) whose border
+              is zero
+    Returns:
+      out: batch of cropped images
+    """
+    n, _, height, width = images.shape
+    if padded is None:
+        padded = np.zeros(images.shape[:2] + (height + 2 * padding,
+                                              width + 2 * padding),
+                          images.dtype)
+    padded[:, :, padding:padding + height, padding:padding + width] = images
+
+    # every window of the padded images, the crop picks one per image
+    windows = sliding_window_view(padded, (height, width), axis=(2, 3))
+    rows = np.random.randint(2 * padding + 1, size=n)
+    cols = np.random.randint(2 * padding + 1, size=n)
+    crops = windows[np.arange(n), :, rows, cols]
+
+    if out is None:
+        return crops
+    np.copyto(out, crops)
+    return out
+
+def random_flip(images, p=0.5):
+    """
+    Mirrors every image horizontally with probability p, in place.
+
+    Args:
+      images: batch of images
+      p: probability of flipping an image
+    Returns:
+      images: batch of flipped images
+    """
+    flip = np.flatnonzero(np.random.rand(len(images)) < p)
+    images[flip] = images[flip, :, :, ::-1]
+    return images
+
+def normalize(images, mean, std):
+    """
+    Normalizes every channel of the images with its mean and standard
+    deviation, in place.
+
+    Args:
+      images: batch of images
+      mean: mean of every channel
+      std: standard deviation of every channel
+    Returns:
+      images: batch of normalized images
+    """
+    shape = (1, -1, 1, 1)
+    images -= np.asarray(mean, images.dtype).reshape(shape)
+    images /= np.asarray(std, images.dtype).reshape(shape)
+    return images
+
+def channel_stats(images, chunk_size=1000, mean_image=None):
+    """
+    Computes the mean and standard deviation of every channel, chunk by
+    chunk in float64, so it also works on memory-mapped datasets.
+
+    Args:
+      images: images of shape (n_samples, channels, height, width)
+      chunk_size: number of images converted at once
+      mean_image: optional image subtracted from the images first, e.g. the
+                  mean of a cifar10_utils.DataSet storing raw pixels
+    Returns:
+      mean: mean of every channel
+      std: standard deviation of every channel
+    """
+    total = np.zeros(images.shape[1])
+    total_sq = np.zeros(images.shape[1])
+    for start in range(0, len(images), chunk_size):
+        chunk = images[start:start + chunk_size].astype(np.float64)
+        if mean_image is not None:
+            chunk -= mean_image
+        total += chunk.sum(axis=(0, 2, 3))
+        total_sq += np.square(chunk).sum(axis=(0, 2, 3))
+
+    count = images.size // images.shape[1]
+    mean = total / count
+    return mean, np.sqrt(total_sq / count - mean ** 2)
+
+class Augmentation(object):
+    """
+    Random crop, horizontal flip and per-channel normalization of batches,
+    applied in place. Call it with the images and labels of a batch, e.g. as
+    the transform of a cifar10_utils.BatchPrefetcher, which then augments
+    on its background thread.
+    """
+
+    def __init__(self, padding=4, flip=True, mean=None, std=None):
+        """
+        Initializes the augmentation.
+
+        Args:
+          padding: padding of the random crop, 0 to not crop
+          flip: whether to flip half of the images horizontally
+          mean: mean of every channel, the images are not normalized if
+                mean is None
+          std: standard deviation of every channel
+        """
+        self.padding = padding
+        self.flip = flip
+        self.mean = mean
+        self.std = std
+        self._padded = None
+
+    def __call__(self, images, labels):
+        """
+        Augments the images in place.
+
+        Returns:
+          images: augmented images
+          labels: the unchanged labels
+        """
+        if self.padding > 0:
+            shape = images.shape[:2] + tuple(size + 2 * self.padding
+                                             for size in images.shape[2:])
+            if self._padded is None or self._padded.shape != shape or \
+               self._padded.dtype != images.dtype:
+                self._padded = np.zeros(shape, images.dtype)
+            random_crop(images, self.padding, out=images, padded=self._padded)
+        if self.flip:
+            random_flip(images)
+        if self.mean is not None:
+            normalize(images, self.mean, self.std)
+
+        return images, labels
@@ -0,0 +1,463 @@
+"""
+This module implements benchmarks of the training and inference code on
+data with the shapes of CIFAR10. Random data is used, so the benchmarks
+can run without downloading the dataset.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import os
+import pickle
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+from mlp_numpy import MLP
+from convnet_numpy import ConvNet
+from modules import SoftmaxCrossEntropyModule
+from data_parallel import DataParallelMLP
+from optimizers import SGD
+from augmentation import Augmentation
+import cifar10_utils
+
+# Default constants
+DNN_HIDDEN_UNITS_DEFAULT = '100'
+BATCH_SIZE_DEFAULT = 200
+STEPS_DEFAULT = 50
+WORKERS_DEFAULT = '1,2,4,8'
+TRAIN_SIZE_DEFAULT = 10000
+SHARD_SIZE_DEFAULT = 1000
+BATCH_FILE_SIZE_DEFAULT = 10000
+BATCH_SIZES_DEFAULT = '1,32,128'
+THREADS_DEFAULT = '1,2,4'
+
+# Shapes of CIFAR10
+IMAGE_SHAPE = (3, 32, 32)
+NR_PIXELS = 3 * 32 * 32
+NR_LABELS = 10
+
+FLAGS = None
+
+def random_batch(batch_size, dtype=np.float32):
+    """
+    Creates a random batch of flattened images with one-hot labels.
+
+    Args:
+      batch_size: number of samples in the batch
+      dtype: floating point type of the batch
+    Returns:
+      x: images of shape (batch_size, NR_PIXELS)
+      y: one-hot labels of shape (batch_size, NR_LABELS)
+    """
+    x = np.random.randn(batch_size, NR_PIXELS).astype(dtype)
+    y = np.eye(NR_LABELS, dtype=dtype)[np.random.randint(NR_LABELS,
+                                                         size=batch_size)]
+    return x, y
+
+def numpy_train_step(network, optimizer, loss_module, x, y):
+    """
+    Performs one training step of a NumPy MLP.
+    """
+    dx_buffer = None
+    if network.workspace is not None:
+        dx_buffer = network.workspace['gradients'][-1]
+
+    out = network.forward(x)
+    network.backward(loss_module.backward(out, y, out=dx_buffer))
+    optimizer.step()
+
+def time_steps(step, steps):
+    """
+    Runs step once to warm up and then steps times.
+
+    Returns:
+      seconds per step
+    """
+    step()
+    start = time.perf_counter()
+    for _ in range(steps):
+        step()
+    return (time.perf_counter() - start) / steps
+
+def peak_memory(step):
+    """
+    Returns the peak number of bytes allocated by NumPy during one step.
+    """
+    tracemalloc.start()
+    step()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+def resident_memory():
+    """
+    Returns the current resident memory of the process in bytes, read from
+    /proc on Linux, or None elsewhere.
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+def benchmark_dtype():
+    """
+    Compares step time and memory of the NumPy MLP in float64, float32 and
+    float32 with float64 master weights.
+    """
+    settings = [('float64', np.float64, False),
+                ('float32', np.float32, False),
+                ('float32 + master', np.float32, True)]
+
+    print('{:<18}{:>12}{:>16}{:>16}'.format('dtype', 'ms/step',
+                                            'params [MB]', 'peak [MB]'))
+    for name, dtype, master_weights in settings:
+        np.random.seed(42)
+        x, y = random_batch(FLAGS.batch_size, dtype)
+        network = MLP(NR_PIXELS, FLAGS.dnn_hidden_units, NR_LABELS,
+                      fused_loss=True, dtype=dtype,
+                      master_weights=master_weights)
+        optimizer = SGD(network, 1e-3)
+        loss_module = SoftmaxCrossEntropyModule()
+        step = lambda: numpy_train_step(network, optimizer, loss_module, x, y)
+
+        seconds = time_steps(step, FLAGS.steps)
+        params = network.params.nbytes
+        if network.master_params is not None:
+            params += network.master_params.nbytes
+
+        print('{:<18}{:>12.2f}{:>16.2f}{:>16.2f}'.format(
+            name, 1e3 * seconds, params / 2 ** 20, peak_memory(step) / 2 ** 20))
+
+def benchmark_data_parallel():
+    """
+    Measures the throughput of data-parallel training of the NumPy MLP for
+    different numbers of worker processes. Limit the BLAS threads, e.g. with
+    OMP_NUM_THREADS=1, to measure the scaling of the processes alone.
+    """
+    np.random.seed(42)
+    x, y = random_batch(FLAGS.train_size)
+
+    print('{:>8}{:>12}{:>16}{:>10}'.format('workers', 'ms/step',
+                                           'images/sec', 'speedup'))
+    baseline = None
+    for n_workers in FLAGS.workers:
+        network = MLP(NR_PIXELS, FLAGS.dnn_hidden_units, NR_LABELS,
+                      fused_loss=True, dtype=np.float32)
+        optimizer = SGD(network, 1e-3)
+        with DataParallelMLP(network, x, y, n_workers,
+                             FLAGS.batch_size) as parallel:
+            step = lambda: parallel.step(
+                np.random.randint(FLAGS.train_size, size=FLAGS.batch_size),
+                optimizer)
+            seconds = time_steps(step, FLAGS.steps)
+
+        baseline = baseline or seconds
+        print('{:>8}{:>12.2f}{:>16.0f}{:>10.2f}'.format(
+            n_workers, 1e3 * seconds, FLAGS.batch_size / seconds,
+            baseline / seconds))
+
+def benchmark_convnet():
+    """
+    Compares the training and inference throughput of the NumPy ConvNet with
+    the PyTorch ConvNet on the CPU, both in float32. The NumPy ConvNet is
+    slow, so use few steps and small batches, e.g. --steps 5 --batch_size 32.
+    """
+    import torch
+    import torch.nn as nn
+    from convnet_pytorch import ConvNet as TorchConvNet
+
+    np.random.seed(42)
+    torch.manual_seed(42)
+    x, y = random_batch(FLAGS.batch_size)
+    x = x.reshape((FLAGS.batch_size,) + IMAGE_SHAPE)
+
+    network = ConvNet(IMAGE_SHAPE[0], NR_LABELS, dtype=np.float32)
+    loss_module = SoftmaxCrossEntropyModule()
+    optimizer = SGD(network, 1e-3)
+
+    def numpy_step():
+        network.train()
+        out = network.forward(x)
+        network.backward(loss_module.backward(out, y))
+        optimizer.step()
+
+    def numpy_inference():
+        network.eval()
+        network.forward(x)
+
+    torch_network = TorchConvNet(IMAGE_SHAPE[0], NR_LABELS)
+    cross_entropy = nn.CrossEntropyLoss()
+    torch_optimizer = torch.optim.SGD(torch_network.parameters(), 1e-3)
+    x_torch = torch.from_numpy(x)
+    y_torch = torch.from_numpy(y).argmax(dim=1)
+
+    def torch_step():
+        torch_network.train()
+        torch_optimizer.zero_grad()
+        cross_entropy(torch_network(x_torch), y_torch).backward()
+        torch_optimizer.step()
+
+    def torch_inference():
+        torch_network.eval()
+        with torch.no_grad():
+            torch_network(x_torch)
+
+    print('{:<10}{:<12}{:>12}{:>16}'.format('engine', 'mode', 'ms/step',
+                                            'images/sec'))
+    for engine, mode, step in [('numpy', 'train', numpy_step),
+                               ('numpy', 'inference', numpy_inference),
+                               ('pytorch', 'train', torch_step),
+                               ('pytorch', 'inference', torch_inference)]:
+        seconds = time_steps(step, FLAGS.steps)
+        print('{:<10}{:<12}{:>12.1f}{:>16.1f}'.format(
+            engine, mode, 1e3 * seconds, FLAGS.batch_size / seconds))
+
+def benchmark_cpu_modes():
+    """
+    Compares the throughput of the PyTorch ConvNet on the CPU in its default
+    NCHW layout, in channels-last and, for inference, as a frozen copy with
+    the batch normalization folded in and fused oneDNN kernels, for several
+    batch sizes and thread counts. Training is slow, so use few steps, e.g.
+    --steps 5.
+    """
+    import torch
+    import torch.nn as nn
+    from convnet_pytorch import ConvNet as TorchConvNet
+    from export import freeze
+
+    inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+    default_threads = torch.get_num_threads()
+
+    print('{:>8}{:>8}{:<12}{:<16}{:>12}{:>14}{:>10}'.format(
+        'threads', 'batch', '  phase', 'mode', 'ms/step', 'images/sec',
+        'speedup'))
+    for n_threads in FLAGS.threads:
+        torch.set_num_threads(n_threads)
+        for batch_size in FLAGS.batch_sizes:
+            torch.manual_seed(42)
+            x = torch.randn((batch_size,) + IMAGE_SHAPE)
+            y = torch.randint(NR_LABELS, (batch_size,))
+            cross_entropy = nn.CrossEntropyLoss()
+
+            def train_step(network):
+                network.zero_grad()
+                cross_entropy(network(x), y).backward()
+                with torch.no_grad():
+                    for param in network.parameters():
+                        param -= 1e-3 * param.grad
+
+            def inference_step(network):
+                with inference_mode():
+                    network(x)
+
+            def create(channels_last):
+                network = TorchConvNet(IMAGE_SHAPE[0], NR_LABELS)
+                if channels_last:
+                    network.to_channels_last()
+                return network
+
+            train_nchw, train_last = create(False), create(True)
+            eval_nchw, eval_last = create(False).eval(), create(True).eval()
+            fused = freeze(create(False), x, channels_last=True, optimize=True)
+
+            baseline = None
+            for phase, mode, step in [
+                    ('train', 'nchw', lambda: train_step(train_nchw)),
+                    ('train', 'channels_last', lambda: train_step(train_last)),
+                    ('inference', 'nchw', lambda: inference_step(eval_nchw)),
+                    ('inference', 'channels_last',
+                     lambda: inference_step(eval_last)),
+                    ('inference', 'fused', lambda: inference_step(fused))]:
+                seconds = time_steps(step, FLAGS.steps)
+                if mode == 'nchw':
+                    baseline = seconds
+                print('{:>8}{:>8}{:<12}{:<16}{:>12.1f}{:>14.1f}{:>10.2f}'
+                      .format(n_threads, batch_size, '  ' + phase, mode,
+                              1e3 * seconds, batch_size / seconds,
+                              baseline / seconds))
+
+    torch.set_num_threads(default_threads)
+
+def loop_augmentation(images, padding=4):
+    """
+    Randomly crops and flips a batch image by image, as a per-sample
+    transform of a data loader does. Baseline of the augmentation benchmark.
+    """
+    height, width = images.shape[2:]
+    for i in range(len(images)):
+        padded = np.pad(images[i], ((0, 0), (padding, padding),
+                                    (padding, padding)))
+        row, col = np.random.randint(2 * padding + 1, size=2)
+        image = padded[:, row:row + height, col:col + width]
+        if np.random.rand() < 0.5:
+            image = image[:, :, ::-1]
+        images[i] = image
+    return images
+
+def benchmark_augmentation():
+    """
+    Compares the throughput of the batched random crop and flip of the
+    Augmentation with a loop over the images, in images per second of wall
+    time and per second of CPU time, i.e. per core.
+    """
+    np.random.seed(42)
+    x, _ = random_batch(FLAGS.batch_size)
+    x = x.reshape((FLAGS.batch_size,) + IMAGE_SHAPE)
+    augment = Augmentation(padding=4, flip=True)
+
+    print('{:<12}{:>12}{:>16}{:>22}'.format('method', 'ms/batch',
+                                            'images/sec',
+                                            'images/sec per core'))
+    for method, step in [('batched', lambda: augment(x, None)),
+                         ('loop', lambda: loop_augmentation(x))]:
+        cpu_start = time.process_time()
+        seconds = time_steps(step, FLAGS.steps)
+        cpu_seconds = (time.process_time() - cpu_start) / (FLAGS.steps + 1)
+        print('{:<12}{:>12.2f}{:>16.0f}{:>22.0f}'.format(
+            method, 1e3 * seconds, FLAGS.batch_size / seconds,
+            FLAGS.batch_size / cpu_seconds))
+
+def benchmark_sharded():
+    """
+    Writes train_size random images in shards of shard_size and goes
+    through them once with a ShardedDataSet, measuring the throughput and
+    the growth of the resident memory, which is bounded by the mapped
+    shards instead of growing with the dataset.
+    """
+    np.random.seed(42)
+    with tempfile.TemporaryDirectory() as directory:
+        with cifar10_utils.ShardWriter(directory, FLAGS.shard_size) as writer:
+            for start in range(0, FLAGS.train_size, FLAGS.shard_size):
+                size = min(FLAGS.shard_size, FLAGS.train_size - start)
+                writer.write(
+                    np.random.randn(size, *IMAGE_SHAPE).astype(np.float32),
+                    np.random.randint(NR_LABELS, size=size).astype(np.uint8))
+
+        dataset = cifar10_utils.ShardedDataSet(directory)
+        dataset.allocate_buffers(FLAGS.batch_size)
+        baseline = resident_memory()
+        growth = 0
+        start = time.perf_counter()
+        for _ in range(FLAGS.train_size // FLAGS.batch_size):
+            dataset.next_batch(FLAGS.batch_size)
+            if baseline is not None:
+                growth = max(growth, resident_memory() - baseline)
+        seconds = time.perf_counter() - start
+
+        image_bytes = np.prod(IMAGE_SHAPE) * 4
+        print('{:>16}{:>16}{:>20}{:>16}'.format('dataset [MB]', 'shard [MB]',
+                                                'rss growth [MB]',
+                                                'images/sec'))
+        print('{:>16.1f}{:>16.1f}{:>20.1f}{:>16.0f}'.format(
+            FLAGS.train_size * image_bytes / 2 ** 20,
+            FLAGS.shard_size * image_bytes / 2 ** 20, growth / 2 ** 20,
+            FLAGS.train_size // FLAGS.batch_size * FLAGS.batch_size / seconds))
+
+def write_random_cifar10(directory, num_images):
+    """
+    Writes CIFAR10 batch files with num_images random images each.
+    """
+    for filename in cifar10_utils.BATCH_FILES:
+        batch = {'data': np.random.randint(256, size=(num_images, NR_PIXELS),
+                                           dtype=np.uint8),
+                 'labels': list(np.random.randint(NR_LABELS, size=num_images))}
+        with open(os.path.join(directory, filename), 'wb') as f:
+            pickle.dump(batch, f)
+
+def benchmark_startup():
+    """
+    Measures the time to decode and preprocess the CIFAR10 batch files with
+    different numbers of decoding threads, into float32 and uint8 images,
+    and the time to load the cache written by the first run. Random batch
+    files of batch_file_size images are used, the files are in the page
+    cache after the first run.
+    """
+    np.random.seed(42)
+    with tempfile.TemporaryDirectory() as directory:
+        write_random_cifar10(directory, FLAGS.batch_file_size)
+        cifar10_utils.load_preprocessed_cifar10(directory, workers=1)
+
+        print('cpus: ' + str(os.cpu_count()))
+        print('{:<10}{:>8}{:>12}{:>10}'.format('images', 'workers', 'ms',
+                                               'speedup'))
+        for uint8 in [False, True]:
+            baseline = None
+            for n_workers in FLAGS.workers:
+                start = time.perf_counter()
+                cifar10_utils.load_preprocessed_cifar10(directory, uint8,
+                                                        n_workers)
+                seconds = time.perf_counter() - start
+
+                baseline = baseline or seconds
+                print('{:<10}{:>8}{:>12.0f}{:>10.2f}'.format(
+                    'uint8' if uint8 else 'float32', n_workers, 1e3 * seconds,
+                    baseline / seconds))
+
+        cifar10_utils.write_cifar10_cache(directory)
+        start = time.perf_counter()
+        cifar10_utils.get_preprocessed_cifar10(directory)
+        print('{:<18}{:>12.1f}'.format('cache', 1e3 * (time.perf_counter() - start)))
+
+BENCHMARKS = {'dtype': benchmark_dtype,
+              'data_parallel': benchmark_data_parallel,
+              'convnet': benchmark_convnet,
+              'cpu_modes': benchmark_cpu_modes,
+              'augmentation': benchmark_augmentation,
+              'sharded': benchmark_sharded,
+              'startup': benchmark_startup}
+
+def print_flags():
+    """
+    Prints all entries in FLAGS variable.
+    """
+    for key, value in vars(FLAGS).items():
+        print(key + ' : ' + str(value))
+
+def main():
+    """
+    Main function
+    """
+    # Print all Flags to confirm parameter settings
+    print_flags()
+
+    BENCHMARKS[FLAGS.benchmark]()
+
+if __name__ == '__main__':
+    # Command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmark', type=str, choices=sorted(BENCHMARKS),
+                      help='Benchmark to run')
+    parser.add_argument('--dnn_hidden_units', type=str,
+                      default=DNN_HIDDEN_UNITS_DEFAULT,
+                      help='Comma separated list of number of units in each \
+                            hidden layer')
+    parser.add_argument('--batch_size', type=int, default=BATCH_SIZE_DEFAULT,
+                      help='Batch size of the benchmarked steps')
+    parser.add_argument('--steps', type=int, default=STEPS_DEFAULT,
+                      help='Number of timed steps')
+    parser.add_argument('--workers', type=str, default=WORKERS_DEFAULT,
+                      help='Comma separated list of numbers of worker \
+                            processes')
+    parser.add_argument('--train_size', type=int, default=TRAIN_SIZE_DEFAULT,
+                      help='Number of random training samples')
+    parser.add_argument('--shard_size', type=int, default=SHARD_SIZE_DEFAULT,
+                      help='Number of samples per shard')
+    parser.add_argument('--batch_file_size', type=int,
+                      default=BATCH_FILE_SIZE_DEFAULT,
+                      help='Number of images per CIFAR10 batch file')
+    parser.add_argument('--batch_sizes', type=str, default=BATCH_SIZES_DEFAULT,
+                      help='Comma separated list of batch sizes')
+    parser.add_argument('--threads', type=str, default=THREADS_DEFAULT,
+                      help='Comma separated list of numbers of PyTorch \
+                            threads')
+    FLAGS, unparsed = parser.parse_known_args()
+    FLAGS.workers = [int(workers) for workers in FLAGS.workers.split(',')]
+    FLAGS.batch_sizes = [int(size) for size in FLAGS.batch_sizes.split(',')]
+    FLAGS.threads = [int(threads) for threads in FLAGS.threads.split(',')]
+    FLAGS.dnn_hidden_units = [int(units) for units
+                              in FLAGS.dnn_hidden_units.split(',') if units]
+
+    main()
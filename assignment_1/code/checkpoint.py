@@ -0,0 +1,71 @@
+"""
+This module implements checkpoints of NumPy training runs. A checkpoint
+holds the parameters of the network, the state of the optimizer, the state
+of the cifar10_utils.BatchSampler and the recorded accuracies and losses,
+so a resumed run continues with exactly the batch it would have drawn next.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import numpy as np
+
+def save_checkpoint(path, network, optimizer, sampler, step, history=None):
+    """
+    Saves a checkpoint to an .npz file. The file is written next to path
+    and moved into place, so an interrupted save leaves the previous
+    checkpoint intact.
+
+    Args:
+      path: file the checkpoint is saved to
+      network: MLP or ConvNet being trained
+      optimizer: optimizer of the network
+      sampler: BatchSampler drawing the training batches
+      step: number of steps taken, the sampler may have drawn ahead of it
+      history: optional JSON-serializable dictionary, e.g. the accuracies
+               and losses recorded so far
+    """
+    arrays = {'params': network.params}
+    if network.master_params is not None:
+        arrays['master_params'] = network.master_params
+    for name, value in optimizer.state_dict().items():
+        arrays['optimizer/' + name] = value
+
+    sampler_state = sampler.state_dict()
+    sampler_state['step'] = step
+    meta = {'step': step, 'sampler': sampler_state, 'history': history}
+    # NumPy scalars in the history are stored as floats
+    arrays['meta'] = np.array(json.dumps(meta, default=float))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+def load_checkpoint(path, network, optimizer, sampler):
+    """
+    Restores a checkpoint saved by save_checkpoint into the network, the
+    optimizer and the sampler, which must match the saved ones.
+
+    Args:
+      path: checkpoint file
+      network: MLP or ConvNet whose parameters are overwritten
+      optimizer: optimizer whose state is overwritten
+      sampler: BatchSampler moved to the saved step
+    Returns:
+      step: number of steps taken before the checkpoint
+      history: the history passed to save_checkpoint
+    """
+    with np.load(path) as f:
+        meta = json.loads(str(f['meta']))
+        np.copyto(network.params, f['params'])
+        if network.master_params is not None:
+            np.copyto(network.master_params, f['master_params'])
+        optimizer.load_state_dict({key[len('optimizer/'):]: f[key]
+                                   for key in f.files
+                                   if key.startswith('optimizer/')})
+
+    sampler.load_state_dict(meta['sampler'])
+    return meta['step'], meta['history']
@@ -6,30 +6,170 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import collections
+import concurrent.futures
+import hashlib
+import json
 import numpy as np
 import os
 import pickle
+import queue
+import threading
+import time
 
 # Default paths for downloading CIFAR10 data
 CIFAR10_FOLDER = 'cifar10/cifar-10-batches-py'
 
-def load_cifar10_batch(batch_filename):
+# Batch files of CIFAR10 and the preprocessed arrays cached next to them
+BATCH_FILES = ['data_batch_' + str(b) for b in range(1, 6)] + ['test_batch']
+CACHE_FOLDER = 'cache'
+CACHE_ARRAYS = ['train_images', 'train_labels', 'test_images', 'test_labels',
+                'mean_image', 'train_images_uint8', 'test_images_uint8']
+CACHE_VERSION = 2
+DECODE_WORKERS_DEFAULT = min(len(BATCH_FILES), os.cpu_count() or 1)
+SHARD_FOLDER = 'shards'
+SHARD_SIZE_DEFAULT = 10000
+SHARD_VERSION = 1
+
+def read_cifar10_batch(batch_filename):
   """
-  Loads single batch of CIFAR10 data.
+  Reads single batch of CIFAR10 data without converting it.
   Args:
     batch_filename: Filename of batch to get data from.
   Returns:
-    X: CIFAR10 batch data in numpy array with shape (10000, 32, 32, 3).
+    X: CIFAR10 batch data in uint8 numpy array with shape (10000, 3, 32, 32).
     Y: CIFAR10 batch labels in numpy array with shape (10000, ).
   """
   with open(batch_filename, 'rb') as f:
     batch = pickle.load(f, encoding='latin1')
-    X = batch['data']
-    Y = batch['labels']
-    X = X.reshape(10000, 3, 32, 32).transpose(0,2,3,1).astype(np.float32)
-    Y = np.array(Y)
+    X = batch['data'].reshape(-1, 3, 32, 32)
+    Y = np.array(batch['labels'])
     return X, Y
 
+def load_cifar10_batch(batch_filename):
+  """
+  Loads single batch of CIFAR10 data.
+  Args:
+    batch_filename: Filename of batch to get data from.
+  Returns:
+    X: CIFAR10 batch data in numpy array with shape (10000, 32, 32, 3).
+    Y: CIFAR10 batch labels in numpy array with shape (10000, ).
+  """
+  X, Y = read_cifar10_batch(batch_filename)
+  return X.transpose(0,2,3,1).astype(np.float32), Y
+
+def stream_cifar10_batches(batch_filenames, mean_sum = None, dtype = np.float32,
+                           workers = 1):
+  """
+  Decodes CIFAR10 batch files straight into one preallocated NCHW float32
+  array. The rows of the batch files already are in NCHW order, so every
+  batch is cast into its slice of the array without any intermediate copy.
+  The array is sized after the first batch, assuming all batches have its
+  size, and the batches that do not fit are appended afterwards.
+  With several workers a pool of threads decodes the files in parallel.
+  Every thread writes its batch into its slice as soon as the sizes of the
+  batches before it are known, and NumPy releases the GIL while casting and
+  summing, so the decoding scales with the number of cores.
+  Args:
+    batch_filenames: Filenames of the batches.
+    mean_sum: Optional float64 array of shape (3, 32, 32) the images are
+              added to, to compute their mean exactly in the same pass.
+    dtype: Type of the array, np.uint8 keeps the raw pixels.
+    workers: Number of decoding threads.
+  Returns:
+    X: CIFAR10 data in numpy array with shape (N, 3, 32, 32).
+    Y: CIFAR10 labels in numpy array with shape (N, ).
+  """
+  n = len(batch_filenames)
+  # offsets[b] is the start of batch b, set once the batches before it are
+  # decoded, or left None if one of them failed
+  offsets = [0] + [None] * n
+  known = [threading.Event() for _ in range(n + 1)]
+  known[0].set()
+  destination, Ys, sums, spilled = [], [None] * n, [None] * n, {}
+
+  def decode(b):
+    try:
+      X_batch, Ys[b] = read_cifar10_batch(batch_filenames[b])
+      if mean_sum is not None:
+        sums[b] = np.sum(X_batch, axis = 0, dtype = np.float64)
+      known[b].wait()
+      start = offsets[b]
+      if start is None:
+        return
+      if b == 0:
+        destination.append(np.empty((len(X_batch) * n,) + X_batch.shape[1:], dtype))
+      end = start + len(X_batch)
+      offsets[b + 1] = end
+    finally:
+      known[b + 1].set()
+
+    if end <= len(destination[0]):
+      destination[0][start:end] = X_batch
+    else:
+      spilled[b] = X_batch
+
+  if workers > 1 and n > 1:
+    # the batches are started in order, so waiting for the batches before
+    # cannot deadlock the pool
+    with concurrent.futures.ThreadPoolExecutor(min(workers, n)) as pool:
+      for future in [pool.submit(decode, b) for b in range(n)]:
+        future.result()
+  else:
+    for b in range(n):
+      decode(b)
+
+  # the sums are added in file order, exactly as by a sequential pass
+  if mean_sum is not None:
+    for batch_sum in sums:
+      mean_sum += batch_sum
+
+  X = destination[0][:offsets[n]]
+  if spilled:
+    first = min(spilled)
+    X = np.concatenate([destination[0][:offsets[first]]] +
+                       [spilled[b].astype(dtype) for b in sorted(spilled)])
+  return X, np.concatenate(Ys)
+
+def load_preprocessed_cifar10(cifar10_folder, uint8 = False,
+                              workers = DECODE_WORKERS_DEFAULT):
+  """
+  Loads CIFAR10 train and test splits and subtracts the mean train image,
+  without the copies of get_cifar10_raw_data and preprocess_cifar10_data.
+  The batches are streamed into their destinations, the mean is summed in
+  float64 while streaming and subtracted in place. Every decoding thread
+  holds at most one raw batch, so the peak memory is the size of the
+  preprocessed dataset plus about twice the size of one raw batch file per
+  thread, min(workers, 5) of them for the train split. For CIFAR10 this is
+  at most 1.1 times the float32 dataset with one worker and 1.45 times
+  with five, or 1.35 and 2.75 times the uint8 dataset.
+  Args:
+    cifar10_folder: Folder which contains downloaded CIFAR10 data.
+    uint8: Flag for keeping the raw uint8 pixels, a quarter of the size,
+           and leaving the subtraction of the mean image to DataSet.
+    workers: Number of threads decoding the batch files in parallel.
+  Returns:
+    X_train: CIFAR10 train data in numpy array with shape (50000, 3, 32, 32).
+    Y_train: CIFAR10 train labels in numpy array with shape (50000, ).
+    X_test: CIFAR10 test data in numpy array with shape (10000, 3, 32, 32).
+    Y_test: CIFAR10 test labels in numpy array with shape (10000, ).
+    mean_image: Mean train image in numpy array with shape (3, 32, 32).
+  """
+  dtype = np.uint8 if uint8 else np.float32
+  mean_sum = np.zeros((3, 32, 32))
+  X_train, Y_train = stream_cifar10_batches(
+      [os.path.join(cifar10_folder, filename) for filename in BATCH_FILES[:-1]],
+      mean_sum, dtype, workers)
+  X_test, Y_test = stream_cifar10_batches(
+      [os.path.join(cifar10_folder, BATCH_FILES[-1])], dtype = dtype)
+
+  mean_image = (mean_sum / len(X_train)).astype(np.float32)
+  if uint8:
+    return X_train, Y_train, X_test, Y_test, mean_image
+  X_train -= mean_image
+  X_test -= mean_image
+  return X_train, Y_train, X_test, Y_test, mean_image
+
 def load_cifar10(cifar10_folder):
   """
   Loads CIFAR10 train and test splits.
@@ -101,6 +241,140 @@ def preprocess_cifar10_data(X_train_raw, Y_train_raw, X_test_raw, Y_test_raw):
   X_test = X_test.transpose(0, 3, 1, 2).astype(np.float32)
   return X_train, Y_train, X_test, Y_test
 
+def source_fingerprint(data_dir):
+  """
+  Describes the CIFAR10 batch files by their sizes and modification times,
+  so a cache built from other files can be detected without reading them.
+  Args:
+    data_dir: Data directory.
+  Returns:
+    Dictionary from batch filename to [size, mtime in nanoseconds].
+  """
+  fingerprint = {}
+  for filename in BATCH_FILES:
+    stat = os.stat(os.path.join(data_dir, filename))
+    fingerprint[filename] = [stat.st_size, stat.st_mtime_ns]
+  return fingerprint
+
+def file_sha256(filename):
+  """
+  Computes the SHA-256 hash of the content of a file.
+  """
+  digest = hashlib.sha256()
+  with open(filename, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      digest.update(block)
+  return digest.hexdigest()
+
+def write_cifar10_cache(data_dir, cache_dir = None, workers = DECODE_WORKERS_DEFAULT):
+  """
+  Preprocesses CIFAR10 once and writes the result as .npy files: the
+  mean-subtracted train and test images as contiguous NCHW float32 arrays,
+  the int labels, the mean image and the raw uint8 images. The batch files
+  are decoded once, the float32 images are computed from the uint8 ones. A
+  manifest with the fingerprint of the batch files and the SHA-256 hash of
+  every array is written last, and all files are moved into place
+  atomically, so concurrent runs never read a partial cache.
+  Args:
+    data_dir: Data directory.
+    cache_dir: Directory of the cache, data_dir/cache by default.
+    workers: Number of threads decoding the batch files in parallel.
+  Returns:
+    manifest: Dictionary describing the cache.
+  """
+  cache_dir = cache_dir or os.path.join(data_dir, CACHE_FOLDER)
+  if not os.path.exists(cache_dir):
+    os.makedirs(cache_dir)
+
+  fingerprint = source_fingerprint(data_dir)
+  X_train, Y_train, X_test, Y_test, mean_image = \
+      load_preprocessed_cifar10(data_dir, uint8 = True, workers = workers)
+  preprocessed = [np.subtract(X_train, mean_image, dtype = np.float32), Y_train,
+                  np.subtract(X_test, mean_image, dtype = np.float32), Y_test,
+                  mean_image, X_train, X_test]
+
+  manifest = {'version': CACHE_VERSION, 'source': fingerprint, 'sha256': {}}
+  for name, array in zip(CACHE_ARRAYS, preprocessed):
+    filename = os.path.join(cache_dir, name + '.npy')
+    tmp_filename = filename + '.' + str(os.getpid()) + '.tmp'
+    with open(tmp_filename, 'wb') as f:
+      np.save(f, np.ascontiguousarray(array))
+    manifest['sha256'][name] = file_sha256(tmp_filename)
+    os.replace(tmp_filename, filename)
+
+  tmp_filename = os.path.join(cache_dir, 'manifest.json.' + str(os.getpid()))
+  with open(tmp_filename, 'w') as f:
+    json.dump(manifest, f, indent = 2)
+  os.replace(tmp_filename, os.path.join(cache_dir, 'manifest.json'))
+  return manifest
+
+def load_cifar10_cache(data_dir, cache_dir = None, mmap_mode = 'r', verify = False):
+  """
+  Loads the arrays written by write_cifar10_cache, memory-mapped by default,
+  so loading takes milliseconds and parallel runs share the page cache.
+  Args:
+    data_dir: Data directory.
+    cache_dir: Directory of the cache, data_dir/cache by default.
+    mmap_mode: Memory-map mode passed to np.load, None reads the arrays.
+    verify: Flag for checking the SHA-256 hashes of the arrays, which reads
+            all of them.
+  Returns:
+    Dictionary from array name to array, or None if there is no cache or it
+    was built from other batch files.
+  """
+  cache_dir = cache_dir or os.path.join(data_dir, CACHE_FOLDER)
+  try:
+    with open(os.path.join(cache_dir, 'manifest.json')) as f:
+      manifest = json.load(f)
+    if manifest['version'] != CACHE_VERSION or \
+       manifest['source'] != source_fingerprint(data_dir):
+      return None
+  except (OSError, ValueError, KeyError):
+    return None
+
+  arrays = {}
+  for name in CACHE_ARRAYS:
+    filename = os.path.join(cache_dir, name + '.npy')
+    if verify and file_sha256(filename) != manifest['sha256'][name]:
+      raise ValueError("Cached array {0} does not match its hash.".format(filename))
+    arrays[name] = np.load(filename, mmap_mode = mmap_mode)
+  return arrays
+
+def get_preprocessed_cifar10(data_dir, use_cache = True, uint8 = False,
+                             workers = DECODE_WORKERS_DEFAULT):
+  """
+  Returns the preprocessed CIFAR10 arrays, from the cache if possible. The
+  cache is written on the first call, unless data_dir is not writable.
+  Args:
+    data_dir: Data directory.
+    use_cache: Flag for reading and writing the cache.
+    uint8: Flag for returning the raw uint8 images instead of the
+           mean-subtracted float32 images.
+    workers: Number of threads decoding the batch files in parallel.
+  Returns:
+    X_train: CIFAR10 train data in numpy array with shape (50000, 3, 32, 32).
+    Y_train: CIFAR10 train labels in numpy array with shape (50000, ).
+    X_test: CIFAR10 test data in numpy array with shape (10000, 3, 32, 32).
+    Y_test: CIFAR10 test labels in numpy array with shape (10000, ).
+    mean_image: Mean train image in numpy array with shape (3, 32, 32).
+  """
+  names = CACHE_ARRAYS[:5]
+  if uint8:
+    names = ['train_images_uint8', 'train_labels', 'test_images_uint8',
+             'test_labels', 'mean_image']
+  if use_cache:
+    arrays = load_cifar10_cache(data_dir)
+    if arrays is None:
+      try:
+        write_cifar10_cache(data_dir, workers = workers)
+        arrays = load_cifar10_cache(data_dir)
+      except OSError:
+        pass
+    if arrays is not None:
+      return [arrays[name] for name in names]
+
+  return load_preprocessed_cifar10(data_dir, uint8, workers)
+
 def dense_to_one_hot(labels_dense, num_classes):
   """
   Convert class labels from scalars to one-hot vectors.
@@ -116,17 +390,64 @@ def dense_to_one_hot(labels_dense, num_classes):
   labels_one_hot.flat[index_offset + labels_dense.ravel()] = 1
   return labels_one_hot
 
+def dense_to_sparse(labels_dense, num_classes):
+  """
+  Converts class labels to the smallest unsigned integer type holding all
+  classes, uint8 for CIFAR10, instead of expanding them to one-hot vectors.
+  Args:
+    labels_dense: Dense labels.
+    num_classes: Number of classes.
+  Returns:
+    labels_sparse: Class indices of the labels.
+  """
+  return labels_dense.astype(np.min_scalar_type(num_classes - 1), copy = False)
+
+def class_indices(labels):
+  """
+  Returns the class indices of one-hot encoded or sparse labels.
+  Args:
+    labels: One-hot labels of shape (N, num_classes) or class indices of
+            shape (N, ).
+  Returns:
+    Class indices of shape (N, ).
+  """
+  if labels.ndim > 1:
+    return labels.argmax(axis = 1)
+  return labels
+
+def count_classes(labels):
+  """
+  Returns the number of classes of one-hot encoded or sparse labels.
+  """
+  if labels.ndim > 1:
+    return labels.shape[1]
+  return int(labels.max()) + 1
+
 class DataSet(object):
   """
-  Utility class to handle dataset structure.
+  Utility class to handle dataset structure. The data itself is never
+  reordered, shuffling permutes an index into it and batches are gathered
+  with np.take, into reusable buffers after allocate_buffers. Images can be
+  stored as raw uint8 pixels together with the mean image, or in another
+  type than the batches, the batches are then converted and mean-subtracted
+  as they are gathered.
   """
 
-  def __init__(self, images, labels):
+  def __init__(self, images, labels, mean = None, dtype = None, std = None):
     """
     Builds dataset with images and labels.
     Args:
       images: Images data.
       labels: Labels data
+      mean: Optional mean image. If given, images holds raw pixels and the
+            gathered batches are images - mean in dtype, see normalize.
+      dtype: Type of the gathered images, by default float32 if mean or
+             std is given and the type of images otherwise. Images of
+             another type are cast batch by batch.
+      std: Optional standard deviation of every channel of the images of
+           shape (n_samples, channels, height, width). If given, the
+           gathered batches are also divided by it, like the images
+           passed through normalize for evaluation.
     """
     assert images.shape[0] == labels.shape[0], (
           "images.shape: {0}, labels.shape: {1}".format(str(images.shape), str(labels.shape)))
@@ -134,6 +455,14 @@ class DataSet(object):
     self._num_examples = images.shape[0]
     self._images = images
     self._labels = labels
+    self._mean = mean
+    self._dtype = None if dtype is None else np.dtype(dtype)
+    self._std = None
+    if std is not None:
+      self._std = np.asarray(std, self.image_dtype).reshape(-1, 1, 1)
+    self._perm = np.arange(self._num_examples)
+    self._buffers = None
+    self._pinned = False
     self._epochs_completed = 0
     self._index_in_epoch = 0
 
@@ -145,6 +474,27 @@ class DataSet(object):
   def labels(self):
     return self._labels
 
+  @property
+  def mean(self):
+    return self._mean
+
+  @property
+  def std(self):
+    if self._std is None:
+      return None
+    return self._std.ravel()
+
+  @property
+  def image_dtype(self):
+    """
+    Type of the images of the gathered batches.
+    """
+    if self._dtype is not None:
+      return self._dtype
+    if self._mean is None and self._std is None:
+      return self._images.dtype
+    return np.dtype(np.float32)
+
   @property
   def num_examples(self):
     return self._num_examples
@@ -153,52 +503,733 @@ class DataSet(object):
   def epochs_completed(self):
     return self._epochs_completed
 
-  def next_batch(self, batch_size):
+  def allocate_buffers(self, batch_size, pin_memory = False):
     """
-    Return the next `batch_size` examples from this data set.
+    Preallocates the buffers batches of batch_size examples are gathered
+    into. The batches returned by next_batch are then overwritten by the
+    next call.
+    Args:
+      batch_size: Batch size.
+      pin_memory: Flag for page-locking the buffers, which speeds up and
+                  allows asynchronous copies to a CUDA device. Needs
+                  PyTorch and is ignored if CUDA is not available. A
+                  non_blocking copy of a batch may still read the buffers
+                  after next_batch returns, so next_batch waits for the
+                  work queued on the current CUDA stream before it
+                  overwrites them.
+    """
+    self._pinned = _pinned(pin_memory)
+    self._buffers = [_empty((batch_size,) + self._images.shape[1:], self.image_dtype, pin_memory),
+                     _empty((batch_size,) + self._labels.shape[1:], self._labels.dtype, pin_memory)]
+
+  def sample_indices(self, batch_size, replace = False):
+    """
+    Returns the indices of the next `batch_size` examples.
     Args:
       batch_size: Batch size.
+      replace: Flag for sampling the examples uniformly with replacement,
+               instead of going through the shuffled data set epoch by
+               epoch.
     """
+    if replace:
+      return np.random.randint(self._num_examples, size = batch_size)
+
     start = self._index_in_epoch
     self._index_in_epoch += batch_size
     if self._index_in_epoch > self._num_examples:
       self._epochs_completed += 1
 
+      # composing the permutations keeps the order of reshuffling the data
       perm = np.arange(self._num_examples)
       np.random.shuffle(perm)
-      self._images = self._images[perm]
-      self._labels = self._labels[perm]
+      self._perm = self._perm[perm]
 
       start = 0
       self._index_in_epoch = batch_size
       assert batch_size <= self._num_examples
 
     end = self._index_in_epoch
-    return self._images[start:end], self._labels[start:end]
+    return self._perm[start:end]
+
+  def next_batch(self, batch_size, replace = False):
+    """
+    Return the next `batch_size` examples from this data set.
+    Args:
+      batch_size: Batch size.
+      replace: Flag for sampling the examples uniformly with replacement,
+               instead of going through the shuffled data set epoch by
+               epoch.
+    """
+    indices = self.sample_indices(batch_size, replace)
+    if self._buffers is None or len(self._buffers[0]) != batch_size:
+      return self.take(indices)
+    if self._pinned:
+      _synchronize()
+    return self.take(indices, self._buffers)
+
+  def take(self, indices, out = None):
+    """
+    Gathers the examples with the given indices.
+    Args:
+      indices: Indices of the examples.
+      out: Optional pair of arrays the images and labels are written into.
+    """
+    if self._converts():
+      # the conversion is fused into the gather, only the gathered raw
+      # pixels are a temporary
+      images = np.take(self._images, indices, axis = 0)
+      if out is None:
+        return self.normalize(images), np.take(self._labels, indices, axis = 0)
+      self.normalize(images, out[0])
+    elif out is None:
+      return np.take(self._images, indices, axis = 0), \
+             np.take(self._labels, indices, axis = 0)
+    else:
+      np.take(self._images, indices, axis = 0, out = out[0])
+    np.take(self._labels, indices, axis = 0, out = out[1])
+    return out[0], out[1]
+
+  def normalize(self, images, out = None):
+    """
+    Converts stored images, e.g. a slice of the images property, into the
+    images the batches contain. The float32 result equals the images
+    preprocessed at load time, divided by the standard deviations if given.
+    Args:
+      images: Images as stored in this data set.
+      out: Optional array the result is written into.
+    """
+    if not self._converts():
+      if out is None:
+        return images
+      np.copyto(out, images)
+      return out
+    if self._mean is not None:
+      out = np.subtract(images, self._mean, out = out, dtype = self.image_dtype)
+    elif out is None:
+      out = images.astype(self.image_dtype)
+    else:
+      np.copyto(out, images)
+    if self._std is not None:
+      out /= self._std
+    return out
+
+  def _converts(self):
+    """
+    Returns whether the gathered images differ from the stored ones.
+    """
+    return self._mean is not None or self._std is not None or \
+           self.image_dtype != self._images.dtype
+
+class BatchSampler(object):
+  """
+  Deterministic sampler of the batch indices of a data set. The indices of
+  a step are a pure function of the seed and the step: they are drawn from
+  a counter-based Philox generator keyed by the seed, with the step, or the
+  epoch without replacement, as its counter. Any step is produced without
+  replaying the steps before it, so the state needed to resume a run is
+  the seed and the step. Without replacement every epoch is a permutation
+  of the data set, computed once when the epoch is reached, and the last
+  incomplete batch of an epoch is dropped, like in DataSet.next_batch.
+  """
+
+  def __init__(self, num_examples, batch_size, seed = 0, replace = False, step = 0):
+    """
+    Initializes the sampler.
+    Args:
+      num_examples: Number of examples of the data set.
+      batch_size: Batch size.
+      seed: Seed of the generator, an integer below 2**64.
+      replace: Flag for sampling the examples uniformly with replacement,
+               instead of going through permutations epoch by epoch.
+      step: Step the iteration starts at.
+    """
+    assert replace or batch_size <= num_examples
+    self.num_examples = num_examples
+    self.batch_size = batch_size
+    self.seed = seed
+    self.replace = replace
+    self.step = step
+    self._epoch = None
+    self._perm = None
+
+  @property
+  def batches_per_epoch(self):
+    return max(self.num_examples // self.batch_size, 1)
+
+  @property
+  def epoch(self):
+    return self.step // self.batches_per_epoch
+
+  def _generator(self, stream, counter):
+    return np.random.Generator(np.random.Philox(key = [self.seed, stream],
+                                                counter = [0, counter, 0, 0]))
+
+  def indices(self, step):
+    """
+    Returns the indices of the batch of a step.
+    Args:
+      step: Step of the batch.
+    """
+    if self.replace:
+      return self._generator(0, step).integers(self.num_examples, size = self.batch_size)
+
+    epoch, batch = divmod(step, self.batches_per_epoch)
+    if epoch != self._epoch:
+      self._perm = self._generator(1, epoch).permutation(self.num_examples)
+      self._epoch = epoch
+    return self._perm[batch * self.batch_size:(batch + 1) * self.batch_size]
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    indices = self.indices(self.step)
+    self.step += 1
+    return indices
+
+  def state_dict(self):
+    """
+    Returns the state of the sampler as a JSON-serializable dictionary.
+    """
+    return {'num_examples': self.num_examples, 'batch_size': self.batch_size,
+            'seed': self.seed, 'replace': self.replace, 'step': self.step}
+
+  def load_state_dict(self, state):
+    """
+    Restores a state returned by state_dict, the next batch is the one of
+    the restored step.
+    Args:
+      state: State of a sampler over the same data set and batch size.
+    """
+    for key in ['num_examples', 'batch_size', 'replace']:
+      if state[key] != getattr(self, key):
+        raise ValueError("Sampler state has {0} {1}, expected {2}.".format(
+            key, state[key], getattr(self, key)))
+    self.seed = state['seed']
+    self.step = state['step']
+
+class BatchPrefetcher(object):
+  """
+  Iterator over the batches of a DataSet that gathers and transforms the
+  next `depth` batches on a background thread while the trainer computes.
+  The indices are still drawn on the calling thread, in the same order as
+  by next_batch, so training with and without prefetching is identical.
+  A batch stays valid until the next one is requested. The time the
+  trainer waited for batches is recorded in wait_time. If gathering or
+  transforming a batch fails, the thread stops and every later request
+  raises its error.
+  With pinned buffers, the transform may copy a batch to the device with
+  non_blocking = True. An event recorded after the transform marks when
+  those copies are done, and a slot is only gathered into again after it.
+  """
+
+  def __init__(self, dataset, batch_size, depth = 2, replace = False,
+               transform = None, pin_memory = False, sampler = None):
+    """
+    Starts the background thread.
+    Args:
+      dataset: DataSet to draw the batches from.
+      batch_size: Batch size.
+      depth: Number of batches prepared ahead.
+      replace: Flag for sampling with replacement, see DataSet.next_batch.
+      transform: Optional function applied to the images and labels of
+                 every batch on the background thread, e.g. converting
+                 them to tensors on a device.
+      pin_memory: Flag for gathering into page-locked buffers. Copies
+                  the transform issues on the current CUDA stream of the
+                  background thread are waited for before a buffer is
+                  reused.
+      sampler: Optional BatchSampler drawing the indices instead of the
+               data set. It runs depth batches ahead of the trainer.
+    """
+    self.dataset = dataset
+    self.batch_size = batch_size
+    self.replace = replace
+    self.sampler = sampler
+    self.transform = transform
+    self.wait_time = 0.
+    self.num_batches = 0
+
+    # one more slot than batches in flight, for the batch in use
+    self._slots = [[_empty((batch_size,) + dataset.images.shape[1:], dataset.image_dtype, pin_memory),
+                    _empty((batch_size,) + dataset.labels.shape[1:], dataset.labels.dtype, pin_memory)]
+                   for _ in range(depth + 1)]
+    self._pinned = _pinned(pin_memory)
+    self._events = [None] * (depth + 1)
+    self._free = queue.Queue()
+    for slot in range(depth + 1):
+      self._free.put(slot)
+    self._tasks = queue.Queue()
+    self._ready = queue.Queue()
+    self._held = None
+    self._error = None
+
+    for _ in range(depth):
+      self._request()
+    self._thread = threading.Thread(target = self._produce, daemon = True)
+    self._thread.start()
+
+  def _request(self):
+    if self.sampler is not None:
+      self._tasks.put(next(self.sampler))
+    else:
+      self._tasks.put(self.dataset.sample_indices(self.batch_size, self.replace))
+
+  def _produce(self):
+    """
+    Gathers and transforms the requested batches until close is called.
+    """
+    while True:
+      indices = self._tasks.get()
+      if indices is None:
+        return
+      slot = self._free.get()
+      try:
+        if self._events[slot] is not None:
+          # the copies of the last batch in the slot may still read it
+          self._events[slot].synchronize()
+        batch = self.dataset.take(indices, self._slots[slot])
+        if self.transform is not None:
+          batch = self.transform(*batch)
+        if self._pinned:
+          self._events[slot] = _record_event()
+      except Exception as error:
+        self._ready.put((slot, error))
+        return
+      self._ready.put((slot, batch))
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    if self._error is not None:
+      # the background thread has stopped, no batch would ever be ready
+      raise self._error
+    if self._held is not None:
+      self._free.put(self._held)
+    self._request()
+
+    start = time.perf_counter()
+    self._held, batch = self._ready.get()
+    self.wait_time += time.perf_counter() - start
+    self.num_batches += 1
+
+    if isinstance(batch, Exception):
+      self._error = batch
+      raise batch
+    return batch
+
+  def mean_wait_time(self):
+    """
+    Returns the average time in seconds the trainer waited for a batch.
+    """
+    return self.wait_time / max(self.num_batches, 1)
+
+  def close(self):
+    """
+    Stops the background thread.
+    """
+    self._tasks.put(None)
+    if self._held is not None:
+      self._free.put(self._held)
+      self._held = None
+    self._thread.join()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+def _pinned(pin_memory):
+  """
+  Returns whether _empty allocates page-locked memory for pin_memory, which
+  needs CUDA.
+  """
+  if not pin_memory:
+    return False
+  import torch
+  return torch.cuda.is_available()
+
+def _synchronize():
+  """
+  Waits for the work queued on the current CUDA stream, e.g. non_blocking
+  copies from page-locked buffers that are about to be overwritten.
+  """
+  import torch
+  torch.cuda.current_stream().synchronize()
+
+def _record_event():
+  """
+  Returns a CUDA event recorded on the current stream, which completes once
+  the work queued on it so far, e.g. non_blocking copies, is done.
+  """
+  import torch
+  event = torch.cuda.Event()
+  event.record()
+  return event
+
+def _empty(shape, dtype, pin_memory = False):
+  """
+  Returns a new uninitialized array, in page-locked memory if requested and
+  CUDA is available. A non_blocking copy from page-locked memory returns
+  before the data is read, so the owner of a reused buffer has to wait for
+  the copy, e.g. with _synchronize or an event from _record_event, before
+  writing the next batch into it.
+  """
+  if _pinned(pin_memory):
+    import torch
+    return torch.empty(shape, dtype = torch.from_numpy(np.empty(0, dtype)).dtype)\
+                .pin_memory().numpy()
+  return np.empty(shape, dtype)
+
+class ShardWriter(object):
+  """
+  Writes a dataset as a directory of fixed-size shards, one images and one
+  labels .npy file per shard, and an index.json describing them. Examples
+  are appended chunk by chunk and only the current shard is held in memory,
+  so datasets larger than RAM can be written. The index is written last and
+  moved into place atomically.
+  """
+
+  def __init__(self, directory, shard_size = SHARD_SIZE_DEFAULT, metadata = None):
+    """
+    Creates the directory.
+    Args:
+      directory: Directory of the shards.
+      shard_size: Number of examples per shard, the last shard may be smaller.
+      metadata: Optional dictionary stored in the index.
+    """
+    if not os.path.exists(directory):
+      os.makedirs(directory)
+    self.directory = directory
+    self.shard_size = shard_size
+    self.metadata = metadata or {}
+    self.shard_sizes = []
+    self._buffers = None
+    self._count = 0
+
+  def write(self, images, labels):
+    """
+    Appends examples, writing every shard that is full.
+    Args:
+      images: Images of the examples.
+      labels: Labels of the examples.
+    """
+    assert len(images) == len(labels)
+    if self._buffers is None:
+      self._buffers = [np.empty((self.shard_size,) + array.shape[1:], array.dtype)
+                       for array in [images, labels]]
+
+    start = 0
+    while start < len(images):
+      end = min(len(images), start + self.shard_size - self._count)
+      for buffer, array in zip(self._buffers, [images, labels]):
+        buffer[self._count:self._count + end - start] = array[start:end]
+      self._count += end - start
+      start = end
+      if self._count == self.shard_size:
+        self._flush()
+
+  def _flush(self):
+    shard = len(self.shard_sizes)
+    for name, buffer in zip(['images', 'labels'], self._buffers):
+      np.save(os.path.join(self.directory, _shard_filename(shard, name)),
+              buffer[:self._count])
+    self.shard_sizes.append(self._count)
+    self._count = 0
+
+  def close(self):
+    """
+    Writes the last shard and the index.
+    Returns:
+      index: Dictionary describing the shards.
+    """
+    if self._buffers is None:
+      raise ValueError("No examples were written to {0}.".format(self.directory))
+    if self._count > 0:
+      self._flush()
+
+    index = dict(self.metadata, version = SHARD_VERSION,
+                 shard_size = self.shard_size, shard_sizes = self.shard_sizes)
+    for name, buffer in zip(['images', 'labels'], self._buffers):
+      index[name] = {'shape': list(buffer.shape[1:]), 'dtype': buffer.dtype.str}
+    self._buffers = None
+
+    tmp_filename = os.path.join(self.directory, 'index.json.' + str(os.getpid()))
+    with open(tmp_filename, 'w') as f:
+      json.dump(index, f, indent = 2)
+    os.replace(tmp_filename, os.path.join(self.directory, 'index.json'))
+    return index
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, error_type, *args):
+    if error_type is None:
+      self.close()
+
+def _shard_filename(shard, name):
+  return 'shard_{0:05d}_{1}.npy'.format(shard, name)
+
+class ShardedDataSet(DataSet):
+  """
+  DataSet over a directory written by ShardWriter. The shards are
+  memory-mapped lazily and at most max_open_shards of them stay mapped, the
+  least recently used one is unmapped first, so the resident memory is
+  bounded by a few shards whatever the size of the dataset. An epoch goes
+  through the shards in shuffled order and through the examples of every
+  shard in shuffled order, so consecutive batches are read from one shard.
+  images and labels are lazy arrays that gather the indexed examples.
+  """
+
+  def __init__(self, directory, max_open_shards = 2):
+    """
+    Reads the index of the shards.
+    Args:
+      directory: Directory written by ShardWriter.
+      max_open_shards: Maximal number of memory-mapped shards.
+    """
+    with open(os.path.join(directory, 'index.json')) as f:
+      self.index = json.load(f)
+    self.directory = directory
+    self.max_open_shards = max_open_shards
+
+    self._offsets = np.concatenate([[0], np.cumsum(self.index['shard_sizes'])])\
+                      .astype(np.int64)
+    self._mapped = collections.OrderedDict()
+    self._lock = threading.Lock()
+    num_examples = int(self._offsets[-1])
+    super(ShardedDataSet, self).__init__(
+        _ShardedArray(self, 0, self.index['images'], num_examples),
+        _ShardedArray(self, 1, self.index['labels'], num_examples))
+
+    # the first epoch reads the shards in order, like DataSet
+    self._shard_order = np.arange(self.num_shards)
+    self._next_shard = 0
+    self._shard_perm = np.empty(0, np.int64)
+    self._index_in_shard = 0
+
+  @property
+  def num_shards(self):
+    return len(self._offsets) - 1
+
+  @property
+  def open_shards(self):
+    """
+    Returns the numbers of the memory-mapped shards.
+    """
+    return list(self._mapped)
+
+  def sample_indices(self, batch_size, replace = False):
+    """
+    Returns the indices of the next `batch_size` examples.
+    Args:
+      batch_size: Batch size.
+      replace: Flag for sampling the examples uniformly with replacement,
+               instead of going through the shuffled shards epoch by epoch.
+    """
+    if replace:
+      return np.random.randint(self._num_examples, size = batch_size)
+
+    if self._index_in_epoch + batch_size > self._num_examples:
+      assert batch_size <= self._num_examples
+      self._epochs_completed += 1
+      self._shard_order = np.random.permutation(self.num_shards)
+      self._next_shard = 0
+      self._shard_perm = np.empty(0, np.int64)
+      self._index_in_shard = 0
+      self._index_in_epoch = 0
+    self._index_in_epoch += batch_size
+
+    pieces = []
+    while batch_size > 0:
+      if self._index_in_shard == len(self._shard_perm):
+        shard = self._shard_order[self._next_shard]
+        self._next_shard += 1
+        self._shard_perm = np.arange(self._offsets[shard], self._offsets[shard + 1])
+        if self._epochs_completed > 0:
+          np.random.shuffle(self._shard_perm)
+        self._index_in_shard = 0
+
+      piece = self._shard_perm[self._index_in_shard:self._index_in_shard + batch_size]
+      self._index_in_shard += len(piece)
+      batch_size -= len(piece)
+      pieces.append(piece)
+    return np.concatenate(pieces)
+
+  def take(self, indices, out = None):
+    """
+    Gathers the examples with the given indices, shard by shard.
+    Args:
+      indices: Indices of the examples.
+      out: Optional pair of arrays the images and labels are written into.
+    """
+    if out is None:
+      out = [None, None]
+    return self._gather(0, indices, out[0]), self._gather(1, indices, out[1])
+
+  def _gather(self, field, indices, out = None):
+    """
+    Gathers the images (field 0) or labels (field 1) with the given indices.
+    """
+    array = [self._images, self._labels][field]
+    indices = np.asarray(indices, np.int64)
+    if out is None:
+      out = np.empty(indices.shape + array.shape[1:], array.dtype)
+
+    shards = np.searchsorted(self._offsets, indices, side = 'right') - 1
+    for shard in np.unique(shards):
+      positions = np.flatnonzero(shards == shard)
+      out[positions] = self._shard(shard)[field][indices[positions] - self._offsets[shard]]
+    return out
+
+  def _shard(self, shard):
+    """
+    Returns the memory-mapped images and labels of a shard.
+    """
+    with self._lock:
+      if shard in self._mapped:
+        self._mapped.move_to_end(shard)
+      else:
+        self._mapped[shard] = [
+            np.load(os.path.join(self.directory, _shard_filename(shard, name)),
+                    mmap_mode = 'r')
+            for name in ['images', 'labels']]
+        while len(self._mapped) > self.max_open_shards:
+          self._mapped.popitem(last = False)
+      return self._mapped[shard]
+
+class _ShardedArray(object):
+  """
+  Read-only array-like view of the images or labels of a ShardedDataSet.
+  Indexing with an int, a slice or an index array gathers the examples from
+  the shards into a new array.
+  """
+
+  def __init__(self, dataset, field, spec, num_examples):
+    self._dataset = dataset
+    self._field = field
+    self.shape = (num_examples,) + tuple(spec['shape'])
+    self.dtype = np.dtype(spec['dtype'])
+    self.ndim = len(self.shape)
+    self.size = int(np.prod(self.shape))
+
+  def __len__(self):
+    return self.shape[0]
+
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      return self._dataset._gather(self._field, np.arange(*key.indices(len(self))))
+    if np.ndim(key) == 0:
+      index = int(key) + len(self) if key < 0 else int(key)
+      if not 0 <= index < len(self):
+        raise IndexError("index {0} is out of bounds for size {1}".format(key, len(self)))
+      return self._dataset._gather(self._field, [index])[0]
+    return self._dataset._gather(self._field, key)
+
+def write_cifar10_shards(data_dir, shard_dir = None, shard_size = SHARD_SIZE_DEFAULT):
+  """
+  Writes the mean-subtracted CIFAR10 train and test sets as shards into
+  shard_dir/train and shard_dir/test, with sparse labels. The batch files are
+  read one at a time, a first pass sums the mean train image and a second
+  one writes the shards, so at most one batch file and one shard are in
+  memory.
+  Args:
+    data_dir: Data directory.
+    shard_dir: Directory of the shards, data_dir/shards by default.
+    shard_size: Number of examples per shard.
+  Returns:
+    mean_image: Mean train image in numpy array with shape (3, 32, 32).
+  """
+  shard_dir = shard_dir or os.path.join(data_dir, SHARD_FOLDER)
+  filenames = [os.path.join(data_dir, filename) for filename in BATCH_FILES]
+
+  mean_sum, count, num_classes = np.zeros((3, 32, 32)), 0, 0
+  for filename in filenames[:-1]:
+    X, Y = read_cifar10_batch(filename)
+    mean_sum += np.sum(X, axis = 0, dtype = np.float64)
+    count += len(X)
+    num_classes = max(num_classes, int(Y.max()) + 1)
+  mean_image = (mean_sum / count).astype(np.float32)
+
+  metadata = {'source': source_fingerprint(data_dir), 'num_classes': num_classes}
+  for split, split_filenames in [('train', filenames[:-1]), ('test', filenames[-1:])]:
+    with ShardWriter(os.path.join(shard_dir, split), shard_size, metadata) as writer:
+      for filename in split_filenames:
+        X, Y = read_cifar10_batch(filename)
+        X = X.astype(np.float32)
+        X -= mean_image
+        writer.write(X, dense_to_sparse(Y, num_classes))
+  np.save(os.path.join(shard_dir, 'mean_image.npy'), mean_image)
+  return mean_image
+
+def get_sharded_cifar10(data_dir = CIFAR10_FOLDER, shard_dir = None,
+                        shard_size = SHARD_SIZE_DEFAULT, max_open_shards = 2):
+  """
+  Returns the CIFAR10 train and test sets as ShardedDataSets with sparse
+  labels. The shards are written on the first call and rewritten if they
+  were built from other batch files or with another shard size.
+  Args:
+    data_dir: Data directory.
+    shard_dir: Directory of the shards, data_dir/shards by default.
+    shard_size: Number of examples per shard.
+    max_open_shards: Maximal number of memory-mapped shards per dataset.
+  Returns:
+    Dictionary with Train and Test ShardedDataSets
+  """
+  shard_dir = shard_dir or os.path.join(data_dir, SHARD_FOLDER)
+  splits = ['train', 'test']
+  try:
+    datasets = {split: ShardedDataSet(os.path.join(shard_dir, split), max_open_shards)
+                for split in splits}
+    if all(dataset.index['version'] == SHARD_VERSION and
+           dataset.index['shard_size'] == shard_size and
+           dataset.index['source'] == source_fingerprint(data_dir)
+           for dataset in datasets.values()):
+      return datasets
+  except (OSError, ValueError, KeyError):
+    pass
+
+  write_cifar10_shards(data_dir, shard_dir, shard_size)
+  return {split: ShardedDataSet(os.path.join(shard_dir, split), max_open_shards)
+          for split in splits}
 
-def read_data_sets(data_dir, one_hot = True, validation_size = 0):
+def read_data_sets(data_dir, one_hot = True, validation_size = 0, use_cache = True,
+                   uint8 = False, workers = DECODE_WORKERS_DEFAULT):
   """
   Returns the dataset readed from data_dir.
   Uses or not uses one-hot encoding for the labels.
   Subsamples validation set with specified size if necessary.
   Args:
     data_dir: Data directory.
-    one_hot: Flag for one hot encoding.
+    one_hot: Flag for one hot encoding. Without it the labels are class
+             indices in the smallest unsigned integer type, see
+             dense_to_sparse.
     validation_size: Size of validation set
+    use_cache: Flag for using the preprocessed arrays cached in data_dir.
+               The cached images are read-only memory maps.
+    uint8: Flag for storing the raw uint8 images, a quarter of the memory.
+           The datasets subtract the mean image while gathering batches,
+           which then are identical to the preprocessed ones.
+    workers: Number of threads decoding the batch files in parallel.
   Returns:
     Dictionary with Train, Validation, Test Datasets
   """
-  # Extract CIFAR10 data
-  train_images_raw, train_labels_raw, test_images_raw, test_labels_raw = \
-      get_cifar10_raw_data(data_dir)
-  train_images, train_labels, test_images, test_labels = \
-      preprocess_cifar10_data(train_images_raw, train_labels_raw, test_images_raw, test_labels_raw)
+  # Extract and preprocess CIFAR10 data
+  train_images, train_labels, test_images, test_labels, mean_image = \
+      get_preprocessed_cifar10(data_dir, use_cache, uint8, workers)
+  if not uint8:
+    mean_image = None
 
-  # Apply one-hot encoding if specified
+  # Apply one-hot encoding if specified, compact the class indices otherwise
+  num_classes = len(np.unique(train_labels))
   if one_hot:
-    num_classes = len(np.unique(train_labels))
     train_labels = dense_to_one_hot(train_labels, num_classes)
     test_labels = dense_to_one_hot(test_labels, num_classes)
+  else:
+    train_labels = dense_to_sparse(train_labels, num_classes)
+    test_labels = dense_to_sparse(test_labels, num_classes)
 
   # Subsample the validation set from the train set
   if not 0 <= validation_size <= len(train_images):
@@ -211,20 +1242,26 @@ def read_data_sets(data_dir, one_hot = True, validation_size = 0):
   train_labels = train_labels[validation_size:]
 
   # Create datasets
-  train = DataSet(train_images, train_labels)
-  validation = DataSet(validation_images, validation_labels)
-  test = DataSet(test_images, test_labels)
+  train = DataSet(train_images, train_labels, mean_image)
+  validation = DataSet(validation_images, validation_labels, mean_image)
+  test = DataSet(test_images, test_labels, mean_image)
 
   return {'train': train, 'validation': validation, 'test': test}
 
-def get_cifar10(data_dir = CIFAR10_FOLDER, one_hot = True, validation_size = 0):
+def get_cifar10(data_dir = CIFAR10_FOLDER, one_hot = True, validation_size = 0,
+                use_cache = True, uint8 = False, workers = DECODE_WORKERS_DEFAULT):
   """
   Prepares CIFAR10 dataset.
   Args:
     data_dir: Data directory.
-    one_hot: Flag for one hot encoding.
+    one_hot: Flag for one hot encoding, class indices are returned
+             otherwise.
     validation_size: Size of validation set
+    use_cache: Flag for using the preprocessed arrays cached in data_dir.
+    uint8: Flag for storing the raw uint8 images, see read_data_sets.
+    workers: Number of threads decoding the batch files in parallel.
   Returns:
     Dictionary with Train, Validation, Test Datasets
   """
-  return read_data_sets(data_dir, one_hot, validation_size)
+  return read_data_sets(data_dir, one_hot, validation_size, use_cache, uint8,
+                        workers)
@@ -0,0 +1,79 @@
+"""
+This module implements a Convolutional Neural Network in NumPy, with the
+architecture of the ConvNet in convnet_pytorch.py.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+from modules import *
+from mlp_numpy import MLP
+
+# Output channels of the convolutions, 'M' stands for a max pooling layer
+ARCHITECTURE = [64, 'M', 128, 'M', 256, 256, 'M', 512, 512, 'M', 512, 512,
+                'M']
+
+class ConvNet(MLP):
+    """
+    This class implements a Convolutional Neural Network in NumPy. It
+    outputs logits, to be used together with the SoftmaxCrossEntropyModule.
+    The handling of the parameters, the training and inference modes and
+    the forward and backward passes are those of the MLP.
+    """
+
+    def __init__(self, n_channels, n_classes, dtype=np.float64,
+                 master_weights=False):
+        """
+        Initializes ConvNet object.
+
+        Args:
+          n_channels: number of input channels
+          n_classes: number of classes of the classification problem
+          dtype: floating point type of the parameters, activations and
+                 gradients
+          master_weights: if True, the optimizers apply the updates to a
+                          float64 copy of the parameters
+        """
+        self.layers = []
+
+        for units in ARCHITECTURE:
+            if units == 'M':
+                self.layers.append(MaxPool2dModule(kernel_size=3, stride=2,
+                                                   padding=1))
+            else:
+                self.layers.append(Conv2dModule(n_channels, units,
+                                                kernel_size=3, stride=1,
+                                                padding=1, dtype=dtype))
+                self.layers.append(BatchNorm2dModule(units, dtype=dtype))
+                self.layers.append(ReLUModule())
+                n_channels = units
+
+        # the average pooling with kernel size 1 of the PyTorch model is the
+        # identity and left out
+        self.layers.append(FlattenModule())
+        self.layers.append(LinearModule(n_channels, n_classes, dtype))
+
+        super(ConvNet, self)._init_state(dtype, master_weights)
+
+    def allocate_workspace(self, batch_size):
+        """
+        Sets up a workspace without buffers: the convolution and pooling
+        layers compute their outputs in new arrays, which a preallocated
+        buffer would only add a copy to. Every layer and the loss thus keep
+        allocating their outputs, as with the workspace of the MLP for
+        batches of another size.
+
+        Args:
+          batch_size: number of samples in a training batch
+        """
+        self.workspace = {
+            'batch_size': batch_size,
+            'activations': [None] * len(self.layers),
+            'gradients': [None] * (len(self.layers) + 1)}
+
+    def _inference_buffers(self, batch_size):
+        """
+        Lets every layer allocate its output in inference mode.
+        """
+        return [None] * len(self.layers)
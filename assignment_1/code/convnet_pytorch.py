@@ -36,7 +36,7 @@ class ConvNet(nn.Module):
 
         self.layers = []
 
-        self.layers.append(nn.Conv2d(in_channels=3, out_channels=64,\
+        self.layers.append(nn.Conv2d(in_channels=n_channels, out_channels=64,\
                                 kernel_size=3, stride=1, padding=1))
         self.layers.append(nn.BatchNorm2d(num_features=64))
         self.layers.append(nn.ReLU())
@@ -88,7 +88,14 @@ class ConvNet(nn.Module):
 
         self.layers.append(nn.AvgPool2d(kernel_size=1, stride=1, padding=0))
 
-        self.layers.append(nn.Linear(512, 10))
+        self.layers.append(nn.Flatten())
+
+        self.layers.append(nn.Linear(512, n_classes))
+
+        self.layers = nn.Sequential(*self.layers)
+
+        # memory format the inputs are converted to, None keeps them as given
+        self.memory_format = None
 
         ########################
         # END OF YOUR CODE    #
@@ -111,9 +118,25 @@ class ConvNet(nn.Module):
         ########################
         # PUT YOUR CODE HERE  #
         #######################
+        if self.memory_format is not None:
+            x = x.contiguous(memory_format=self.memory_format)
         out = self.layers(x)
         ########################
         # END OF YOUR CODE    #
         #######################
 
         return out
+
+    def to_channels_last(self):
+        """
+        Converts the parameters to the channels-last memory format, inputs
+        are converted in forward. The oneDNN convolutions of PyTorch on the
+        CPU work on this format directly, instead of reordering the
+        activations around every convolution. Works in training and
+        inference mode.
+
+        Returns:
+          the network itself
+        """
+        self.memory_format = torch.channels_last
+        return self.to(memory_format=torch.channels_last)
@@ -0,0 +1,191 @@
+"""
+This module implements data-parallel training of the NumPy MLP. Every batch
+is split into shards that a pool of worker processes, each holding a replica
+of the network, processes in parallel. The training data, the parameters and
+the per-shard gradients live in shared memory, so only shard boundaries and
+a few scalars are sent between the processes. Raw uint8 images are shared
+as they are and normalized shard by shard in the workers.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from modules import LinearModule, CrossEntropyModule, SoftmaxCrossEntropyModule
+from cifar10_utils import class_indices
+
+# State of a worker process, set up by _init_worker
+_worker = {}
+
+def _share(array):
+    """
+    Copies array into a new block of shared memory.
+
+    Returns:
+      shm: the SharedMemory block
+      view: array backed by the shared memory
+    """
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    view = np.ndarray(array.shape, array.dtype, buffer=shm.buf)
+    view[...] = array
+    return shm, view
+
+def _attach(spec):
+    """
+    Attaches to a block of shared memory described by (name, shape, dtype).
+    """
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype, buffer=shm.buf)
+
+def _init_worker(network, specs):
+    """
+    Sets up a worker process with a replica of the network whose parameters
+    are views into the shared parameter vector.
+    """
+    for key, spec in specs.items():
+        _worker[key + '_shm'], _worker[key] = _attach(spec)
+
+    # the shared parameters may already have been updated by other workers
+    network.flatten_parameters(params=_worker['params'], copy=False)
+    _worker['network'] = network
+    if isinstance(network.layers[-1], LinearModule):
+        _worker['loss'] = SoftmaxCrossEntropyModule()
+    else:
+        _worker['loss'] = CrossEntropyModule()
+
+def _worker_step(task):
+    """
+    Computes the gradients of one shard of the batch and writes them, weighted
+    by the size of the shard, into the gradient slot of the shard.
+
+    Args:
+      task: tuple (shard, start, end, batch_size) with the shard number, the
+            range of the shard in the batch indices and the batch size
+    Returns:
+      loss: loss of the shard, weighted by its share of the batch
+      correct: number of correctly classified samples in the shard
+      dx_sq: squared norm of the share of the shard in the output gradient
+    """
+    shard, start, end, batch_size = task
+    network, loss_module = _worker['network'], _worker['loss']
+    if end == start:
+        _worker['grads'][shard] = 0
+        return 0., 0, 0.
+
+    idx = _worker['indices'][start:end]
+    x_batch = np.take(_worker['x'], idx, axis=0)
+    if 'mean' in _worker:
+        x_batch = np.subtract(x_batch, _worker['mean'], dtype=network.dtype)
+    else:
+        x_batch = x_batch.astype(network.dtype, copy=False)
+    y_batch = np.take(_worker['y'], idx, axis=0)
+
+    out = network.forward(x_batch)
+    dx = loss_module.backward(out, y_batch)
+    network.backward(dx)
+
+    weight = (end - start) / batch_size
+    np.multiply(network.grads, weight, out=_worker['grads'][shard])
+
+    loss = loss_module.forward(out, y_batch) * weight
+    correct = np.sum(out.argmax(axis=1) == class_indices(y_batch))
+    return loss, correct, np.sum(dx ** 2) * weight ** 2
+
+class DataParallelMLP(object):
+    """
+    Trains a NumPy MLP data-parallel over a pool of worker processes.
+    Use it as a context manager or call close() to release the workers and
+    the shared memory.
+    """
+
+    def __init__(self, network, x, y, n_workers, batch_size, mean=None):
+        """
+        Initializes the shared memory and the worker pool.
+
+        Args:
+          network: MLP to train. Its parameters are moved into shared memory
+                   and updated in place, so it can be evaluated directly.
+          x: training inputs of shape (n_samples, n_inputs), either
+             normalized or raw uint8 images together with mean
+          y: one-hot training labels of shape (n_samples, n_classes) or
+             class indices of shape (n_samples,)
+          n_workers: number of worker processes
+          batch_size: maximal number of samples in a batch
+          mean: optional mean image of shape (n_inputs,) that the workers
+                subtract from the gathered raw images of their shards
+        """
+        self.network = network
+        self.n_workers = n_workers
+        self._shms = []
+
+        params = network.params
+        arrays = {'x': x, 'y': y, 'params': params,
+                  'indices': np.zeros(batch_size, np.int64),
+                  'grads': np.zeros((n_workers,) + params.shape, params.dtype)}
+        if mean is not None:
+            arrays['mean'] = mean
+        self._keys = list(arrays)
+        specs = {}
+        for key, array in arrays.items():
+            shm, view = _share(array)
+            self._shms.append(shm)
+            setattr(self, '_' + key, view)
+            specs[key] = (shm.name, array.shape, array.dtype)
+
+        network.flatten_parameters(params=self._params, grads=network.grads)
+        self._pool = multiprocessing.Pool(n_workers, _init_worker,
+                                          (network, specs))
+
+    def step(self, indices, optimizer):
+        """
+        Performs one training step on the samples with the given indices.
+        The gradients of all shards are summed and the update is applied
+        once to the shared parameters.
+
+        Args:
+          indices: indices of the samples in the batch
+          optimizer: optimizer of the network, e.g. optimizers.SGD
+        Returns:
+          loss: loss of the batch
+          accuracy: accuracy of the network on the batch
+          dx_norm: norm of the gradient of the loss w.r.t. the network output
+        """
+        batch_size = len(indices)
+        self._indices[:batch_size] = indices
+
+        bounds = np.linspace(0, batch_size, self.n_workers + 1).astype(int)
+        tasks = [(k, bounds[k], bounds[k + 1], batch_size)
+                 for k in range(self.n_workers)]
+        results = self._pool.map(_worker_step, tasks)
+
+        # all-reduce of the gradients of the shards
+        np.sum(self._grads, axis=0, out=self.network.grads)
+        optimizer.step()
+
+        loss, correct, dx_sq = (sum(values) for values in zip(*results))
+        return loss, correct / batch_size, np.sqrt(dx_sq)
+
+    def close(self):
+        """
+        Stops the workers and releases the shared memory. The parameters of
+        the network are copied back into private memory.
+        """
+        self._pool.terminate()
+        self._pool.join()
+        self.network.flatten_parameters(params=self._params.copy(),
+                                        grads=self.network.grads)
+        for key in self._keys:
+            delattr(self, '_' + key)
+        for shm in self._shms:
+            shm.close()
+            shm.unlink()
+        self._shms = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
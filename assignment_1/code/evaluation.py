@@ -0,0 +1,214 @@
+"""
+This module implements evaluation of trained models on a whole dataset. The
+dataset is streamed through the model in chunks of fixed size, so the
+memory needed for the activations is bounded by the chunk size instead of
+growing with the dataset.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import ctypes
+import time
+import tracemalloc
+import numpy as np
+from modules import CrossEntropyModule
+from cifar10_utils import class_indices
+
+def chunks(dataset, batch_size):
+    """
+    Iterates over a dataset in order, in chunks of at most batch_size samples.
+    The images are as stored, pass them through dataset.normalize.
+
+    Args:
+      dataset: cifar10_utils.DataSet
+      batch_size: maximal number of samples per chunk
+    Returns:
+      iterator of (images, labels) views into the dataset
+    """
+    for start in range(0, dataset.num_examples, batch_size):
+        end = min(start + batch_size, dataset.num_examples)
+        yield dataset.images[start:end], dataset.labels[start:end]
+
+def evaluate(model, dataset, batch_size, loss_module=None, flatten=True,
+             trace_memory=False):
+    """
+    Evaluates a NumPy model on a dataset chunk by chunk. Models with an
+    inference mode, like mlp_numpy.MLP, are evaluated in it and set back to
+    training mode afterwards.
+
+    Args:
+      model: NumPy network, e.g. mlp_numpy.MLP
+      dataset: cifar10_utils.DataSet with one-hot labels or class indices
+      batch_size: number of samples per chunk
+      loss_module: loss matching the output of the model, defaults to the
+                   CrossEntropyModule
+      flatten: whether the model takes flattened images
+      trace_memory: whether to trace the allocations with tracemalloc,
+                    which slows the evaluation down
+    Returns:
+      dictionary with the accuracy and loss over the whole dataset, the
+      throughput in images per second and the peak number of bytes
+      allocated during the evaluation, None unless trace_memory is set
+    """
+    if loss_module is None:
+        loss_module = CrossEntropyModule()
+    dtype = getattr(model, 'dtype', np.float64)
+    training = getattr(model, 'training', False)
+    if training:
+        model.eval()
+
+    tracing = tracemalloc.is_tracing()
+    if trace_memory:
+        if not tracing:
+            tracemalloc.start()
+        tracemalloc.reset_peak()
+    start = time.perf_counter()
+
+    # the chunks are converted into one input buffer
+    sample_shape = dataset.images.shape[1:]
+    if flatten:
+        sample_shape = (int(np.prod(sample_shape)),)
+    x_buffer = np.empty((min(batch_size, dataset.num_examples),) + sample_shape,
+                        dtype)
+
+    loss, correct = 0., 0
+    for images, labels in chunks(dataset, batch_size):
+        x = x_buffer[:len(images)]
+        dataset.normalize(images, out=x.reshape(images.shape))
+        y = labels
+        if labels.ndim > 1:
+            y = labels.astype(dtype, copy=False)
+
+        out = model.forward(x)
+        loss += loss_module.forward(out, y) * len(x)
+        correct += np.sum(out.argmax(axis=1) == class_indices(labels))
+
+    elapsed = time.perf_counter() - start
+    peak_memory = None
+    if trace_memory:
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        if not tracing:
+            tracemalloc.stop()
+    if training:
+        model.train()
+
+    return {'accuracy': correct / dataset.num_examples,
+            'loss': loss / dataset.num_examples,
+            'images_per_sec': dataset.num_examples / elapsed,
+            'peak_memory': peak_memory}
+
+def evaluate_torch(model, dataset, batch_size, loss_fn, device, flatten=True):
+    """
+    Evaluates a PyTorch model on a dataset chunk by chunk without building
+    an autograd graph. The model is evaluated in eval mode, so batch
+    normalization uses its running statistics and leaves them unchanged,
+    and is set back to training mode afterwards if it was training. Frozen
+    TorchScript modules are evaluated as they are.
+
+    Args:
+      model: torch.nn.Module or frozen TorchScript module
+      dataset: cifar10_utils.DataSet with one-hot labels or class indices
+      batch_size: number of samples per chunk
+      loss_fn: loss on the output of the model and the class indices, e.g.
+               nn.CrossEntropyLoss()
+      device: device the model lives on
+      flatten: whether the model takes flattened images
+    Returns:
+      dictionary with the accuracy and loss over the whole dataset, the
+      throughput in images per second and the peak memory in bytes used by
+      the evaluation, allocated on the GPU or resident on the CPU on top of
+      the memory resident before it. It is None where the resident memory
+      can not be measured.
+    """
+    import torch
+
+    # inference mode also skips the version counting of no_grad, it is
+    # missing in PyTorch before 1.9
+    inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+    training = getattr(model, 'training', False)
+    if training:
+        model.eval()
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+        baseline = torch.cuda.memory_allocated(device)
+    else:
+        baseline = _reset_peak_rss()
+
+    # the losses and counts are summed on the device, so the chunks are
+    # not synchronized one by one
+    loss = torch.zeros((), dtype=torch.float64, device=device)
+    correct = torch.zeros((), dtype=torch.int64, device=device)
+    start = time.perf_counter()
+    with inference_mode():
+        for images, labels in chunks(dataset, batch_size):
+            images = dataset.normalize(images)
+            if flatten:
+                images = images.reshape(len(images), -1)
+            x = torch.from_numpy(images).to(device, torch.float32)
+            y = torch.from_numpy(class_indices(labels)).to(device).long()
+
+            out = model(x)
+            loss += loss_fn(out, y).double() * len(x)
+            correct += (out.argmax(dim=1) == y).sum()
+        loss, correct = loss.item(), correct.item()
+    elapsed = time.perf_counter() - start
+
+    if device.type == 'cuda':
+        peak_memory = torch.cuda.max_memory_allocated(device) - baseline
+    else:
+        peak_memory = _peak_rss()
+        if peak_memory is not None and baseline is not None:
+            peak_memory -= baseline
+        else:
+            peak_memory = None
+    if training:
+        model.train()
+
+    return {'accuracy': correct / dataset.num_examples,
+            'loss': loss / dataset.num_examples,
+            'images_per_sec': dataset.num_examples / elapsed,
+            'peak_memory': peak_memory}
+
+def _reset_peak_rss():
+    """
+    Resets the peak resident memory of the process to the memory resident
+    now, which is returned in bytes, or None where this is not supported.
+    The lifetime peak of the process, e.g. ru_maxrss, is lost.
+    """
+    # glibc keeps freed memory resident for reuse, which would hide the
+    # footprint of every evaluation after the first, so it is released
+    try:
+        ctypes.CDLL(None).malloc_trim(0)
+    except (OSError, AttributeError, TypeError):
+        pass
+
+    try:
+        # writing 5 resets the peak resident set size, since Linux 4.0
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        return None
+
+    return _status('VmRSS')
+
+def _peak_rss():
+    """
+    Returns the peak resident memory of the process in bytes since the last
+    _reset_peak_rss, or None where /proc is not available.
+    """
+    return _status('VmHWM')
+
+def _status(key):
+    """
+    Returns a memory size in bytes from /proc/self/status, or None.
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(key + ':'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        return None
+
+    return None
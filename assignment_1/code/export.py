@@ -0,0 +1,308 @@
+"""
+This module implements the export of trained PyTorch models for inference.
+Batch normalization layers are folded into the weights of the layer before
+them, the model is traced and frozen into a TorchScript module and saved as
+a standalone artifact, which torch.jit.load runs without the training code.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import contextlib
+import copy
+import time
+import warnings
+import numpy as np
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval, fuse_linear_bn_eval
+from convnet_pytorch import ConvNet
+from mlp_pytorch import MLP
+
+# Default constants
+MODEL_DEFAULT = 'convnet'
+OUTPUT_DEFAULT = 'model.pt'
+DNN_HIDDEN_UNITS_DEFAULT = '100'
+BATCH_SIZES_DEFAULT = '1,32'
+STEPS_DEFAULT = 20
+
+# Shapes of CIFAR10
+IMAGE_SHAPE = (3, 32, 32)
+NR_LABELS = 10
+
+FLAGS = None
+
+def fold_batchnorm(model):
+    """
+    Returns a copy of a model in eval mode in which every BatchNorm2d that
+    follows a Conv2d and every BatchNorm1d that follows a Linear in an
+    nn.Sequential is folded into the weights and bias of that layer, using
+    the running statistics. The copy is for inference only.
+
+    Args:
+      model: torch.nn.Module, e.g. convnet_pytorch.ConvNet or
+             mlp_pytorch.MLP, left unchanged
+    Returns:
+      folded: copy of the model without the folded normalization layers
+    """
+    folded = copy.deepcopy(model).eval()
+    _fold_children(folded)
+    if isinstance(folded, nn.Sequential):
+        folded = _fold_sequential(folded)
+    return folded
+
+def _fold_children(module):
+    """
+    Folds the batch normalization in the sequentials below a module, inner
+    ones first.
+    """
+    for name, child in module.named_children():
+        _fold_children(child)
+        if isinstance(child, nn.Sequential):
+            setattr(module, name, _fold_sequential(child))
+
+def _fold_sequential(sequential):
+    """
+    Returns an nn.Sequential with the batch normalization layers of a
+    sequential folded into the layers before them.
+    """
+    layers = []
+    for module in sequential:
+        previous = layers[-1] if layers else None
+        if isinstance(module, nn.BatchNorm2d) and \
+           isinstance(previous, nn.Conv2d):
+            layers[-1] = fuse_conv_bn_eval(previous, module)
+        elif isinstance(module, nn.BatchNorm1d) and \
+             isinstance(previous, nn.Linear):
+            layers[-1] = fuse_linear_bn_eval(previous, module)
+        else:
+            layers.append(module)
+    return nn.Sequential(*layers)
+
+def _prepare(model, channels_last):
+    """
+    Returns the folded copy of a model that is traced, in channels-last for
+    models with a to_channels_last method if channels_last is set.
+    """
+    folded = fold_batchnorm(model)
+    if channels_last:
+        folded.to_channels_last()
+    return folded
+
+@contextlib.contextmanager
+def _torchscript():
+    """
+    Context of the TorchScript calls, without autograd.
+    """
+    # TorchScript is deprecated in recent PyTorch in favour of torch.compile
+    # and torch.export, which need a compiler toolchain, but still provides
+    # standalone frozen graphs and the oneDNN fusions
+    with torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore', FutureWarning)
+        yield
+
+def _trace(model, example):
+    """
+    Traces and freezes a model. The parameters become constants of the
+    graph, so the result does not depend on the Python classes.
+    """
+    with _torchscript():
+        return torch.jit.freeze(torch.jit.trace(model, example))
+
+def _optimize(module):
+    """
+    Lets PyTorch rewrite a frozen module for inference, on the CPU it
+    replaces the convolutions followed by ReLUs with fused oneDNN kernels on
+    weights reordered once. The result can not be saved.
+    """
+    optimize = getattr(torch.jit, 'optimize_for_inference', lambda m: m)
+    with _torchscript():
+        return optimize(module)
+
+def freeze(model, example, channels_last=False, optimize=False):
+    """
+    Folds the batch normalization of a model into its weights, traces and
+    freezes it.
+
+    Args:
+      model: torch.nn.Module, left unchanged
+      example: input batch the model is traced with, the frozen module
+               accepts any batch size
+      channels_last: whether to convert a ConvNet to channels-last
+      optimize: whether to fuse the layers into oneDNN kernels for
+                inference on the CPU
+    Returns:
+      frozen TorchScript module computing the outputs of the model
+    """
+    frozen = _trace(_prepare(model, channels_last), example)
+    if optimize:
+        frozen = _optimize(frozen)
+    return frozen
+
+def export_model(model, example, path, channels_last=False):
+    """
+    Exports a model as a frozen TorchScript artifact with the batch
+    normalization folded in. The artifact is not optimized for oneDNN, which
+    is not serializable, load_model applies it after loading.
+
+    Args:
+      model: torch.nn.Module, left unchanged
+      example: input batch the model is traced with
+      path: file the artifact is saved to
+      channels_last: whether to convert a ConvNet to channels-last
+    Returns:
+      folded: the eager model that was traced, the reference the artifact
+              matches bit for bit
+    """
+    folded = _prepare(model, channels_last)
+    frozen = _trace(folded, example)
+    with _torchscript():
+        torch.jit.save(frozen, path)
+    return folded
+
+def load_model(path, optimize=False, map_location=None):
+    """
+    Loads an artifact saved by export_model, without the training code.
+
+    Args:
+      path: file of the artifact
+      optimize: whether to fuse the layers into oneDNN kernels for
+                inference on the CPU
+      map_location: device the artifact is loaded to
+    Returns:
+      frozen TorchScript module
+    """
+    with _torchscript():
+        module = torch.jit.load(path, map_location=map_location)
+    if optimize:
+        module = _optimize(module)
+    return module
+
+def verify_export(model, folded, artifact, x):
+    """
+    Checks an exported artifact. The artifact runs the same operations as
+    the folded eager model and must match it bit for bit, the folding
+    itself changes the rounding compared to the original model.
+
+    Args:
+      model: original model
+      folded: folded eager model returned by export_model
+      artifact: module loaded by load_model without optimization
+      x: input batch
+    Returns:
+      dictionary with whether the artifact matches the folded model bit for
+      bit and the maximal absolute difference to the original model
+    """
+    model = copy.deepcopy(model).eval()
+    with torch.no_grad():
+        out = artifact(x)
+        return {'bit_exact': torch.equal(out, folded(x)),
+                'max_error': (out - model(x)).abs().max().item()}
+
+def latency(module, x, steps):
+    """
+    Returns the median time of a forward pass in seconds, after two warm up
+    passes.
+    """
+    inference_mode = getattr(torch, 'inference_mode', torch.no_grad)
+    times = []
+    with inference_mode():
+        for step in range(steps + 2):
+            start = time.perf_counter()
+            module(x)
+            times.append(time.perf_counter() - start)
+    return np.median(times[2:])
+
+def create_model():
+    """
+    Creates the model selected by FLAGS and loads the trained weights.
+    """
+    if FLAGS.model == 'convnet':
+        model = ConvNet(IMAGE_SHAPE[0], NR_LABELS)
+    else:
+        model = MLP(int(np.prod(IMAGE_SHAPE)), FLAGS.dnn_hidden_units,
+                    NR_LABELS)
+    if FLAGS.weights:
+        model.load_state_dict(torch.load(FLAGS.weights, map_location='cpu'))
+    return model.eval()
+
+def random_input(batch_size):
+    """
+    Returns a random input batch of the model selected by FLAGS.
+    """
+    x = torch.randn((batch_size,) + IMAGE_SHAPE)
+    if FLAGS.model == 'mlp':
+        x = x.reshape(batch_size, -1)
+    return x
+
+def export():
+    """
+    Exports the model, checks the artifact against the eager model and
+    compares their latencies.
+    """
+    torch.manual_seed(42)
+    model = create_model()
+    x = random_input(max(FLAGS.batch_sizes))
+    folded = export_model(model, x, FLAGS.output, FLAGS.channels_last)
+
+    results = verify_export(model, folded, load_model(FLAGS.output), x)
+    print('artifact ' + FLAGS.output + ' | bit-exact to folded model ' +
+          str(results['bit_exact']) + ' | max error to eager model ' +
+          '{:.2e}'.format(results['max_error']))
+    if not results['bit_exact']:
+        raise RuntimeError('exported artifact differs from the folded model')
+
+    artifact = load_model(FLAGS.output)
+    optimized = load_model(FLAGS.output, optimize=True)
+    print('{:>8}{:>12}{:>12}{:>12}'.format('batch', 'eager', 'frozen',
+                                           'oneDNN'))
+    for batch_size in FLAGS.batch_sizes:
+        x = random_input(batch_size)
+        print('{:>8}{:>10.2f}ms{:>10.2f}ms{:>10.2f}ms'.format(
+            batch_size, *[1e3 * latency(module, x, FLAGS.steps)
+                          for module in [model, artifact, optimized]]))
+
+def print_flags():
+    """
+    Prints all entries in FLAGS variable.
+    """
+    for key, value in vars(FLAGS).items():
+        print(key + ' : ' + str(value))
+
+def main():
+    """
+    Main function
+    """
+    # Print all Flags to confirm parameter settings
+    print_flags()
+
+    export()
+
+if __name__ == '__main__':
+    # Command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default=MODEL_DEFAULT,
+                      choices=['convnet', 'mlp'], help='Model to export')
+    parser.add_argument('--weights', type=str, default='',
+                      help='State dict saved by the trainer with \
+                            --save_model, random weights if empty')
+    parser.add_argument('--output', type=str, default=OUTPUT_DEFAULT,
+                      help='File the artifact is saved to')
+    parser.add_argument('--dnn_hidden_units', type=str,
+                      default=DNN_HIDDEN_UNITS_DEFAULT,
+                      help='Comma separated list of number of units in each \
+                            hidden layer of the MLP')
+    parser.add_argument('--channels_last', action='store_true',
+                      help='Export the ConvNet in the channels-last format')
+    parser.add_argument('--batch_sizes', type=str, default=BATCH_SIZES_DEFAULT,
+                      help='Comma separated list of batch sizes of the \
+                            latency comparison')
+    parser.add_argument('--steps', type=int, default=STEPS_DEFAULT,
+                      help='Number of timed forward passes')
+    FLAGS, unparsed = parser.parse_known_args()
+    FLAGS.batch_sizes = [int(size) for size in FLAGS.batch_sizes.split(',')]
+    FLAGS.dnn_hidden_units = [int(units) for units
+                              in FLAGS.dnn_hidden_units.split(',') if units]
+
+    main()
@@ -38,3 +38,77 @@ def eval_numerical_gradient_array(f, x, df, h=1e-5):
     grad[ix] = np.sum((pos - neg) * df) / (2 * h)
     it.iternext()
   return grad
+
+def eval_numerical_gradient_batched(f, x, df, h=1e-5, chunk_size=256,
+                                    indices=None):
+  """
+  Batched version of eval_numerical_gradient_array for functions that treat
+  the rows of x independently, like the modules of the network. Perturbing
+  an element only changes the output row of its own sample, so the perturbed
+  rows of chunk_size elements are stacked and passed to f in a single call.
+
+  Args:
+    f: function mapping an array of shape (n, ...) to one of shape (n, ...)
+    x: input of shape (batch_size, ...), it is not modified
+    df: gradient with respect to the output f(x)
+    h: step of the central differences
+    chunk_size: number of elements perturbed per call of f
+    indices: optional flat indices of the elements to check, e.g. from
+             random_indices. All elements are checked by default.
+  Returns:
+    grad: numerical gradient, zero for the elements that are not checked
+  """
+  grad = np.zeros_like(x)
+  if indices is None:
+    indices = np.arange(x.size)
+
+  row_size = x[0].size
+  rows = x.reshape(len(x), row_size)
+  df_rows = df.reshape(len(df), -1)
+  for start in range(0, len(indices), chunk_size):
+    idx = indices[start:start + chunk_size]
+    k = len(idx)
+    row, col = np.divmod(idx, row_size)
+
+    # first k rows perturbed by +h, last k rows by -h
+    stacked = rows[np.concatenate([row, row])]
+    stacked[np.arange(k), col] += h
+    stacked[np.arange(k, 2 * k), col] -= h
+
+    out = f(stacked.reshape((2 * k,) + x.shape[1:])).reshape(2 * k, -1)
+    grad.flat[idx] = np.sum((out[:k] - out[k:]) * df_rows[row], axis=1) / (2 * h)
+
+  return grad
+
+def eval_directional_derivative(f, x, df, v, h=1e-5):
+  """
+  Numerical derivative of np.sum(f(x) * df) in the direction v, to compare
+  with np.sum(grad * v) for an analytical gradient grad. Takes two calls of
+  f for any size of x, so it also checks large parameter arrays. x is
+  perturbed in place and restored, so f may read it from elsewhere, e.g.
+  lambda w: layer.forward(inputs) for x = layer.params['weight'].
+
+  Args:
+    f: function of x
+    x: array the derivative is taken with respect to
+    df: gradient with respect to the output f(x)
+    v: direction of the same shape as x
+    h: step of the central differences
+  Returns:
+    numerical directional derivative
+  """
+  oldval = x.copy()
+  x += h * v
+  pos = np.sum(f(x) * df)
+  np.subtract(oldval, h * v, out=x)
+  neg = np.sum(f(x) * df)
+  x[...] = oldval
+
+  return (pos - neg) / (2 * h)
+
+def random_indices(x, n):
+  """
+  Returns the flat indices of n random elements of x, or of all elements if
+  x has fewer.
+  """
+  return np.random.choice(x.size, size=min(n, x.size), replace=False)
@@ -0,0 +1,105 @@
+"""
+This module implements the recording of training metrics. The values are
+stored as plain floats in an array allocated up front, so recording never
+keeps tensors, and with them their autograd graphs, alive and the memory
+used by the history does not grow over a run.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+class MetricsRecorder(object):
+    """
+    Records named scalar metrics at evaluation steps into a preallocated
+    array. Metrics not recorded at a step are NaN.
+    """
+
+    def __init__(self, names, capacity, dtype=np.float64):
+        """
+        Initializes the recorder.
+
+        Args:
+          names: names of the metrics, e.g. ['train_loss', 'test_loss']
+          capacity: maximal number of recorded steps, e.g. the number of
+                    steps of the run divided by the evaluation frequency
+          dtype: floating point type the values are stored in
+        """
+        self.names = list(names)
+        self._columns = {name: j for j, name in enumerate(self.names)}
+        self.steps = np.zeros(capacity, np.int64)
+        self.values = np.full((capacity, len(self.names)), np.nan, dtype)
+        self.count = 0
+
+    @property
+    def capacity(self):
+        return len(self.steps)
+
+    def __len__(self):
+        return self.count
+
+    def record(self, step, **values):
+        """
+        Records the metrics of a step. Tensors and NumPy scalars are
+        converted to floats with item(), which detaches them from the
+        autograd graph and waits for the device.
+
+        Args:
+          step: training step the metrics belong to
+          values: value of every recorded metric
+        """
+        if self.count == self.capacity:
+            raise ValueError('recorder is full after {0} steps'
+                             .format(self.capacity))
+
+        row = self.values[self.count]
+        for name, value in values.items():
+            if hasattr(value, 'item'):
+                value = value.item()
+            row[self._columns[name]] = value
+        self.steps[self.count] = step
+        self.count += 1
+
+    def __getitem__(self, name):
+        """
+        Returns the recorded values of a metric, a view into the array.
+        """
+        return self.values[:self.count, self._columns[name]]
+
+    def last(self, name):
+        """
+        Returns the last recorded value of a metric.
+        """
+        return self[name][-1]
+
+    def save(self, path):
+        """
+        Saves the recorded steps and metrics to an .npz file, with one array
+        per metric.
+
+        Args:
+          path: file the metrics are saved to
+        """
+        arrays = {name: self[name] for name in self.names}
+        np.savez(path, steps=self.steps[:self.count], **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Loads metrics saved by save.
+
+        Args:
+          path: .npz file written by save
+        Returns:
+          recorder: MetricsRecorder holding exactly the saved steps
+        """
+        with np.load(path) as f:
+            names = [name for name in f.files if name != 'steps']
+            recorder = cls(names, len(f['steps']), f[names[0]].dtype
+                           if names else np.float64)
+            recorder.steps[...] = f['steps']
+            for j, name in enumerate(names):
+                recorder.values[:, j] = f[name]
+        recorder.count = recorder.capacity
+        return recorder
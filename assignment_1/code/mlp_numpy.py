@@ -6,6 +6,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import numpy as np
 from modules import *
 
 class MLP(object):
@@ -15,7 +16,8 @@ class MLP(object):
     Once initialized an MLP object can perform forward and backward.
     """
 
-    def __init__(self, n_inputs, n_hidden, n_classes):
+    def __init__(self, n_inputs, n_hidden, n_classes, fused_loss=False,
+                 dtype=np.float64, master_weights=False):
         """
         Initializes MLP object.
 
@@ -28,6 +30,14 @@ class MLP(object):
           n_classes: number of classes of the classification problem.
                      This number is required in order to specify the
                      output dimensions of the MLP
+          fused_loss: if True, the final SoftMaxModule is left out and the
+                      network outputs logits, to be used together with the
+                      SoftmaxCrossEntropyModule.
+          dtype: floating point type of the parameters, activations and
+                 gradients, e.g. np.float32 to halve the memory traffic.
+          master_weights: if True, the optimizers apply the updates to a
+                          float64 copy of the parameters, which is then cast
+                          to dtype.
 
         TODO:
         Implement initialization of the network.
@@ -42,28 +52,55 @@ class MLP(object):
 
             # if there is no hidden layer
             if len(n_hidden) == 0:
-                self.layers.append(LinearModule(n_inputs, n_classes))
+                self.layers.append(LinearModule(n_inputs, n_classes, dtype))
                 self.layers.append(SoftMaxModule())
 
             # first layer with input size
             elif i == 0:
-                self.layers.append(LinearModule(n_inputs, n_hidden[i]))
+                self.layers.append(LinearModule(n_inputs, n_hidden[i], dtype))
                 self.layers.append(ReLUModule())
 
             # last layer with classes size and softmax
             elif i == len(n_hidden):
-                self.layers.append(LinearModule(n_hidden[i - 1], n_classes))
+                self.layers.append(LinearModule(n_hidden[i - 1], n_classes,
+                                                dtype))
                 self.layers.append(SoftMaxModule())
 
             # other layers
             else:
-                self.layers.append(LinearModule(n_hidden[i - 1], n_hidden[i]))
+                self.layers.append(LinearModule(n_hidden[i - 1], n_hidden[i],
+                                                dtype))
                 self.layers.append(ReLUModule())
 
+        if fused_loss:
+            self.layers.pop()
+
+        self._init_state(dtype, master_weights)
+
         ########################
         # END OF YOUR CODE    #
         #######################
 
+    def _init_state(self, dtype, master_weights):
+        """
+        Sets up the state of a network whose layers are built, which
+        subclasses with other layers share.
+
+        Args:
+          dtype: floating point type of the layers
+          master_weights: whether to keep float64 master weights
+        """
+        self.dtype = dtype
+        self.workspace = None
+        self.training = True
+        self._scratch = None
+
+        # all parameters and gradients live in one contiguous vector each
+        self.flatten_parameters()
+        self.master_params = None
+        if master_weights:
+            self.master_params = self.params.astype(np.float64)
+
     def forward(self, x):
         """
         Performs forward pass of the input. Here an input tensor x is
@@ -82,8 +119,12 @@ class MLP(object):
         # PUT YOUR CODE HERE  #
         #######################
         out = x
-        for layer in self.layers:
-            out = layer.forward(out)
+        if self.training:
+            buffers = self._buffers('activations', x.shape[0])
+        else:
+            buffers = self._inference_buffers(x.shape[0])
+        for layer, buffer in zip(self.layers, buffers):
+            out = layer.forward(out, out=buffer)
         ########################
         # END OF YOUR CODE    #
         #######################
@@ -104,10 +145,191 @@ class MLP(object):
         ########################
         # PUT YOUR CODE HERE  #
         #######################
-        for layer in reversed(self.layers):
-            dout = layer.backward(dout)
+        assert self.training, "backward needs a forward pass in training mode"
+        buffers = self._buffers('gradients', dout.shape[0])
+        for layer, buffer in zip(reversed(self.layers), reversed(buffers[:-1])):
+            dout = layer.backward(dout, out=buffer)
         ########################
         # END OF YOUR CODE    #
         #######################
 
         return
+
+    def train(self, mode=True):
+        """
+        Sets the network to training mode, or to inference mode if mode is
+        False. In inference mode the layers cache nothing for the backward
+        pass, the activation functions run in place and the linear layers
+        write into two scratch buffers in turn, so a forward pass needs no
+        new arrays once the buffers are large enough. The output of such a
+        pass is overwritten by the next one.
+
+        Args:
+          mode: whether to use training mode
+        Returns:
+          self
+        """
+        self.training = mode
+        for layer in self.layers:
+            layer.training = mode
+            if not mode:
+                layer.__dict__.pop('_x', None)
+                layer.__dict__.pop('_out', None)
+                layer.__dict__.pop('_cache', None)
+
+        return self
+
+    def eval(self):
+        """
+        Sets the network to inference mode, see train.
+        """
+        return self.train(False)
+
+    def allocate_workspace(self, batch_size):
+        """
+        Preallocates the activation and gradient buffers of all layers for
+        batches of batch_size samples. Forward and backward passes over such
+        batches then write into these buffers instead of allocating new
+        arrays, so the returned outputs are overwritten by the next pass.
+        Batches of any other size still use freshly allocated arrays.
+
+        Args:
+          batch_size: number of samples in a training batch
+
+        The buffers are stored in self.workspace:
+          'activations': output buffer of every layer
+          'gradients': buffer for the gradient with respect to the input of
+                       every layer, followed by one for the network output
+                       that can be passed to the backward of the loss
+        """
+        widths = [self.layers[0].params['weight'].shape[1]]
+        for layer in self.layers:
+            if isinstance(layer, LinearModule):
+                widths.append(layer.params['weight'].shape[0])
+            else:
+                widths.append(widths[-1])
+
+        self.workspace = {
+            'batch_size': batch_size,
+            'activations': [np.empty((batch_size, width), self.dtype)
+                            for width in widths[1:]],
+            'gradients': [np.empty((batch_size, width), self.dtype)
+                          for width in widths]}
+
+    def flatten_parameters(self, params=None, grads=None, copy=True):
+        """
+        Moves the parameters and gradients of all layers that have any into
+        one contiguous vector each. The params and grads dictionaries of the
+        layers then hold views into these vectors, which are also stored in
+        self.params and self.grads. This is done on initialization, call it
+        again to move the parameters, e.g. into shared memory.
+
+        Args:
+          params: optional vector to store the parameters in, e.g. one that
+                  lives in shared memory. The current values are copied.
+          grads: optional vector to store the gradients in
+          copy: if False, the given params already hold the values of the
+                parameters and are not written to.
+        Returns:
+          params: vector holding all parameters
+          grads: vector holding all gradients
+        """
+        size = sum(param.size for layer in self.layers
+                   if hasattr(layer, 'params')
+                   for param in layer.params.values())
+        if params is None:
+            params = np.empty(size, self.dtype)
+        if grads is None:
+            grads = np.zeros(size, self.dtype)
+        assert params.shape == grads.shape == (size,)
+
+        offset = 0
+        for layer in self.layers:
+            if not hasattr(layer, 'params'):
+                continue
+            for name in layer.params:
+                shape = layer.params[name].shape
+                end = offset + layer.params[name].size
+                if copy:
+                    params[offset:end] = layer.params[name].ravel()
+                    grads[offset:end] = layer.grads[name].ravel()
+                layer.params[name] = params[offset:end].reshape(shape)
+                layer.grads[name] = grads[offset:end].reshape(shape)
+                offset = end
+
+        self.params, self.grads = params, grads
+        return params, grads
+
+    def grad_norm(self):
+        """
+        Returns the L2 norm of the gradients of all parameters.
+        """
+        return np.sqrt(np.dot(self.grads, self.grads))
+
+    def clip_grad_norm(self, max_norm):
+        """
+        Scales the gradients of all parameters in place, such that their L2
+        norm is at most max_norm.
+
+        Args:
+          max_norm: maximal norm of the gradients
+        Returns:
+          norm: norm of the gradients before clipping
+        """
+        norm = self.grad_norm()
+        if norm > max_norm:
+            self.grads *= max_norm / norm
+
+        return norm
+
+    def save(self, path):
+        """
+        Writes all parameters to path as a single .npy array.
+        """
+        np.save(path, self.params)
+
+    def load(self, path):
+        """
+        Reads the parameters written by save into the parameter vector.
+        """
+        params = np.load(path, mmap_mode='r')
+        assert params.shape == self.params.shape, (
+            "params.shape: {0}, expected: {1}".format(str(params.shape),
+                                                      str(self.params.shape)))
+        np.copyto(self.params, params, casting='same_kind')
+        if self.master_params is not None:
+            np.copyto(self.master_params, params)
+
+    def _inference_buffers(self, batch_size):
+        """
+        Returns the output buffers of all layers for an inference pass over
+        batch_size samples. Every linear layer writes into the scratch
+        buffer its input is not in, activation functions into their input.
+        """
+        widths = [layer.params['weight'].shape[0] for layer in self.layers
+                  if isinstance(layer, LinearModule)]
+        size = batch_size * max(widths)
+        if self._scratch is None or self._scratch.shape[1] < size:
+            self._scratch = np.empty((2, size), self.dtype)
+
+        buffers, k = [], 0
+        for layer in self.layers:
+            if isinstance(layer, LinearModule):
+                width = layer.params['weight'].shape[0]
+                buffer = self._scratch[k % 2, :batch_size * width]\
+                             .reshape(batch_size, width)
+                k += 1
+            buffers.append(buffer)
+
+        return buffers
+
+    def _buffers(self, kind, batch_size):
+        """
+        Returns the workspace buffers of the given kind, or a list of None
+        if there is no workspace for batches of batch_size samples.
+        """
+        if self.workspace is not None and \
+           self.workspace['batch_size'] == batch_size:
+            return self.workspace[kind]
+
+        return [None] * (len(self.layers) + 1)
@@ -3,18 +3,23 @@ This module implements various modules of the network.
 You should fill in code into indicated sections.
 """
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
 class LinearModule(object):
     """
     Linear module. Applies a linear transformation to the input data.
     """
-    def __init__(self, in_features, out_features):
+    # the input is only cached for the backward pass in training mode
+    training = True
+
+    def __init__(self, in_features, out_features, dtype=np.float64):
         """
         Initializes the parameters of the module.
 
         Args:
           in_features: size of each input sample
           out_features: size of each output sample
+          dtype: floating point type of the parameters and gradients
 
         TODO:
         Initialize weights self.params['weight'] using normal distribution with
@@ -27,20 +32,22 @@ class LinearModule(object):
         # PUT YOUR CODE HERE  #
         #######################
         self.params = {'weight': np.random.normal(0, 0.0001, \
-                                                  (out_features, in_features)),
-                       'bias': np.zeros((out_features, 1))}
-        self.grads = {'weight': np.zeros((out_features, in_features)),
-                      'bias': np.zeros((out_features, 1))}
+                                                  (out_features, in_features))\
+                                   .astype(dtype, copy=False),
+                       'bias': np.zeros((out_features, 1), dtype)}
+        self.grads = {'weight': np.zeros((out_features, in_features), dtype),
+                      'bias': np.zeros((out_features, 1), dtype)}
         ########################
         # END OF YOUR CODE    #
         #######################
 
-    def forward(self, x):
+    def forward(self, x, out=None):
         """
         Forward pass.
 
         Args:
           x: input to the module
+          out: optional preallocated array the output is written into
         Returns:
           out: output of the module
 
@@ -54,20 +61,23 @@ class LinearModule(object):
         ########################
         # PUT YOUR CODE HERE  #
         #######################
-        self._x = x
-        out = x @ self.params['weight'].T + self.params['bias'].T
+        if self.training:
+            self._x = x
+        out = np.matmul(x, self.params['weight'].T, out=out)
+        out += self.params['bias'].T
         ########################
         # END OF YOUR CODE    #
         #######################
 
         return out
 
-    def backward(self, dout):
+    def backward(self, dout, out=None):
         """
         Backward pass.
 
         Args:
           dout: gradients of the previous module
+          out: optional preallocated array the gradients are written into
         Returns:
           dx: gradients with respect to the input of the module
 
@@ -80,9 +90,11 @@ class LinearModule(object):
         ########################
         # PUT YOUR CODE HERE  #
         #######################
-        self.grads['weight'] = dout.T @ self._x
-        self.grads['bias'] = dout.T @ np.ones((dout.shape[0], 1))
-        dx = dout @ self.params['weight']
+
+        # gradients are written in place, so self.grads keeps its arrays
+        np.matmul(dout.T, self._x, out=self.grads['weight'])
+        np.sum(dout.T, axis=1, keepdims=True, out=self.grads['bias'])
+        dx = np.matmul(dout, self.params['weight'], out=out)
         ########################
         # END OF YOUR CODE    #
         #######################
@@ -93,12 +105,15 @@ class ReLUModule(object):
     """
     ReLU activation module.
     """
-    def forward(self, x):
+    training = True
+
+    def forward(self, x, out=None):
         """
         Forward pass.
 
         Args:
           x: input to the module
+          out: optional preallocated array the output is written into
         Returns:
           out: output of the module
 
@@ -112,19 +127,22 @@ class ReLUModule(object):
         ########################
         # PUT YOUR CODE HERE  #
         #######################
-        self._out = np.maximum(0, x)
+        out = np.maximum(x, 0, out=out)
+        if self.training:
+            self._out = out
         ########################
         # END OF YOUR CODE    #
         #######################
 
-        return self._out
+        return out
 
-    def backward(self, dout):
+    def backward(self, dout, out=None):
         """
         Backward pass.
 
         Args:
           dout: gradients of the previous modul
+          out: optional preallocated array the gradients are written into
         Returns:
           dx: gradients with respect to the input of the module
 
@@ -135,7 +153,11 @@ class ReLUModule(object):
         ########################
         # PUT YOUR CODE HERE  #
         #######################
-        dx = dout * (self._out > 0)
+        if out is None:
+            dx = dout * (self._out > 0)
+        else:
+            dx = np.greater(self._out, 0, out=out)
+            np.multiply(dx, dout, out=dx)
         ########################
         # END OF YOUR CODE    #
         #######################
@@ -146,11 +168,14 @@ class SoftMaxModule(object):
     """
     Softmax activation module.
     """
-    def forward(self, x):
+    training = True
+
+    def forward(self, x, out=None):
         """
         Forward pass.
         Args:
           x: input to the module
+          out: optional preallocated array the output is written into
         Returns:
           out: output of the module
 
@@ -167,22 +192,27 @@ class SoftMaxModule(object):
         # PUT YOUR CODE HERE  #
         #######################
         sz = x.shape[0]
-        max_x = np.reshape(x.max(axis=1), (sz, 1))
-
-        num = np.exp(x - max_x)
-        self._out = num / np.reshape(np.sum(num, axis=1), (sz, 1))
+        self._rows = _reuse(getattr(self, '_rows', None), (sz, 1), x.dtype)
+        max_x = np.max(x, axis=1, keepdims=True, out=self._rows)
+
+        out = np.subtract(x, max_x, out=out)
+        np.exp(out, out=out)
+        out /= np.sum(out, axis=1, keepdims=True, out=self._rows)
+        if self.training:
+            self._out = out
         ########################
         # END OF YOUR CODE    #
         #######################
 
-        return self._out
+        return out
 
-    def backward(self, dout):
+    def backward(self, dout, out=None):
         """
         Backward pass.
 
         Args:
           dout: gradients of the previous module
+          out: optional preallocated array the gradients are written into
         Returns:
           dx: gradients with respect to the input of the module
 
@@ -193,11 +223,11 @@ class SoftMaxModule(object):
         ########################
         # PUT YOUR CODE HERE  #
         #######################
-        diagonal = [np.diag(x) for x in self._out]
-
-        derivative = diagonal - np.einsum('ij, ik -> ijk', self._out, self._out)
-
-        dx = np.einsum('ij, ijk -> ik', dout, derivative)
+        # the Jacobian diag(p) - p p^T is never formed explicitly
+        dx = np.multiply(dout, self._out, out=out)
+        dot = np.sum(dx, axis=1, keepdims=True, out=self._rows)
+        np.subtract(dout, dot, out=dx)
+        dx *= self._out
         ########################
         # END OF YOUR CODE    #
         #######################
@@ -206,7 +236,8 @@ class SoftMaxModule(object):
 
 class CrossEntropyModule(object):
     """
-    Cross entropy loss module.
+    Cross entropy loss module. The labels are either one-hot encoded or
+    class indices of shape (batch_size,).
     """
     def forward(self, x, y):
         """
@@ -214,7 +245,7 @@ class CrossEntropyModule(object):
 
         Args:
           x: input to the module
-          y: labels of the input
+          y: labels of the input, one-hot or class indices
         Returns:
           out: cross entropy loss
 
@@ -227,20 +258,24 @@ class CrossEntropyModule(object):
         #######################
 
         # normalize?
-        out = - np.sum(y * np.log(x + 1e-5)) / len(y)
+        if y.ndim == 1:
+            out = - np.sum(np.log(x[_label_index(y)] + 1e-5)) / len(y)
+        else:
+            out = - np.sum(y * np.log(x + 1e-5)) / len(y)
         ########################
         # END OF YOUR CODE    #
         #######################
 
         return out
 
-    def backward(self, x, y):
+    def backward(self, x, y, out=None):
         """
         Backward pass.
 
         Args:
           x: input to the module
-          y: labels of the input
+          y: labels of the input, one-hot or class indices
+          out: optional preallocated array the gradient is written into
         Returns:
           dx: gradient of the loss with the respect to the input x.
 
@@ -253,9 +288,414 @@ class CrossEntropyModule(object):
         #######################
 
         # normalize?
-        dx = - y / (len(y) * (x + 1e-5))
+        if y.ndim == 1:
+            # only the entries of the labeled classes are nonzero
+            index = _label_index(y)
+            dx = np.zeros_like(x) if out is None else out
+            dx.fill(0)
+            dx[index] = -1 / (len(y) * (x[index] + 1e-5))
+        else:
+            dx = np.add(x, 1e-5, out=out)
+            dx *= - len(y)
+            np.divide(y, dx, out=dx)
         ########################
         # END OF YOUR CODE    #
         #######################
 
         return dx
+
+class SoftmaxCrossEntropyModule(object):
+    """
+    Softmax activation fused with the cross entropy loss. Operates on the
+    logits of the network, so the model should not end with a SoftMaxModule.
+    The labels are either one-hot encoded or class indices.
+    """
+    def forward(self, x, y):
+        """
+        Forward pass.
+
+        Args:
+          x: logits, input to the softmax
+          y: labels of the input, one-hot or class indices
+        Returns:
+          out: cross entropy loss of softmax(x)
+        """
+        if y.ndim == 1:
+            out = - np.sum(_log_softmax(x)[_label_index(y)]) / len(y)
+        else:
+            out = - np.sum(y * _log_softmax(x)) / len(y)
+
+        return out
+
+    def backward(self, x, y, out=None):
+        """
+        Backward pass.
+
+        Args:
+          x: logits, input to the softmax
+          y: labels of the input, one-hot or class indices
+          out: optional preallocated array the gradient is written into
+        Returns:
+          dx: gradient of the loss with the respect to the logits x.
+        """
+        self._rows = _reuse(getattr(self, '_rows', None), (len(x), 1), x.dtype)
+        max_x = np.max(x, axis=1, keepdims=True, out=self._rows)
+
+        dx = np.subtract(x, max_x, out=out)
+        np.exp(dx, out=dx)
+        dx /= np.sum(dx, axis=1, keepdims=True, out=self._rows)
+        if y.ndim == 1:
+            dx[_label_index(y)] -= 1
+        else:
+            dx -= y
+        dx /= len(y)
+
+        return dx
+
+class Conv2dModule(object):
+    """
+    2D convolution module for inputs of shape (batch_size, channels, height,
+    width). The input windows are gathered with stride tricks (im2col), so
+    the convolution is a single matrix product.
+    """
+    training = True
+
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1,
+                 padding=0, dtype=np.float64):
+        """
+        Initializes the parameters of the module. The weights are drawn from
+        a normal distribution with He scaling, the biases are 0.
+
+        Args:
+          in_channels: number of channels of the input
+          out_channels: number of channels of the output
+          kernel_size: height and width of the square kernels
+          stride: step between the windows
+          padding: number of zeros added to every side of the input
+          dtype: floating point type of the parameters and gradients
+        """
+        self.stride = stride
+        self.padding = padding
+        shape = (out_channels, in_channels, kernel_size, kernel_size)
+        std = np.sqrt(2. / (in_channels * kernel_size ** 2))
+        self.params = {'weight': np.random.normal(0, std, shape)\
+                                   .astype(dtype, copy=False),
+                       'bias': np.zeros(out_channels, dtype)}
+        self.grads = {'weight': np.zeros(shape, dtype),
+                      'bias': np.zeros(out_channels, dtype)}
+
+    def forward(self, x, out=None):
+        """
+        Forward pass.
+
+        Args:
+          x: input to the module
+          out: optional preallocated array the output is written into
+        Returns:
+          out: output of the module
+        """
+        n_out, _, k, _ = self.params['weight'].shape
+        n = x.shape[0]
+
+        # (n * out_height * out_width, in_channels * k * k)
+        windows = _windows(_pad(x, self.padding, 0), k, self.stride)
+        height, width = windows.shape[2:4]
+        cols = windows.transpose(0, 2, 3, 1, 4, 5).reshape(n * height * width,
+                                                           -1)
+        if self.training:
+            self._cache = (cols, x.shape)
+
+        result = np.matmul(cols, self.params['weight'].reshape(n_out, -1).T)
+        result += self.params['bias']
+        result = result.reshape(n, height, width, n_out).transpose(0, 3, 1, 2)
+
+        return _into(result, out)
+
+    def backward(self, dout, out=None):
+        """
+        Backward pass.
+
+        Args:
+          dout: gradients of the previous module
+          out: optional preallocated array the gradients are written into
+        Returns:
+          dx: gradients with respect to the input of the module
+        """
+        cols, x_shape = self._cache
+        n_out, n_in, k, _ = self.params['weight'].shape
+        n, _, height, width = dout.shape
+        s, p = self.stride, self.padding
+
+        dout_cols = dout.transpose(0, 2, 3, 1).reshape(-1, n_out)
+        np.matmul(dout_cols.T, cols,
+                  out=self.grads['weight'].reshape(n_out, -1))
+        np.sum(dout_cols, axis=0, out=self.grads['bias'])
+
+        # col2im, the loop only runs over the offsets within the kernel
+        dcols = np.matmul(dout_cols, self.params['weight'].reshape(n_out, -1))
+        dcols = dcols.reshape(n, height, width, n_in, k, k)\
+                     .transpose(0, 3, 1, 2, 4, 5)
+        dx = np.zeros((n, n_in, x_shape[2] + 2 * p, x_shape[3] + 2 * p),
+                      dout.dtype)
+        for i in range(k):
+            for j in range(k):
+                dx[:, :, i:i + s * height:s, j:j + s * width:s] += \
+                    dcols[..., i, j]
+
+        return _into(dx[:, :, p:p + x_shape[2], p:p + x_shape[3]], out)
+
+class MaxPool2dModule(object):
+    """
+    2D max pooling module for inputs of shape (batch_size, channels, height,
+    width).
+    """
+    training = True
+
+    def __init__(self, kernel_size, stride=None, padding=0):
+        """
+        Initializes the module.
+
+        Args:
+          kernel_size: height and width of the square windows
+          stride: step between the windows, kernel_size by default
+          padding: number of -inf added to every side of the input
+        """
+        self.kernel_size = kernel_size
+        self.stride = stride or kernel_size
+        self.padding = padding
+
+    def forward(self, x, out=None):
+        """
+        Forward pass.
+
+        Args:
+          x: input to the module
+          out: optional preallocated array the output is written into
+        Returns:
+          out: output of the module
+        """
+        k, s = self.kernel_size, self.stride
+        x_pad = _pad(x, self.padding, -np.inf)
+        height = (x_pad.shape[2] - k) // s + 1
+        width = (x_pad.shape[3] - k) // s + 1
+
+        # a running maximum over the offsets within the window, which are
+        # few compared to the windows
+        out = _into(x_pad[:, :, :s * height:s, :s * width:s], out)
+        for i in range(k):
+            for j in range(k):
+                np.maximum(out, x_pad[:, :, i:i + s * height:s,
+                                      j:j + s * width:s], out=out)
+
+        if self.training:
+            self._cache = (x_pad, out, x.shape)
+
+        return out
+
+    def backward(self, dout, out=None):
+        """
+        Backward pass.
+
+        Args:
+          dout: gradients of the previous module
+          out: optional preallocated array the gradients are written into
+        Returns:
+          dx: gradients with respect to the input of the module
+        """
+        x_pad, pooled, x_shape = self._cache
+        k, s, p = self.kernel_size, self.stride, self.padding
+        height, width = dout.shape[2:]
+
+        # the first maximum of every window receives the gradient, as in
+        # PyTorch
+        dx = np.zeros(x_pad.shape, dout.dtype)
+        open_windows = np.ones(dout.shape, bool)
+        hit = np.empty(dout.shape, bool)
+        for i in range(k):
+            for j in range(k):
+                window = (slice(None), slice(None),
+                          slice(i, i + s * height, s), slice(j, j + s * width, s))
+                np.equal(x_pad[window], pooled, out=hit)
+                hit &= open_windows
+                open_windows ^= hit
+                dx[window] += dout * hit
+
+        return _into(dx[:, :, p:p + x_shape[2], p:p + x_shape[3]], out)
+
+class BatchNorm2dModule(object):
+    """
+    Batch normalization module for inputs of shape (batch_size, channels,
+    height, width). Normalizes with the statistics of the batch in training
+    mode and with running averages of them in inference mode.
+    """
+    training = True
+
+    def __init__(self, num_features, eps=1e-5, momentum=0.1,
+                 dtype=np.float64):
+        """
+        Initializes the parameters of the module, the scales with 1 and the
+        shifts with 0.
+
+        Args:
+          num_features: number of channels of the input
+          eps: term added to the variance for numerical stability
+          momentum: weight of the batch statistics in the running averages
+          dtype: floating point type of the parameters and gradients
+        """
+        self.eps = eps
+        self.momentum = momentum
+        self.params = {'weight': np.ones(num_features, dtype),
+                       'bias': np.zeros(num_features, dtype)}
+        self.grads = {'weight': np.zeros(num_features, dtype),
+                      'bias': np.zeros(num_features, dtype)}
+        self.running_mean = np.zeros(num_features, dtype)
+        self.running_var = np.ones(num_features, dtype)
+
+    def forward(self, x, out=None):
+        """
+        Forward pass.
+
+        Args:
+          x: input to the module
+          out: optional preallocated array the output is written into
+        Returns:
+          out: output of the module
+        """
+        shape = (1, -1, 1, 1)
+        if self.training:
+            mean = np.mean(x, axis=(0, 2, 3))
+            var = np.var(x, axis=(0, 2, 3))
+
+            # the running variance is unbiased, as in PyTorch
+            m = x.size // x.shape[1]
+            self.running_mean *= 1 - self.momentum
+            self.running_mean += self.momentum * mean
+            self.running_var *= 1 - self.momentum
+            self.running_var += self.momentum * var * m / max(m - 1, 1)
+        else:
+            mean, var = self.running_mean, self.running_var
+
+        inv_std = 1 / np.sqrt(var + self.eps)
+        x_hat = np.subtract(x, mean.reshape(shape), out=out)
+        x_hat *= inv_std.reshape(shape)
+        if self.training:
+            self._cache = (x_hat.copy(), inv_std)
+
+        x_hat *= self.params['weight'].reshape(shape)
+        x_hat += self.params['bias'].reshape(shape)
+
+        return x_hat
+
+    def backward(self, dout, out=None):
+        """
+        Backward pass.
+
+        Args:
+          dout: gradients of the previous module
+          out: optional preallocated array the gradients are written into
+        Returns:
+          dx: gradients with respect to the input of the module
+        """
+        x_hat, inv_std = self._cache
+        shape = (1, -1, 1, 1)
+        m = dout.size // dout.shape[1]
+
+        np.sum(dout * x_hat, axis=(0, 2, 3), out=self.grads['weight'])
+        np.sum(dout, axis=(0, 2, 3), out=self.grads['bias'])
+
+        # dx = gamma / std * (dout - mean(dout) - x_hat * mean(dout * x_hat))
+        dx = np.multiply(x_hat, (self.grads['weight'] / m).reshape(shape),
+                         out=out)
+        dx += (self.grads['bias'] / m).reshape(shape)
+        np.subtract(dout, dx, out=dx)
+        dx *= (self.params['weight'] * inv_std).reshape(shape)
+
+        return dx
+
+class FlattenModule(object):
+    """
+    Flattens all dimensions but the first, e.g. to pass the output of a
+    convolution to a LinearModule.
+    """
+    training = True
+
+    def forward(self, x, out=None):
+        """
+        Forward pass.
+
+        Args:
+          x: input to the module
+          out: optional preallocated array the output is written into
+        Returns:
+          out: output of the module
+        """
+        self._cache = x.shape
+
+        return _into(x.reshape(x.shape[0], -1), out)
+
+    def backward(self, dout, out=None):
+        """
+        Backward pass.
+
+        Args:
+          dout: gradients of the previous module
+          out: optional preallocated array the gradients are written into
+        Returns:
+          dx: gradients with respect to the input of the module
+        """
+        return _into(dout.reshape(self._cache), out)
+
+def _log_softmax(x):
+    """
+    Computes the row-wise log of the softmax with the log-sum-exp trick.
+    """
+    shifted = x - x.max(axis=1, keepdims=True)
+
+    return shifted - np.log(np.sum(np.exp(shifted), axis=1, keepdims=True))
+
+def _label_index(y):
+    """
+    Returns the index of the entries of the labeled classes in a batch of
+    outputs, for labels given as class indices.
+    """
+    return np.arange(len(y)), y
+
+def _reuse(buffer, shape, dtype):
+    """
+    Returns buffer if it has the requested shape and dtype, a new array
+    otherwise. Lets modules keep small scratch arrays between calls.
+    """
+    if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+        buffer = np.empty(shape, dtype=dtype)
+
+    return buffer
+
+def _pad(x, padding, value):
+    """
+    Pads the last two dimensions of x on every side with value.
+    """
+    if padding == 0:
+        return x
+
+    width = ((0, 0),) * (x.ndim - 2) + ((padding, padding),) * 2
+    return np.pad(x, width, constant_values=value)
+
+def _windows(x, kernel_size, stride):
+    """
+    Returns a view of shape (batch_size, channels, out_height, out_width,
+    kernel_size, kernel_size) of all windows of x.
+    """
+    windows = sliding_window_view(x, (kernel_size, kernel_size), axis=(2, 3))
+
+    return windows[:, :, ::stride, ::stride]
+
+def _into(result, out):
+    """
+    Copies result into out if an output array is given, returns it as a
+    contiguous array otherwise.
+    """
+    if out is None:
+        return np.ascontiguousarray(result)
+
+    np.copyto(out, result)
+    return out
@@ -0,0 +1,198 @@
+"""
+This module implements optimizers for the NumPy MLP. They work on the flat
+parameter and gradient vectors of the network, so every update is a handful
+of in-place vector operations over all parameters instead of a Python loop
+over the layers.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+class SGD(object):
+    """
+    Stochastic gradient descent.
+    """
+
+    # attributes saved by state_dict
+    _state_names = []
+
+    def __init__(self, network, learning_rate):
+        """
+        Initializes the optimizer.
+
+        Args:
+          network: MLP whose parameters are optimized
+          learning_rate: step size of the updates
+        """
+        self.network = network
+        self.learning_rate = learning_rate
+        self._update = np.empty_like(_target(network))
+
+    def step(self):
+        """
+        Updates the parameters of the network in place using its gradients.
+        With master weights the update is applied to the float64 copies,
+        which are then cast back to the parameters.
+        """
+        target = _target(self.network)
+        self._compute_update(self.network.grads, self._update)
+        target -= self._update
+
+        if target is not self.network.params:
+            np.copyto(self.network.params, target, casting='same_kind')
+
+    def _compute_update(self, grads, update):
+        """
+        Writes the update that is subtracted from the parameters into update.
+        """
+        np.multiply(grads, self.learning_rate, out=update)
+
+    def _state(self):
+        """
+        Returns a new zero-initialized state vector.
+        """
+        return np.zeros_like(_target(self.network))
+
+    def state_dict(self):
+        """
+        Returns the state of the optimizer, copies of its running averages
+        and its step counter, to continue the optimization later.
+        """
+        return {name: np.copy(getattr(self, name))
+                for name in self._state_names}
+
+    def load_state_dict(self, state):
+        """
+        Restores a state returned by state_dict. The state vectors are
+        copied into the existing ones.
+
+        Args:
+          state: dictionary of the state of an optimizer of the same type
+        """
+        for name in self._state_names:
+            value = getattr(self, name)
+            if isinstance(value, np.ndarray):
+                np.copyto(value, state[name])
+            else:
+                setattr(self, name, type(value)(state[name]))
+
+class Momentum(SGD):
+    """
+    Stochastic gradient descent with momentum.
+    """
+
+    _state_names = ['_velocity']
+
+    def __init__(self, network, learning_rate, momentum=0.9):
+        """
+        Initializes the optimizer.
+
+        Args:
+          network: MLP whose parameters are optimized
+          learning_rate: step size of the updates
+          momentum: decay of the velocity
+        """
+        super(Momentum, self).__init__(network, learning_rate)
+        self.momentum = momentum
+        self._velocity = self._state()
+
+    def _compute_update(self, grads, update):
+        self._velocity *= self.momentum
+        self._velocity += grads
+        np.multiply(self._velocity, self.learning_rate, out=update)
+
+class RMSprop(SGD):
+    """
+    RMSprop, scales the gradients by a running average of their magnitude.
+    """
+
+    _state_names = ['_square_avg']
+
+    def __init__(self, network, learning_rate, decay=0.99, eps=1e-8):
+        """
+        Initializes the optimizer.
+
+        Args:
+          network: MLP whose parameters are optimized
+          learning_rate: step size of the updates
+          decay: decay of the running average of the squared gradients
+          eps: term added to the denominator for numerical stability
+        """
+        super(RMSprop, self).__init__(network, learning_rate)
+        self.decay = decay
+        self.eps = eps
+        self._square_avg = self._state()
+
+    def _compute_update(self, grads, update):
+        np.multiply(grads, grads, out=update)
+        update *= 1 - self.decay
+        self._square_avg *= self.decay
+        self._square_avg += update
+
+        np.sqrt(self._square_avg, out=update)
+        update += self.eps
+        np.divide(grads, update, out=update)
+        update *= self.learning_rate
+
+class Adam(SGD):
+    """
+    Adam, uses bias-corrected running averages of the gradients and of
+    their squares.
+    """
+
+    _state_names = ['t', '_exp_avg', '_exp_avg_sq']
+
+    def __init__(self, network, learning_rate, beta1=0.9, beta2=0.999,
+                 eps=1e-8):
+        """
+        Initializes the optimizer.
+
+        Args:
+          network: MLP whose parameters are optimized
+          learning_rate: step size of the updates
+          beta1: decay of the running average of the gradients
+          beta2: decay of the running average of the squared gradients
+          eps: term added to the denominator for numerical stability
+        """
+        super(Adam, self).__init__(network, learning_rate)
+        self.beta1 = beta1
+        self.beta2 = beta2
+        self.eps = eps
+        self.t = 0
+        self._exp_avg = self._state()
+        self._exp_avg_sq = self._state()
+
+    def _compute_update(self, grads, update):
+        self.t += 1
+        correction1 = 1 - self.beta1 ** self.t
+        correction2 = 1 - self.beta2 ** self.t
+
+        np.multiply(grads, 1 - self.beta1, out=update)
+        self._exp_avg *= self.beta1
+        self._exp_avg += update
+
+        np.multiply(grads, grads, out=update)
+        update *= 1 - self.beta2
+        self._exp_avg_sq *= self.beta2
+        self._exp_avg_sq += update
+
+        np.sqrt(self._exp_avg_sq, out=update)
+        update /= np.sqrt(correction2)
+        update += self.eps
+        np.divide(self._exp_avg, update, out=update)
+        update *= self.learning_rate / correction1
+
+def _target(network):
+    """
+    Returns the vector updates are applied to, the master weights of the
+    network if it has any and its parameters otherwise.
+    """
+    if network.master_params is not None:
+        return network.master_params
+
+    return network.params
+
+OPTIMIZERS = {'sgd': SGD, 'momentum': Momentum, 'rmsprop': RMSprop,
+              'adam': Adam}
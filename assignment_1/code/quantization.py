@@ -0,0 +1,304 @@
+"""
+This module implements post-training static int8 quantization of the
+PyTorch ConvNet and MLP for inference on the CPU. The convolutions and
+linear layers are fused with their batch normalization and ReLUs, the
+ranges of the activations are calibrated on a split of the training set
+and the layers are converted to int8 kernels. The accuracy and latency of
+the quantized model are compared with the float model on the test set.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import contextlib
+import copy
+import io
+import os
+import warnings
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.ao.quantization as quantization
+from convnet_pytorch import ConvNet
+from mlp_pytorch import MLP
+from evaluation import chunks, evaluate_torch
+from export import latency
+import cifar10_utils
+
+# Default constants
+MODEL_DEFAULT = 'convnet'
+DNN_HIDDEN_UNITS_DEFAULT = '100'
+BACKEND_DEFAULT = 'x86'
+CALIBRATION_SIZE_DEFAULT = 1000
+EVAL_BATCH_SIZE_DEFAULT = 500
+BATCH_SIZES_DEFAULT = '1,32'
+STEPS_DEFAULT = 20
+
+# Directory in which cifar data is saved
+DATA_DIR_DEFAULT = './cifar10/cifar-10-batches-py'
+
+FLAGS = None
+
+# Sequences of layers fused into one quantized layer, longest first
+FUSION_PATTERNS = [(nn.Conv2d, nn.BatchNorm2d, nn.ReLU),
+                   (nn.Conv2d, nn.BatchNorm2d),
+                   (nn.Conv2d, nn.ReLU),
+                   (nn.Linear, nn.BatchNorm1d),
+                   (nn.Linear, nn.ReLU)]
+
+@contextlib.contextmanager
+def quantized_engine(backend):
+    """
+    Context in which the quantized kernels of a backend run. The engine is
+    a process-wide setting, the previous one is restored on exit. Some
+    layers of a model quantized for one backend, like the pooling, fail to
+    run under another one.
+    """
+    previous = torch.backends.quantized.engine
+    torch.backends.quantized.engine = backend
+    try:
+        yield
+    finally:
+        torch.backends.quantized.engine = previous
+
+@contextlib.contextmanager
+def _deprecations():
+    """
+    Context of the prepare and convert calls, which warn that the eager mode
+    quantization API and its observers and tensors are deprecated, as they
+    move to the torchao package, which is not a dependency. Only these
+    warnings are ignored.
+    """
+    with warnings.catch_warnings():
+        warnings.filterwarnings('ignore',
+                                r'torch\.ao\.quantization is deprecated',
+                                DeprecationWarning)
+        warnings.filterwarnings('ignore', r'(?s).*deprecated', UserWarning,
+                                r'torch\.ao\.')
+        yield
+
+def fusion_groups(sequential):
+    """
+    Returns the names of the layers of an nn.Sequential that are fused,
+    e.g. [['0', '1', '2'], ['4', '5', '6']] for convolutions followed by
+    batch normalization and ReLUs.
+    """
+    layers = list(sequential)
+    groups, i = [], 0
+    while i < len(layers):
+        for pattern in FUSION_PATTERNS:
+            window = layers[i:i + len(pattern)]
+            if len(window) == len(pattern) and \
+               all(type(layer) is kind for layer, kind in zip(window, pattern)):
+                groups.append([str(j) for j in range(i, i + len(pattern))])
+                i += len(pattern)
+                break
+        else:
+            i += 1
+    return groups
+
+def fuse(model):
+    """
+    Fuses the layers in every nn.Sequential of a model in eval mode in
+    place, the batch normalization is folded into the weights.
+    """
+    # the fused layers are sequentials themselves and are not fused again
+    for module in list(model.modules()):
+        if type(module) is nn.Sequential:
+            groups = fusion_groups(module)
+            if groups:
+                quantization.fuse_modules(module, groups, inplace=True)
+    return model
+
+def calibrate(model, dataset, batch_size, flatten=True):
+    """
+    Runs a model prepared for quantization over a dataset, so its observers
+    record the ranges of the activations.
+
+    Args:
+      model: prepared model
+      dataset: cifar10_utils.DataSet, e.g. a split of the training set
+      batch_size: number of samples per chunk
+      flatten: whether the model takes flattened images
+    """
+    with torch.no_grad():
+        for images, _ in chunks(dataset, batch_size):
+            images = dataset.normalize(images)
+            if flatten:
+                images = images.reshape(len(images), -1)
+            model(torch.from_numpy(images).float())
+
+def quantize_static(model, calibration_set, batch_size, flatten=True,
+                    backend=BACKEND_DEFAULT):
+    """
+    Quantizes the weights and activations of the convolutions and linear
+    layers of a model to int8. The other layers, like the max pooling, run
+    on the quantized tensors.
+
+    Args:
+      model: float ConvNet or MLP on the CPU, left unchanged
+      calibration_set: cifar10_utils.DataSet the activation ranges are
+                       calibrated on
+      batch_size: number of samples per calibration chunk
+      flatten: whether the model takes flattened images
+      backend: quantized engine, 'x86' or 'fbgemm' on x86 CPUs and
+               'qnnpack' on ARM. The model is run under it, see
+               quantized_engine.
+    Returns:
+      quantized: int8 model taking and returning float tensors
+    """
+    with quantized_engine(backend):
+        quantized = nn.Sequential(quantization.QuantStub(),
+                                  fuse(copy.deepcopy(model).eval()),
+                                  quantization.DeQuantStub()).eval()
+        quantized.qconfig = quantization.get_default_qconfig(backend)
+        with _deprecations():
+            quantization.prepare(quantized, inplace=True)
+        calibrate(quantized, calibration_set, batch_size, flatten)
+        with _deprecations():
+            quantization.convert(quantized, inplace=True)
+    return quantized
+
+def model_size(model):
+    """
+    Returns the number of bytes of the serialized state dict of a model.
+    """
+    buffer = io.BytesIO()
+    torch.save(model.state_dict(), buffer)
+    return buffer.tell()
+
+def compare(model, quantized, dataset, batch_size, flatten=True):
+    """
+    Evaluates a float model and its quantized version on a dataset.
+
+    Args:
+      model: float model
+      quantized: model returned by quantize_static
+      dataset: cifar10_utils.DataSet, e.g. the test set
+      batch_size: number of samples per chunk
+      flatten: whether the models take flattened images
+    Returns:
+      dictionary with the results of evaluate_torch and the size in bytes
+      of each model, under 'float' and 'int8'
+    """
+    results = {}
+    for name, network in [('float', model), ('int8', quantized)]:
+        results[name] = evaluate_torch(network, dataset, batch_size,
+                                       nn.CrossEntropyLoss(),
+                                       torch.device('cpu'), flatten)
+        results[name]['size'] = model_size(network)
+    return results
+
+def create_model(nr_pixels, nr_labels):
+    """
+    Creates the model selected by FLAGS and loads the trained weights.
+    """
+    if FLAGS.model == 'convnet':
+        model = ConvNet(3, nr_labels)
+    else:
+        model = MLP(nr_pixels, FLAGS.dnn_hidden_units, nr_labels)
+    if FLAGS.weights:
+        model.load_state_dict(torch.load(FLAGS.weights, map_location='cpu'))
+    return model.eval()
+
+def report():
+    """
+    Quantizes the model and prints the accuracy, size and latency of the
+    float and int8 models on the test set.
+    """
+    torch.manual_seed(42)
+    data = cifar10_utils.get_cifar10(FLAGS.data_dir, uint8=True)
+    image_shape = data['test'].images[0].shape
+    nr_pixels = int(np.prod(image_shape))
+    nr_labels = cifar10_utils.count_classes(data['test'].labels)
+    flatten = FLAGS.model == 'mlp'
+
+    # the calibration split comes from the training set, the test set is
+    # only used for the comparison
+    train = data['train']
+    calibration_set = cifar10_utils.DataSet(
+        train.images[:FLAGS.calibration_size],
+        train.labels[:FLAGS.calibration_size], train.mean)
+
+    model = create_model(nr_pixels, nr_labels)
+    quantized = quantize_static(model, calibration_set, FLAGS.eval_batch_size,
+                                flatten, FLAGS.backend)
+    with quantized_engine(FLAGS.backend):
+        results = compare(model, quantized, data['test'],
+                          FLAGS.eval_batch_size, flatten)
+
+    print('{:<8}{:>10}{:>10}{:>12}{:>14}'.format('model', 'accuracy', 'loss',
+                                                 'size [MB]', 'images/sec'))
+    for name in ['float', 'int8']:
+        print('{:<8}{:>10.4f}{:>10.4f}{:>12.2f}{:>14.1f}'.format(
+            name, results[name]['accuracy'], results[name]['loss'],
+            results[name]['size'] / 2 ** 20, results[name]['images_per_sec']))
+
+    print('{:>8}{:>12}{:>12}{:>10}'.format('batch', 'float', 'int8',
+                                           'speedup'))
+    for batch_size in FLAGS.batch_sizes:
+        x = torch.randn((batch_size,) + image_shape)
+        if flatten:
+            x = x.reshape(batch_size, -1)
+        with quantized_engine(FLAGS.backend):
+            seconds = [latency(network, x, FLAGS.steps)
+                       for network in [model, quantized]]
+        print('{:>8}{:>10.2f}ms{:>10.2f}ms{:>10.2f}'.format(
+            batch_size, 1e3 * seconds[0], 1e3 * seconds[1],
+            seconds[0] / seconds[1]))
+
+def print_flags():
+    """
+    Prints all entries in FLAGS variable.
+    """
+    for key, value in vars(FLAGS).items():
+        print(key + ' : ' + str(value))
+
+def main():
+    """
+    Main function
+    """
+    # Print all Flags to confirm parameter settings
+    print_flags()
+
+    if not os.path.exists(FLAGS.data_dir):
+        os.makedirs(FLAGS.data_dir)
+
+    report()
+
+if __name__ == '__main__':
+    # Command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--model', type=str, default=MODEL_DEFAULT,
+                      choices=['convnet', 'mlp'], help='Model to quantize')
+    parser.add_argument('--weights', type=str, default='',
+                      help='State dict saved by the trainer with \
+                            --save_model, random weights if empty')
+    parser.add_argument('--data_dir', type=str, default=DATA_DIR_DEFAULT,
+                      help='Directory for storing input data')
+    parser.add_argument('--dnn_hidden_units', type=str,
+                      default=DNN_HIDDEN_UNITS_DEFAULT,
+                      help='Comma separated list of number of units in each \
+                            hidden layer of the MLP')
+    parser.add_argument('--backend', type=str, default=BACKEND_DEFAULT,
+                      choices=['x86', 'fbgemm', 'qnnpack', 'onednn'],
+                      help='Quantized engine')
+    parser.add_argument('--calibration_size', type=int,
+                      default=CALIBRATION_SIZE_DEFAULT,
+                      help='Number of training images the activation ranges \
+                            are calibrated on')
+    parser.add_argument('--eval_batch_size', type=int,
+                      default=EVAL_BATCH_SIZE_DEFAULT,
+                      help='Number of samples calibrated and evaluated at once')
+    parser.add_argument('--batch_sizes', type=str, default=BATCH_SIZES_DEFAULT,
+                      help='Comma separated list of batch sizes of the \
+                            latency comparison')
+    parser.add_argument('--steps', type=int, default=STEPS_DEFAULT,
+                      help='Number of timed forward passes')
+    FLAGS, unparsed = parser.parse_known_args()
+    FLAGS.batch_sizes = [int(size) for size in FLAGS.batch_sizes.split(',')]
+    FLAGS.dnn_hidden_units = [int(units) for units
+                              in FLAGS.dnn_hidden_units.split(',') if units]
+
+    main()
@@ -0,0 +1,242 @@
+"""
+This module implements training and evaluation of a Convolutional Neural
+Network in NumPy.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import numpy as np
+import os
+from convnet_numpy import ConvNet
+from modules import SoftmaxCrossEntropyModule
+from optimizers import OPTIMIZERS
+from evaluation import evaluate
+from augmentation import Augmentation, channel_stats
+import cifar10_utils
+import time
+
+# Default constants
+LEARNING_RATE_DEFAULT = 1e-4
+BATCH_SIZE_DEFAULT = 32
+MAX_STEPS_DEFAULT = 5000
+EVAL_FREQ_DEFAULT = 500
+EVAL_BATCH_SIZE_DEFAULT = 500
+OPTIMIZER_DEFAULT = 'adam'
+DTYPE_DEFAULT = 'float32'
+PREFETCH_DEFAULT = 2
+ONE_HOT_DEFAULT = False
+IMAGE_STORAGE_DEFAULT = 'uint8'
+AUGMENT_DEFAULT = False
+SEED_DEFAULT = 42
+
+# Directory in which cifar data is saved
+DATA_DIR_DEFAULT = './cifar10/cifar-10-batches-py'
+
+FLAGS = None
+
+def accuracy(predictions, targets):
+    """
+    Computes the prediction accuracy, i.e. the average of correct predictions
+    of the network.
+
+    Args:
+    predictions: 2D float array of size [batch_size, n_classes]
+    labels: 2D int array of size [batch_size, n_classes]
+            with one-hot encoding or 1D int array of size [batch_size]
+            with class indices. Ground truth labels for
+            each sample in the batch
+    Returns:
+    accuracy: scalar float, the accuracy of predictions,
+              i.e. the average correct predictions over the whole batch
+    """
+    return (predictions.argmax(axis=1) ==
+            cifar10_utils.class_indices(targets)).mean()
+
+def train():
+    """
+    Performs training and evaluation of ConvNet model. Evaluates the model on
+    the whole test set each eval_freq iterations.
+    """
+
+    ### DO NOT CHANGE SEEDS!
+    # Set the random seeds for reproducibility
+    np.random.seed(42)
+
+    # initialize empty dictionaries
+    accu, loss = {}, {}
+
+    # retrieve data
+    data = cifar10_utils.get_cifar10(FLAGS.data_dir, one_hot=FLAGS.one_hot,
+                                     uint8=FLAGS.image_storage == 'uint8')
+
+    # determine shapes
+    image_shape = data['test'].images[0].shape
+    nr_labels = cifar10_utils.count_classes(data['test'].labels)
+
+    # save in variables, the test set is streamed through evaluate
+    dtype = np.dtype(FLAGS.dtype)
+    train_labels = data['train'].labels
+    if FLAGS.one_hot:
+        train_labels = train_labels.astype(dtype, copy=False)
+    # the images stay as stored and are cast to dtype batch by batch
+    train_images = data['train'].images
+
+    # with augmentation the images are also divided by the standard
+    # deviation of every channel, the training batches as they are gathered
+    # and the test images in evaluate alike
+    std = None
+    if FLAGS.augment:
+        std = channel_stats(train_images, mean_image=data['train'].mean)[1]
+    train_set = cifar10_utils.DataSet(train_images, train_labels,
+                                      data['train'].mean, dtype, std)
+    test_set = cifar10_utils.DataSet(data['test'].images, data['test'].labels,
+                                     data['test'].mean, dtype, std)
+
+    # the training batches are augmented on the background thread
+    augment = None
+    if FLAGS.augment:
+        augment = Augmentation(padding=4, flip=True)
+    sampler = cifar10_utils.BatchSampler(train_set.num_examples,
+                                         FLAGS.batch_size, FLAGS.seed,
+                                         replace=True)
+    batches = cifar10_utils.BatchPrefetcher(train_set, FLAGS.batch_size,
+                                            FLAGS.prefetch, transform=augment,
+                                            sampler=sampler)
+    for tag in data:
+        accu[tag] = []
+        loss[tag] = []
+
+    # create neural network, it outputs logits
+    neural_network = ConvNet(image_shape[0], nr_labels, dtype=dtype)
+    cross_entropy = SoftmaxCrossEntropyModule()
+    optimizer = OPTIMIZERS[FLAGS.optimizer](neural_network, FLAGS.learning_rate)
+
+    i = 0
+    logs = ['\n'.join([key + ' : ' + str(value)
+                      for key, value in vars(FLAGS).items()])]
+    start = time.perf_counter()
+    while i < FLAGS.max_steps:
+
+        i += 1
+
+        # sample batch from data
+        x_batch, y_batch = next(batches)
+
+        # apply forward and backward pass and update weights
+        nn_out = neural_network.forward(x_batch)
+        neural_network.backward(cross_entropy.backward(nn_out, y_batch))
+        optimizer.step()
+
+        if i % FLAGS.eval_freq == 0:
+
+            # throughput of the training steps since the last evaluation
+            images_per_sec = FLAGS.eval_freq * FLAGS.batch_size / \
+                (time.perf_counter() - start)
+
+            # save train accuracy and loss
+            accu['train'].append(accuracy(nn_out, y_batch))
+            loss['train'].append(cross_entropy.forward(nn_out, y_batch))
+
+            # calculate and save test accuracy and loss chunk by chunk
+            results = evaluate(neural_network, test_set,
+                               FLAGS.eval_batch_size, cross_entropy,
+                               flatten=False)
+            accu['test'].append(results['accuracy'])
+            loss['test'].append(results['loss'])
+
+            # show results in command prompt and save log
+            s = 'iteration ' + str(i) + ' | train acc/loss ' + \
+                str('{:.3f}'.format(accu['train'][-1])) + '/' + \
+                str('{:.3f}'.format(loss['train'][-1])) + ' | test acc/loss ' \
+                + str('{:.3f}'.format(accu['test'][-1])) + '/' + \
+                str('{:.3f}'.format(loss['test'][-1])) + ' | train images/sec ' \
+                + str('{:.1f}'.format(images_per_sec)) + ' | data wait ' + \
+                str('{:.3f}'.format(1e3 * batches.mean_wait_time())) + ' ms'
+
+            logs.append(s)
+            print(s)
+
+            # the evaluation is not part of the training time
+            start = time.perf_counter()
+
+    batches.close()
+    t = str(time.time())
+
+    # write logs
+    with open('results/logs_' + t + '.txt', 'w') as f:
+        f.writelines(['%s\n' % item for item in logs])
+
+    # write data to file
+    with open('results/data_' + t + '.txt', 'w') as f:
+        f.write('train accuracy')
+        f.writelines([',%s' % str(item) for item in accu['train']])
+        f.write('\ntrain loss')
+        f.writelines([',%s' % str(item) for item in loss['train']])
+        f.write('\ntest accuracy')
+        f.writelines([',%s' % str(item) for item in accu['test']])
+        f.write('\ntest loss')
+        f.writelines([',%s' % str(item) for item in loss['test']])
+
+def print_flags():
+    """
+    Prints all entries in FLAGS variable.
+    """
+    for key, value in vars(FLAGS).items():
+        print(key + ' : ' + str(value))
+
+def main():
+    """
+    Main function
+    """
+    # Print all Flags to confirm parameter settings
+    print_flags()
+
+    if not os.path.exists(FLAGS.data_dir):
+        os.makedirs(FLAGS.data_dir)
+
+    # Run the training operation
+    train()
+
+if __name__ == '__main__':
+    # Command line arguments
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--learning_rate', type=float,
+                      default=LEARNING_RATE_DEFAULT, help='Learning rate')
+    parser.add_argument('--max_steps', type=int, default=MAX_STEPS_DEFAULT,
+                      help='Number of steps to run trainer.')
+    parser.add_argument('--batch_size', type=int, default=BATCH_SIZE_DEFAULT,
+                      help='Batch size to run trainer.')
+    parser.add_argument('--eval_freq', type=int, default=EVAL_FREQ_DEFAULT,
+                      help='Frequency of evaluation on the test set')
+    parser.add_argument('--data_dir', type=str, default=DATA_DIR_DEFAULT,
+                      help='Directory for storing input data')
+    parser.add_argument('--eval_batch_size', type=int,
+                      default=EVAL_BATCH_SIZE_DEFAULT,
+                      help='Number of test samples evaluated at once')
+    parser.add_argument('--optimizer', type=str, default=OPTIMIZER_DEFAULT,
+                      choices=sorted(OPTIMIZERS),
+                      help='Optimizer of the parameters')
+    parser.add_argument('--dtype', type=str, default=DTYPE_DEFAULT,
+                      choices=['float32', 'float64'],
+                      help='Floating point type of parameters and activations')
+    parser.add_argument('--prefetch', type=int, default=PREFETCH_DEFAULT,
+                      help='Number of batches prepared ahead on a background \
+                            thread')
+    parser.add_argument('--one_hot', action='store_true',
+                      default=ONE_HOT_DEFAULT,
+                      help='Use one-hot labels instead of class indices')
+    parser.add_argument('--image_storage', type=str,
+                      default=IMAGE_STORAGE_DEFAULT, choices=['uint8', 'float32'],
+                      help='Type the images are kept in memory in, uint8 \
+                            images are normalized batch by batch')
+    parser.add_argument('--augment', action='store_true',
+                      default=AUGMENT_DEFAULT,
+                      help='Randomly crop, flip and normalize the training \
+                            batches')
+    parser.add_argument('--seed', type=int, default=SEED_DEFAULT,
+                      help='Seed of the sampler of the training batches')
+    FLAGS, unparsed = parser.parse_known_args()
+
+    main()
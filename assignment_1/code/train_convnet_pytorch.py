@@ -11,7 +11,12 @@ import torch.nn as nn
 import argparse
 import numpy as np
 import os
+import time
 from convnet_pytorch import ConvNet
+from augmentation import Augmentation, channel_stats
+from evaluation import evaluate_torch
+from export import freeze
+from metrics import MetricsRecorder
 import cifar10_utils
 
 # Default constants
@@ -19,7 +24,16 @@ LEARNING_RATE_DEFAULT = 1e-4
 BATCH_SIZE_DEFAULT = 32
 MAX_STEPS_DEFAULT = 5000
 EVAL_FREQ_DEFAULT = 500
+EVAL_BATCH_SIZE_DEFAULT = 500
 OPTIMIZER_DEFAULT = 'ADAM'
+PREFETCH_DEFAULT = 2
+ONE_HOT_DEFAULT = False
+IMAGE_STORAGE_DEFAULT = 'uint8'
+AUGMENT_DEFAULT = False
+SEED_DEFAULT = 42
+SAVE_MODEL_DEFAULT = ''
+CHANNELS_LAST_DEFAULT = False
+FUSED_EVAL_DEFAULT = False
 
 # Directory in which cifar data is saved
 DATA_DIR_DEFAULT = './cifar10/cifar-10-batches-py'
@@ -34,7 +48,8 @@ def accuracy(predictions, targets):
     Args:
     predictions: 2D float array of size [batch_size, n_classes]
     labels: 2D int array of size [batch_size, n_classes]
-            with one-hot encoding. Ground truth labels for
+            with one-hot encoding or 1D int array of size [batch_size]
+            with class indices. Ground truth labels for
             each sample in the batch
     Returns:
     accuracy: scalar float, the accuracy of predictions,
@@ -47,7 +62,9 @@ def accuracy(predictions, targets):
     ########################
     # PUT YOUR CODE HERE  #
     #######################
-    accuracy = (predictions.argmax(dim=1) == targets.argmax(dim=1))\
+    if targets.dim() > 1:
+        targets = targets.argmax(dim=1)
+    accuracy = (predictions.argmax(dim=1) == targets)\
              .type(torch.FloatTensor).mean().item()
     ########################
     # END OF YOUR CODE    #
@@ -71,35 +88,68 @@ def train():
     # PUT YOUR CODE HERE  #
     #######################
 
-    # initialize empty dictionaries
-    x, y, accu, loss = ({} for _ in range(4))
-
     # retrieve data
-    data = cifar10_utils.get_cifar10(FLAGS.data_dir)
+    data = cifar10_utils.get_cifar10(FLAGS.data_dir, one_hot=FLAGS.one_hot,
+                                     uint8=FLAGS.image_storage == 'uint8')
 
     # determine shapes
     image_shape = data['test'].images[0].shape
     nr_pixels = image_shape[0] * image_shape[1] * image_shape[2]
-    nr_labels = data['test'].labels.shape[1]
+    nr_labels = cifar10_utils.count_classes(data['test'].labels)
     nr_test = data['test'].images.shape[0]
 
     # set standards
     tensor = torch.FloatTensor
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-    # save in variables
-    for tag in data:
-        nr_images = data[tag].images.shape[0]
-        x[tag] = torch.tensor(data[tag].images)
-        y[tag] = torch.tensor(data[tag].labels)
-        accu[tag] = []
-        loss[tag] = []
-
-    x['test'] = x['test'].type(tensor).to(device)
-    y['test'] = y['test'].type(tensor).to(device)
+    # save in variables, training batches are gathered into pinned buffers
+    # and the test set is streamed through evaluate_torch
+    # with augmentation the images are also divided by the standard
+    # deviation of every channel, the training batches as they are gathered
+    # and the test images in evaluate_torch alike
+    std = None
+    if FLAGS.augment:
+        std = channel_stats(data['train'].images,
+                            mean_image=data['train'].mean)[1]
+    train_set = cifar10_utils.DataSet(data['train'].images,
+                                      data['train'].labels,
+                                      data['train'].mean, std=std)
+    test_set = cifar10_utils.DataSet(data['test'].images, data['test'].labels,
+                                     data['test'].mean, std=std)
+
+    # a background thread gathers and augments the next batches and copies
+    # them to the device
+    augment = None
+    if FLAGS.augment:
+        augment = Augmentation(padding=4, flip=True)
+
+    def to_device(images, labels):
+        if augment is not None:
+            images, labels = augment(images, labels)
+        # the copies from the pinned buffers run asynchronously, the
+        # prefetcher waits for them before it gathers into the buffers again
+        labels = cifar10_utils.class_indices(labels)
+        return torch.from_numpy(images).type(tensor).to(device, non_blocking=True), \
+               torch.from_numpy(labels).to(device, non_blocking=True).long()
+
+    sampler = cifar10_utils.BatchSampler(train_set.num_examples,
+                                         FLAGS.batch_size, FLAGS.seed,
+                                         replace=True)
+    batches = cifar10_utils.BatchPrefetcher(train_set, FLAGS.batch_size,
+                                            FLAGS.prefetch,
+                                            transform=to_device,
+                                            pin_memory=True, sampler=sampler)
+
+    # scalars of every evaluation, detached from the autograd graph
+    metrics = MetricsRecorder(['train_accuracy', 'train_loss',
+                               'test_accuracy', 'test_loss',
+                               'eval_peak_memory'],
+                              FLAGS.max_steps // FLAGS.eval_freq)
 
     # create neural network
-    neural_network = ConvNet(nr_pixels, nr_labels).to(device)
+    neural_network = ConvNet(image_shape[0], nr_labels).to(device)
+    if FLAGS.channels_last:
+        neural_network.to_channels_last()
     cross_entropy = nn.CrossEntropyLoss().to(device)
     parameter_optimizer = torch.optim.Adam(params=neural_network.parameters(), \
                                  lr=FLAGS.learning_rate)
@@ -114,35 +164,51 @@ def train():
         i += 1
 
         # sample batch from data
-        rand_idx = np.random.randint(x['train'].shape[0], size=FLAGS.batch_size)
-        x_batch = x['train'][rand_idx].type(tensor).to(device)
-        y_batch = y['train'][rand_idx].type(tensor).to(device)
+        x_batch, y_batch = next(batches)
 
         parameter_optimizer.zero_grad()
 
         nn_out = neural_network.forward(x_batch)
-        ce_out = cross_entropy.forward(nn_out, y_batch.argmax(dim=1))
+        ce_out = cross_entropy.forward(nn_out, y_batch)
         ce_out.backward()
         parameter_optimizer.step()
 
         if i % FLAGS.eval_freq == 0:
 
             # save train accuracy and loss
-            accu['train'].append(accuracy(nn_out, y_batch))
-            loss['train'].append(ce_out)
-
-            # calculate and save test accuracy and loss
-            nn_out = neural_network.forward(x['test'])
-            ce_out = cross_entropy.forward(nn_out, y['test'].argmax(dim=1))
-            accu['test'].append(accuracy(nn_out, y['test']))
-            loss['test'].append(ce_out.item())
+            train_accuracy = accuracy(nn_out, y_batch)
+            train_loss = ce_out.item()
+
+            # calculate and save test accuracy and loss chunk by chunk in
+            # eval mode, the fused network is a frozen copy with the batch
+            # normalization folded in, rebuilt from the current weights
+            eval_network = neural_network
+            if FLAGS.fused_eval:
+                eval_network = freeze(neural_network, x_batch,
+                                      FLAGS.channels_last, optimize=True)
+            results = evaluate_torch(eval_network, test_set,
+                                     FLAGS.eval_batch_size, cross_entropy,
+                                     device, flatten=False)
+            metrics.record(i, train_accuracy=train_accuracy,
+                           train_loss=train_loss,
+                           test_accuracy=results['accuracy'],
+                           test_loss=results['loss'],
+                           eval_peak_memory=np.nan
+                           if results['peak_memory'] is None
+                           else results['peak_memory'])
 
             # show results in command prompt and save log
             s = 'iteration ' + str(i) + ' | train acc/loss ' + \
-                str('{:.3f}'.format(accu['train'][-1])) + '/' + \
-                str('{:.3f}'.format(loss['train'][-1])) + ' | test acc/loss ' \
-                + str('{:.3f}'.format(accu['test'][-1])) + '/' + \
-                str('{:.3f}'.format(loss['test'][-1]))
+                str('{:.3f}'.format(metrics.last('train_accuracy'))) + '/' + \
+                str('{:.3f}'.format(metrics.last('train_loss'))) + ' | test acc/loss ' \
+                + str('{:.3f}'.format(metrics.last('test_accuracy'))) + '/' + \
+                str('{:.3f}'.format(metrics.last('test_loss'))) + ' | data wait ' + \
+                str('{:.3f}'.format(1e3 * batches.mean_wait_time())) + ' ms' + \
+                ' | eval images/sec ' + \
+                str('{:.1f}'.format(results['images_per_sec']))
+            if results['peak_memory'] is not None:
+                s += ' | eval peak ' + \
+                     str('{:.1f}'.format(results['peak_memory'] / 2 ** 20)) + ' MB'
 
             logs.append(s)
             print(s)
@@ -150,22 +216,19 @@ def train():
             #sys.stdout.flush()
 
 
+    batches.close()
     t = str(time.time())
 
+    # save the weights, e.g. for export.py
+    if FLAGS.save_model:
+        torch.save(neural_network.state_dict(), FLAGS.save_model)
+
     # write logs
     with open('results/logs_' + t + '.txt', 'w') as f:
         f.writelines(['%s\n' % item for item in logs])
 
-    # write data to file
-    with open('results/data_' + t + '.txt', 'w') as f:
-        f.write('train accuracy')
-        f.writelines([',%s' % str(item) for item in accu['train']])
-        f.write('\ntrain loss')
-        f.writelines([',%s' % str(item) for item in loss['train']])
-        f.write('\ntest accuracy')
-        f.writelines([',%s' % str(item) for item in accu['test']])
-        f.write('\ntest loss')
-        f.writelines([',%s' % str(item) for item in loss['test']])
+    # write data to file, one float64 array per metric
+    metrics.save('results/data_' + t + '.npz')
     ########################
     # END OF YOUR CODE    #
     #######################
@@ -203,6 +266,35 @@ if __name__ == '__main__':
                         help='Frequency of evaluation on the test set')
     parser.add_argument('--data_dir', type = str, default = DATA_DIR_DEFAULT,
                       help='Directory for storing input data')
+    parser.add_argument('--eval_batch_size', type = int,
+                      default = EVAL_BATCH_SIZE_DEFAULT,
+                      help='Number of test samples evaluated at once')
+    parser.add_argument('--prefetch', type = int, default = PREFETCH_DEFAULT,
+                      help='Number of batches prepared ahead on a background \
+                            thread')
+    parser.add_argument('--augment', action = 'store_true',
+                      default = AUGMENT_DEFAULT,
+                      help='Randomly crop, flip and normalize the training \
+                            batches')
+    parser.add_argument('--one_hot', action = 'store_true',
+                      default = ONE_HOT_DEFAULT,
+                      help='Use one-hot labels instead of class indices')
+    parser.add_argument('--image_storage', type = str,
+                      default = IMAGE_STORAGE_DEFAULT, choices = ['uint8', 'float32'],
+                      help='Type the images are kept in memory in, uint8 \
+                            images are normalized batch by batch')
+    parser.add_argument('--seed', type = int, default = SEED_DEFAULT,
+                      help='Seed of the sampler of the training batches')
+    parser.add_argument('--save_model', type = str, default = SAVE_MODEL_DEFAULT,
+                      help='File the state dict of the trained network is saved to')
+    parser.add_argument('--channels_last', action = 'store_true',
+                      default = CHANNELS_LAST_DEFAULT,
+                      help='Train and evaluate in the channels-last memory \
+                            format')
+    parser.add_argument('--fused_eval', action = 'store_true',
+                      default = FUSED_EVAL_DEFAULT,
+                      help='Evaluate a frozen copy of the network with the \
+                            batch normalization folded into the convolutions')
     FLAGS, unparsed = parser.parse_known_args()
 
     main()
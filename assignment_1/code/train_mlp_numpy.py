@@ -11,9 +11,12 @@ import argparse
 import numpy as np
 import os
 from mlp_numpy import MLP
-from modules import CrossEntropyModule
+from modules import CrossEntropyModule, SoftmaxCrossEntropyModule
+from data_parallel import DataParallelMLP
+from optimizers import OPTIMIZERS
+from evaluation import evaluate
+from checkpoint import save_checkpoint, load_checkpoint
 import cifar10_utils
-from modules import LinearModule
 import sys
 import time
 import matplotlib.pyplot as plt
@@ -24,6 +27,15 @@ LEARNING_RATE_DEFAULT = 2e-3
 MAX_STEPS_DEFAULT = 1500
 BATCH_SIZE_DEFAULT = 200
 EVAL_FREQ_DEFAULT = 100
+EVAL_BATCH_SIZE_DEFAULT = 1000
+DTYPE_DEFAULT = 'float64'
+WORKERS_DEFAULT = 1
+PREFETCH_DEFAULT = 2
+ONE_HOT_DEFAULT = False
+IMAGE_STORAGE_DEFAULT = 'uint8'
+OPTIMIZER_DEFAULT = 'sgd'
+SEED_DEFAULT = 42
+CHECKPOINT_DEFAULT = ''
 
 # Directory in which cifar data is saved
 DATA_DIR_DEFAULT = './cifar10/cifar-10-batches-py'
@@ -38,7 +50,8 @@ def accuracy(predictions, targets):
     Args:
     predictions: 2D float array of size [batch_size, n_classes]
     labels: 2D int array of size [batch_size, n_classes]
-            with one-hot encoding. Ground truth labels for
+            with one-hot encoding or 1D int array of size [batch_size]
+            with class indices. Ground truth labels for
             each sample in the batch
     Returns:
     accuracy: scalar float, the accuracy of predictions,
@@ -51,7 +64,8 @@ def accuracy(predictions, targets):
     ########################
     # PUT YOUR CODE HERE  #
     #######################
-    accuracy = (predictions.argmax(axis=1) == targets.argmax(axis=1)).mean()
+    accuracy = (predictions.argmax(axis=1) ==
+                cifar10_utils.class_indices(targets)).mean()
     ########################
     # END OF YOUR CODE    #
     #######################
@@ -89,75 +103,138 @@ def train():
     x, y, accu, loss = ({} for _ in range(4))
 
     # retrieve data
-    data = cifar10_utils.get_cifar10(FLAGS.data_dir)
+    data = cifar10_utils.get_cifar10(FLAGS.data_dir, one_hot=FLAGS.one_hot,
+                                     uint8=FLAGS.image_storage == 'uint8')
 
     # determine shapes
     image_shape = data['test'].images[0].shape
     nr_pixels = image_shape[0] * image_shape[1] * image_shape[2]
-    nr_labels = data['test'].labels.shape[1]
+    nr_labels = cifar10_utils.count_classes(data['test'].labels)
     nr_test = data['test'].images.shape[0]
 
-    # save in variables
+    # save in variables, the test set is streamed through evaluate
+    dtype = np.dtype(FLAGS.dtype)
+    nr_train = data['train'].images.shape[0]
+    # the images stay as stored, batches are normalized and cast to dtype as
+    # they are gathered
+    mean = data['train'].mean
+    x['train'] = np.reshape(data['train'].images, (nr_train, nr_pixels))
+    if mean is not None:
+        mean = mean.reshape(nr_pixels)
+    y['train'] = data['train'].labels
+    if FLAGS.one_hot:
+        y['train'] = y['train'].astype(dtype, copy=False)
+    train_set = cifar10_utils.DataSet(x['train'], y['train'], mean, dtype)
     for tag in data:
-        nr_images = data[tag].images.shape[0]
-        x[tag] = np.reshape(data[tag].images, (nr_images, nr_pixels))
-        y[tag] = np.reshape(data[tag].labels, (nr_images, nr_labels))
         accu[tag] = []
         loss[tag] = []
 
     # create neural network
-    neural_network = MLP(nr_pixels, dnn_hidden_units, nr_labels)
-    cross_entropy = CrossEntropyModule()
-
-    dx = 1
-    i = 0
-    logs = []
-    while i < FLAGS.max_steps and np.linalg.norm(dx) > 1e-5:
-
-        i += 1
-
-        # sample batch from data
-        rand_idx = np.random.randint(x['train'].shape[0], size=FLAGS.batch_size)
-        x_batch = x['train'][rand_idx]
-        y_batch = y['train'][rand_idx]
-
-        # apply forward and backward pass
-        nn_out = neural_network.forward(x_batch)
-        ce_out = cross_entropy.forward(nn_out, y_batch)
-        dx = cross_entropy.backward(nn_out, y_batch)
-        neural_network.backward(dx)
-
-        # update weights
-        for layer in neural_network.layers:
-            if isinstance(layer, LinearModule):
-                layer.params['weight'] -= FLAGS.learning_rate * \
-                                          layer.grads['weight']
-                layer.params['bias'] -= FLAGS.learning_rate * \
-                                        layer.grads['bias']
-
-        if i % FLAGS.eval_freq == 0:
-
-            # save train accuracy and loss
-            accu['train'].append(accuracy(nn_out, y_batch))
-            loss['train'].append(ce_out)
+    neural_network = MLP(nr_pixels, dnn_hidden_units, nr_labels,
+                         fused_loss=FLAGS.fused_loss, dtype=dtype,
+                         master_weights=FLAGS.master_weights)
+    if FLAGS.fused_loss:
+        cross_entropy = SoftmaxCrossEntropyModule()
+    else:
+        cross_entropy = CrossEntropyModule()
 
-            # calculate and save test accuracy and loss
-            nn_out = neural_network.forward(x['test'])
-            ce_out = cross_entropy.forward(nn_out, y['test'])
-            accu['test'].append(accuracy(nn_out, y['test']))
-            loss['test'].append(ce_out)
+    # preallocate batch and layer buffers
+    dx_buffer = None
+    if FLAGS.workspace:
+        neural_network.allocate_workspace(FLAGS.batch_size)
+        dx_buffer = neural_network.workspace['gradients'][-1]
 
-            # show results in command prompt and save log
-            s = 'iteration ' + str(i) + ' | train acc/loss ' + \
-                str('{:.3f}'.format(accu['train'][-1])) + '/' + str('{:.3f}'.format(loss['train'][-1])) + \
-                ' | test acc/loss ' + str('{:.3f}'.format(accu['test'][-1])) + '/' + \
-                str('{:.3f}'.format(loss['test'][-1]))
+    # create optimizer working on all parameters at once
+    optimizer = OPTIMIZERS[FLAGS.optimizer](neural_network, FLAGS.learning_rate)
 
-            logs.append(s)
-            print(s)
-            #sys.stdout.write("\r%s" % s)
-            #sys.stdout.flush()
+    # the batch of every step is a function of the seed and the step, so a
+    # run resumed from a checkpoint draws the batches it would have drawn
+    sampler = cifar10_utils.BatchSampler(nr_train, FLAGS.batch_size,
+                                         FLAGS.seed, replace=True)
+    i = 0
+    if FLAGS.checkpoint and os.path.exists(FLAGS.checkpoint):
+        i, history = load_checkpoint(FLAGS.checkpoint, neural_network,
+                                     optimizer, sampler)
+        accu, loss = history['accu'], history['loss']
+        print('resumed from ' + FLAGS.checkpoint + ' at iteration ' + str(i))
+
+    # start worker processes that share the training data, or a thread
+    # gathering the next batches into its own buffers. Raw images are shared
+    # as they are and the workers normalize their shards
+    parallel, batches = None, None
+    if FLAGS.workers > 1:
+        parallel = DataParallelMLP(neural_network, x['train'], y['train'],
+                                   FLAGS.workers, FLAGS.batch_size, mean)
+    else:
+        batches = cifar10_utils.BatchPrefetcher(train_set, FLAGS.batch_size,
+                                                FLAGS.prefetch, sampler=sampler)
 
+    dx = 1
+    logs = []
+    # the workers, their shared memory and the prefetching thread are
+    # released also if a step fails or the run is interrupted
+    try:
+        while i < FLAGS.max_steps and np.linalg.norm(dx) > 1e-5:
+
+            i += 1
+
+            if parallel is not None:
+                # the workers gather their shards and apply the passes
+                rand_idx = next(sampler)
+                train_loss, train_accu, dx = parallel.step(rand_idx, optimizer)
+            else:
+                # sample batch from data
+                x_batch, y_batch = next(batches)
+
+                # apply forward and backward pass
+                nn_out = neural_network.forward(x_batch)
+                dx = cross_entropy.backward(nn_out, y_batch, out=dx_buffer)
+                neural_network.backward(dx)
+
+                # update weights
+                optimizer.step()
+
+            if i % FLAGS.eval_freq == 0:
+
+                # save train accuracy and loss, the loss is only needed here
+                if parallel is None:
+                    train_accu = accuracy(nn_out, y_batch)
+                    train_loss = cross_entropy.forward(nn_out, y_batch)
+                accu['train'].append(train_accu)
+                loss['train'].append(train_loss)
+
+                # calculate and save test accuracy and loss chunk by chunk
+                results = evaluate(neural_network, data['test'],
+                                   FLAGS.eval_batch_size, cross_entropy,
+                                   trace_memory=FLAGS.trace_memory)
+                accu['test'].append(results['accuracy'])
+                loss['test'].append(results['loss'])
+
+                # show results in command prompt and save log
+                s = 'iteration ' + str(i) + ' | train acc/loss ' + \
+                    str('{:.3f}'.format(accu['train'][-1])) + '/' + str('{:.3f}'.format(loss['train'][-1])) + \
+                    ' | test acc/loss ' + str('{:.3f}'.format(accu['test'][-1])) + '/' + \
+                    str('{:.3f}'.format(loss['test'][-1]))
+                if results['peak_memory'] is not None:
+                    s += ' | eval peak ' + \
+                         str('{:.1f}'.format(results['peak_memory'] / 2 ** 20)) + ' MB'
+                if batches is not None:
+                    s += ' | data wait ' + \
+                         str('{:.3f}'.format(1e3 * batches.mean_wait_time())) + ' ms'
+
+                logs.append(s)
+                print(s)
+
+                if FLAGS.checkpoint:
+                    save_checkpoint(FLAGS.checkpoint, neural_network, optimizer,
+                                    sampler, i, {'accu': accu, 'loss': loss})
+                #sys.stdout.write("\r%s" % s)
+                #sys.stdout.flush()
+    finally:
+        if parallel is not None:
+            parallel.close()
+        else:
+            batches.close()
 
     t = str(time.time())
 
@@ -231,6 +308,41 @@ if __name__ == '__main__':
                       help='Frequency of evaluation on the test set')
     parser.add_argument('--data_dir', type=str, default=DATA_DIR_DEFAULT,
                       help='Directory for storing input data')
+    parser.add_argument('--eval_batch_size', type=int,
+                      default=EVAL_BATCH_SIZE_DEFAULT,
+                      help='Number of test samples evaluated at once')
+    parser.add_argument('--fused_loss', action='store_true',
+                      help='Fuse the softmax into the cross entropy loss')
+    parser.add_argument('--workspace', action='store_true',
+                      help='Train with preallocated batch and layer buffers')
+    parser.add_argument('--dtype', type=str, default=DTYPE_DEFAULT,
+                      choices=['float32', 'float64'],
+                      help='Floating point type of parameters and activations')
+    parser.add_argument('--master_weights', action='store_true',
+                      help='Keep a float64 copy of the weights for the updates')
+    parser.add_argument('--optimizer', type=str, default=OPTIMIZER_DEFAULT,
+                      choices=sorted(OPTIMIZERS),
+                      help='Optimizer of the parameters')
+    parser.add_argument('--workers', type=int, default=WORKERS_DEFAULT,
+                      help='Number of processes for data-parallel training')
+    parser.add_argument('--prefetch', type=int, default=PREFETCH_DEFAULT,
+                      help='Number of batches prepared ahead on a background \
+                            thread')
+    parser.add_argument('--one_hot', action='store_true',
+                      default=ONE_HOT_DEFAULT,
+                      help='Use one-hot labels instead of class indices')
+    parser.add_argument('--image_storage', type=str,
+                      default=IMAGE_STORAGE_DEFAULT, choices=['uint8', 'float32'],
+                      help='Type the images are kept in memory in, uint8 \
+                            images are normalized batch by batch')
+    parser.add_argument('--seed', type=int, default=SEED_DEFAULT,
+                      help='Seed of the sampler of the training batches')
+    parser.add_argument('--checkpoint', type=str, default=CHECKPOINT_DEFAULT,
+                      help='File the run is saved to at every evaluation and \
+                            resumed from if it exists')
+    parser.add_argument('--trace_memory', action='store_true',
+                      help='Trace the peak memory allocated by the \
+                            evaluations, which slows them down')
     FLAGS, unparsed = parser.parse_known_args()
 
     main()
@@ -14,6 +14,8 @@ import argparse
 import numpy as np
 import os
 from mlp_pytorch import MLP
+from evaluation import evaluate_torch
+from metrics import MetricsRecorder
 import cifar10_utils
 import matplotlib.pyplot as plt
 
@@ -23,6 +25,12 @@ LEARNING_RATE_DEFAULT = 2e-3
 MAX_STEPS_DEFAULT = 1500
 BATCH_SIZE_DEFAULT = 200
 EVAL_FREQ_DEFAULT = 100
+EVAL_BATCH_SIZE_DEFAULT = 1000
+PREFETCH_DEFAULT = 2
+ONE_HOT_DEFAULT = False
+IMAGE_STORAGE_DEFAULT = 'uint8'
+SEED_DEFAULT = 42
+SAVE_MODEL_DEFAULT = ''
 
 # Directory in which cifar data is saved
 DATA_DIR_DEFAULT = './cifar10/cifar-10-batches-py'
@@ -37,7 +45,8 @@ def accuracy(predictions, targets):
     Args:
     predictions: 2D float array of size [batch_size, n_classes]
     labels: 2D int array of size [batch_size, n_classes]
-            with one-hot encoding. Ground truth labels for
+            with one-hot encoding or 1D int array of size [batch_size]
+            with class indices. Ground truth labels for
             each sample in the batch
     Returns:
     accuracy: scalar float, the accuracy of predictions,
@@ -50,7 +59,9 @@ def accuracy(predictions, targets):
     ########################
     # PUT YOUR CODE HERE  #
     #######################
-    accuracy = (predictions.argmax(dim=1) == targets.argmax(dim=1))\
+    if targets.dim() > 1:
+        targets = targets.argmax(dim=1)
+    accuracy = (predictions.argmax(dim=1) == targets)\
                 .type(torch.FloatTensor).mean().item()
     ########################
     # END OF YOUR CODE    #
@@ -85,31 +96,52 @@ def train():
     # PUT YOUR CODE HERE  #
     #######################
 
-    # initialize empty dictionaries
-    x, y, accu, loss = ({} for _ in range(4))
-
     # retrieve data
-    data = cifar10_utils.get_cifar10(FLAGS.data_dir)
+    data = cifar10_utils.get_cifar10(FLAGS.data_dir, one_hot=FLAGS.one_hot,
+                                     uint8=FLAGS.image_storage == 'uint8')
 
     # determine shapes
     image_shape = data['test'].images[0].shape
     nr_pixels = image_shape[0] * image_shape[1] * image_shape[2]
-    nr_labels = data['test'].labels.shape[1]
+    nr_labels = cifar10_utils.count_classes(data['test'].labels)
     nr_test = data['test'].images.shape[0]
 
     # set standards
     tensor = torch.FloatTensor
     device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-    # save in variables
-    for tag in data:
-        nr_images = data[tag].images.shape[0]
-        x_tmp = np.reshape(data[tag].images, (nr_images, nr_pixels))
-        y_tmp = np.reshape(data[tag].labels, (nr_images, nr_labels))
-        x[tag] = torch.tensor(x_tmp).type(tensor).to(device)
-        y[tag] = torch.tensor(y_tmp).type(tensor).to(device)
-        accu[tag] = []
-        loss[tag] = []
+    # batches are gathered into pinned buffers and copied to the device, the
+    # test set is streamed through evaluate_torch
+    nr_train = data['train'].images.shape[0]
+    mean = data['train'].mean
+    if mean is not None:
+        mean = mean.reshape(nr_pixels)
+    train_set = cifar10_utils.DataSet(
+        np.reshape(data['train'].images, (nr_train, nr_pixels)),
+        data['train'].labels, mean)
+
+    # a background thread gathers the next batches and copies them to the
+    # device
+    def to_device(images, labels):
+        # the copies from the pinned buffers run asynchronously, the
+        # prefetcher waits for them before it gathers into the buffers again
+        labels = cifar10_utils.class_indices(labels)
+        return torch.from_numpy(images).type(tensor).to(device, non_blocking=True), \
+               torch.from_numpy(labels).to(device, non_blocking=True).long()
+
+    sampler = cifar10_utils.BatchSampler(train_set.num_examples,
+                                         FLAGS.batch_size, FLAGS.seed,
+                                         replace=True)
+    batches = cifar10_utils.BatchPrefetcher(train_set, FLAGS.batch_size,
+                                            FLAGS.prefetch,
+                                            transform=to_device,
+                                            pin_memory=True, sampler=sampler)
+
+    # scalars of every evaluation, detached from the autograd graph
+    metrics = MetricsRecorder(['train_accuracy', 'train_loss',
+                               'test_accuracy', 'test_loss',
+                               'eval_peak_memory'],
+                              FLAGS.max_steps // FLAGS.eval_freq)
 
 
     # create neural network
@@ -127,35 +159,43 @@ def train():
         i += 1
 
         # sample batch from data
-        rand_idx = np.random.randint(x['train'].shape[0], size=FLAGS.batch_size)
-        x_batch = x['train'][rand_idx]
-        y_batch = y['train'][rand_idx]
+        x_batch, y_batch = next(batches)
 
         parameter_optimizer.zero_grad()
 
         nn_out = neural_network.forward(x_batch)
-        ce_out = cross_entropy.forward(nn_out, y_batch.argmax(dim=1))
+        ce_out = cross_entropy.forward(nn_out, y_batch)
         ce_out.backward()
         parameter_optimizer.step()
 
         if i % FLAGS.eval_freq == 0:
 
             # save train accuracy and loss
-            accu['train'].append(accuracy(nn_out, y_batch))
-            loss['train'].append(ce_out)
-
-            # calculate and save test accuracy and loss
-            nn_out = neural_network.forward(x['test'])
-            ce_out = cross_entropy.forward(nn_out, y['test'].argmax(dim=1))
-            accu['test'].append(accuracy(nn_out, y['test']))
-            loss['test'].append(ce_out.item())
+            train_accuracy = accuracy(nn_out, y_batch)
+            train_loss = ce_out.item()
+
+            # calculate and save test accuracy and loss chunk by chunk
+            results = evaluate_torch(neural_network, data['test'],
+                                     FLAGS.eval_batch_size, cross_entropy,
+                                     device)
+            metrics.record(i, train_accuracy=train_accuracy,
+                           train_loss=train_loss,
+                           test_accuracy=results['accuracy'],
+                           test_loss=results['loss'],
+                           eval_peak_memory=np.nan
+                           if results['peak_memory'] is None
+                           else results['peak_memory'])
 
             # show results in command prompt and save log
             s = 'iteration ' + str(i) + ' | train acc/loss ' + \
-                str('{:.3f}'.format(accu['train'][-1])) + '/' + \
-                str('{:.3f}'.format(loss['train'][-1])) + ' | test acc/loss ' \
-                + str('{:.3f}'.format(accu['test'][-1])) + '/' + \
-                str('{:.3f}'.format(loss['test'][-1]))
+                str('{:.3f}'.format(metrics.last('train_accuracy'))) + '/' + \
+                str('{:.3f}'.format(metrics.last('train_loss'))) + ' | test acc/loss ' \
+                + str('{:.3f}'.format(metrics.last('test_accuracy'))) + '/' + \
+                str('{:.3f}'.format(metrics.last('test_loss'))) + ' | data wait ' + \
+                str('{:.3f}'.format(1e3 * batches.mean_wait_time())) + ' ms'
+            if results['peak_memory'] is not None:
+                s += ' | eval peak ' + \
+                     str('{:.1f}'.format(results['peak_memory'] / 2 ** 20)) + ' MB'
 
             logs.append(s)
             print(s)
@@ -163,34 +203,31 @@ def train():
             #sys.stdout.flush()
 
 
+    batches.close()
     t = str(time.time())
 
+    # save the weights, e.g. for export.py
+    if FLAGS.save_model:
+        torch.save(neural_network.state_dict(), FLAGS.save_model)
+
     # write logs
     with open('results/logs_' + t + '.txt', 'w') as f:
         f.writelines(['%s\n' % item for item in logs])
 
-    # write data to file
-    with open('results/data_' + t + '.txt', 'w') as f:
-        f.write('train accuracy')
-        f.writelines([',%s' % str(item) for item in accu['train']])
-        f.write('\ntrain loss')
-        f.writelines([',%s' % str(item) for item in loss['train']])
-        f.write('\ntest accuracy')
-        f.writelines([',%s' % str(item) for item in accu['test']])
-        f.write('\ntest loss')
-        f.writelines([',%s' % str(item) for item in loss['test']])
+    # write data to file, one float64 array per metric
+    metrics.save('results/data_' + t + '.npz')
 
     # plot accuracy
-    axis = [j for j in range(int(i / FLAGS.eval_freq))]
-    plt.plot(axis, accu['train'], label='train')
-    plt.plot(axis, accu['test'], label='test')
+    axis = metrics.steps[:len(metrics)]
+    plt.plot(axis, metrics['train_accuracy'], label='train')
+    plt.plot(axis, metrics['test_accuracy'], label='test')
     plt.legend()
     plt.savefig('acc_pytorch.png')
     plt.clf()
 
     # plot loss
-    plt.plot(axis, loss['train'], label='train')
-    plt.plot(axis, loss['test'], label='test')
+    plt.plot(axis, metrics['train_loss'], label='train')
+    plt.plot(axis, metrics['test_loss'], label='test')
     plt.legend()
     plt.savefig('loss_pytorch.png')
     plt.clf()
@@ -237,6 +274,23 @@ if __name__ == '__main__':
                         help='Frequency of evaluation on the test set')
     parser.add_argument('--data_dir', type = str, default = DATA_DIR_DEFAULT,
                         help='Directory for storing input data')
+    parser.add_argument('--prefetch', type = int, default = PREFETCH_DEFAULT,
+                        help='Number of batches prepared ahead on a background \
+                              thread')
+    parser.add_argument('--one_hot', action = 'store_true',
+                        default = ONE_HOT_DEFAULT,
+                        help='Use one-hot labels instead of class indices')
+    parser.add_argument('--image_storage', type = str,
+                        default = IMAGE_STORAGE_DEFAULT, choices = ['uint8', 'float32'],
+                        help='Type the images are kept in memory in, uint8 \
+                              images are normalized batch by batch')
+    parser.add_argument('--eval_batch_size', type = int,
+                        default = EVAL_BATCH_SIZE_DEFAULT,
+                        help='Number of test samples evaluated at once')
+    parser.add_argument('--seed', type = int, default = SEED_DEFAULT,
+                        help='Seed of the sampler of the training batches')
+    parser.add_argument('--save_model', type = str, default = SAVE_MODEL_DEFAULT,
+                        help='File the state dict of the trained network is saved to')
     FLAGS, unparsed = parser.parse_known_args()
 
     main()
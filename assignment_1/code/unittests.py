@@ -1,11 +1,37 @@
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
 import unittest
+import tracemalloc
+import weakref
 import numpy as np
 import torch
 import torch.nn as nn
 
-from modules import LinearModule, ReLUModule, SoftMaxModule, CrossEntropyModule
+from modules import Conv2dModule, MaxPool2dModule, BatchNorm2dModule
+from modules import LinearModule, ReLUModule, SoftMaxModule, CrossEntropyModule, \
+                    SoftmaxCrossEntropyModule
+from mlp_numpy import MLP
+from convnet_numpy import ConvNet
+from convnet_pytorch import ConvNet as TorchConvNet
+from mlp_pytorch import MLP as TorchMLP
+from export import fold_batchnorm, freeze, export_model, load_model, \
+  verify_export
+from quantization import fusion_groups, quantize_static, compare, quantized_engine
+from data_parallel import DataParallelMLP
+from optimizers import SGD, Momentum, RMSprop, Adam
+from evaluation import evaluate, evaluate_torch
+from checkpoint import save_checkpoint, load_checkpoint
+from metrics import MetricsRecorder
+from augmentation import Augmentation, random_crop, random_flip, normalize, \
+  channel_stats
+import cifar10_utils
+from cifar10_utils import DataSet
 # from custom_batchnorm import CustomBatchNormAutograd, CustomBatchNormManualFunction, CustomBatchNormManualModule
-from gradient_check import eval_numerical_gradient, eval_numerical_gradient_array
+from gradient_check import eval_numerical_gradient, eval_numerical_gradient_array, \
+  eval_numerical_gradient_batched, eval_directional_derivative, random_indices
 
 def rel_error(x, y):
   return np.max(np.abs(x - y) / (np.maximum(1e-8, np.abs(x) + np.abs(y))))
@@ -82,6 +108,46 @@ class TestLosses(unittest.TestCase):
       grads_num = eval_numerical_gradient(f, X, verbose = False, h = 1e-5)
       self.assertLess(rel_error(grads_num, grads), rel_error_max)
 
+  def test_softmax_crossentropy_loss(self):
+    np.random.seed(42)
+    rel_error_max = 1e-5
+
+    for test_num in range(10):
+      N = np.random.choice(range(1, 100))
+      C = np.random.choice(range(1, 10))
+      X = np.random.randn(N, C)
+      y = np.random.randint(C, size=(N,))
+      y = dense_to_one_hot(y, C)
+
+      loss = SoftmaxCrossEntropyModule().forward(X, y)
+      grads = SoftmaxCrossEntropyModule().backward(X, y)
+
+      probs = SoftMaxModule().forward(X)
+      self.assertAlmostEqual(loss, -np.sum(y * np.log(probs)) / N)
+
+      f = lambda _: SoftmaxCrossEntropyModule().forward(X, y)
+      grads_num = eval_numerical_gradient(f, X, verbose = False, h = 1e-5)
+      self.assertLess(rel_error(grads_num, grads), rel_error_max)
+
+  def test_sparse_labels(self):
+    np.random.seed(42)
+    N, C = 37, 10
+    X = np.random.randn(N, C)
+    probs = SoftMaxModule().forward(X)
+    labels = np.random.randint(C, size=(N,)).astype(np.uint8)
+    y = dense_to_one_hot(labels, C)
+
+    for module, x in [(CrossEntropyModule(), probs),
+                      (SoftmaxCrossEntropyModule(), X)]:
+      self.assertAlmostEqual(module.forward(x, labels), module.forward(x, y))
+      dx = module.backward(x, y)
+      self.assertLess(rel_error(module.backward(x, labels), dx), 1e-12)
+
+      # a reused gradient buffer is overwritten completely
+      out = np.random.randn(N, C)
+      self.assertIs(module.backward(x, labels, out=out), out)
+      self.assertLess(rel_error(out, dx), 1e-12)
+
 class TestLayers(unittest.TestCase):
 
   def test_linear_backward(self):
@@ -142,6 +208,1217 @@ class TestLayers(unittest.TestCase):
 
       self.assertLess(rel_error(dx, dx_num), rel_error_max)
 
+class TestConvLayers(unittest.TestCase):
+
+  def test_conv_backward(self):
+    np.random.seed(42)
+    rel_error_max = 1e-6
+
+    for stride, padding in [(1, 0), (1, 1), (2, 1)]:
+      x = np.random.randn(3, 4, 7, 7)
+      layer = Conv2dModule(4, 5, 3, stride, padding)
+      layer.params['bias'] = np.random.randn(5)
+      out = layer.forward(x)
+      dout = np.random.randn(*out.shape)
+      dx = layer.backward(dout)
+      dw = layer.grads['weight']
+
+      dx_num = eval_numerical_gradient_batched(lambda xx: layer.forward(xx), x, dout)
+      dw_num = eval_numerical_gradient_array(lambda w: layer.forward(x), layer.params['weight'], dout)
+      self.assertLess(rel_error(dx, dx_num), rel_error_max)
+      self.assertLess(rel_error(dw, dw_num), rel_error_max)
+
+  def test_matches_pytorch(self):
+    np.random.seed(42)
+    x = np.random.randn(4, 3, 9, 9)
+    x[0, 0] = 0
+
+    conv = Conv2dModule(3, 5, 3, stride=2, padding=1)
+    batchnorm = BatchNorm2dModule(3)
+    batchnorm.params['weight'] = np.random.randn(3)
+    batchnorm.params['bias'] = np.random.randn(3)
+    layers = [(conv, nn.Conv2d(3, 5, 3, stride=2, padding=1)),
+              (MaxPool2dModule(3, 2, 1), nn.MaxPool2d(3, 2, 1)),
+              (batchnorm, nn.BatchNorm2d(3))]
+
+    for layer, torch_layer in layers:
+      torch_layer.double()
+      if hasattr(layer, 'params'):
+        torch_layer.weight.data = torch.tensor(layer.params['weight'])
+        torch_layer.bias.data = torch.tensor(layer.params['bias'])
+
+      x_torch = torch.tensor(x, requires_grad=True)
+      out_torch = torch_layer(x_torch)
+      out = layer.forward(x)
+      dout = np.random.randn(*out.shape)
+      out_torch.backward(torch.tensor(dout))
+
+      self.assertLess(rel_error(out, out_torch.detach().numpy()), 1e-10)
+      self.assertLess(rel_error(layer.backward(dout), x_torch.grad.numpy()), 1e-10)
+      if hasattr(layer, 'params'):
+        self.assertLess(rel_error(layer.grads['weight'], torch_layer.weight.grad.numpy()), 1e-10)
+        self.assertLess(rel_error(layer.grads['bias'], torch_layer.bias.grad.numpy()), 1e-10)
+
+    # inference mode uses the running statistics
+    batchnorm.training = False
+    torch_layer.eval()
+    self.assertLess(rel_error(batchnorm.forward(x), torch_layer(torch.tensor(x)).detach().numpy()), 1e-10)
+
+  def test_convnet_matches_pytorch(self):
+    np.random.seed(42)
+    network = ConvNet(3, 10)
+    torch_network = TorchConvNet(3, 10).double()
+    torch_layers = [layer for layer in torch_network.layers
+                    if isinstance(layer, (nn.Conv2d, nn.BatchNorm2d, nn.Linear))]
+    layers = [layer for layer in network.layers if hasattr(layer, 'params')]
+    for layer, torch_layer in zip(layers, torch_layers):
+      torch_layer.weight.data = torch.tensor(layer.params['weight'])
+      torch_layer.bias.data = torch.tensor(layer.params['bias'].reshape(-1))
+
+    x = np.random.randn(2, 3, 32, 32)
+    x_torch = torch.tensor(x, requires_grad=True)
+    out_torch = torch_network(x_torch)
+    out = network.forward(x)
+    self.assertLess(rel_error(out, out_torch.detach().numpy()), 1e-8)
+
+    dout = np.random.randn(*out.shape)
+    out_torch.backward(torch.tensor(dout))
+    network.backward(dout)
+    for layer, torch_layer in zip(layers, torch_layers):
+      self.assertLess(rel_error(layer.grads['weight'], torch_layer.weight.grad.numpy()), 1e-8)
+
+class TestGradientCheck(unittest.TestCase):
+
+  def test_matches_elementwise(self):
+    np.random.seed(42)
+    x = np.random.randn(7, 13)
+    for layer in [LinearModule(13, 5), ReLUModule(), SoftMaxModule()]:
+      dout = np.random.randn(*layer.forward(x).shape)
+      f = lambda xx: layer.forward(xx)
+      dx_num = eval_numerical_gradient_array(f, x, dout)
+
+      self.assertLess(rel_error(eval_numerical_gradient_batched(f, x, dout, chunk_size=10),
+                                dx_num), 1e-8)
+
+      indices = random_indices(x, 20)
+      dx_subset = eval_numerical_gradient_batched(f, x, dout, indices=indices)
+      self.assertLess(rel_error(dx_subset.flat[indices], dx_num.flat[indices]), 1e-8)
+
+  def test_full_size_linear(self):
+    np.random.seed(42)
+    rel_error_max = 1e-5
+    x = np.random.randn(8, 3072)
+    dout = np.random.randn(8, 100)
+
+    layer = LinearModule(3072, 100)
+    layer.params['weight'] = np.random.randn(100, 3072)
+    layer.forward(x)
+    dx = layer.backward(dout)
+    dw = layer.grads['weight'].copy()
+    db = layer.grads['bias'].copy()
+
+    dx_num = eval_numerical_gradient_batched(lambda xx: layer.forward(xx), x, dout)
+    self.assertLess(rel_error(dx, dx_num), rel_error_max)
+
+    for grad, param in [(dw, layer.params['weight']), (db, layer.params['bias'])]:
+      for _ in range(3):
+        v = np.random.randn(*param.shape)
+        derivative = eval_directional_derivative(lambda p: layer.forward(x), param, dout, v)
+        self.assertLess(rel_error(derivative, np.sum(grad * v)), rel_error_max)
+
+class TestWorkspace(unittest.TestCase):
+
+  def train_step(self, network, optimizer, loss_module, x, y):
+    out = network.forward(x)
+    buffer = None
+    if network.workspace is not None:
+      buffer = network.workspace['gradients'][-1]
+    network.backward(loss_module.backward(out, y, out=buffer))
+    optimizer.step()
+    return out
+
+  def test_matches_allocating_pass(self):
+    for fused_loss in [False, True]:
+      np.random.seed(42)
+      x = np.random.randn(32, 50)
+      y = dense_to_one_hot(np.random.randint(10, size=(32,)), 10)
+      loss_module = SoftmaxCrossEntropyModule() if fused_loss else CrossEntropyModule()
+
+      np.random.seed(0)
+      reference = MLP(50, [20, 20], 10, fused_loss=fused_loss)
+      np.random.seed(0)
+      network = MLP(50, [20, 20], 10, fused_loss=fused_loss)
+      network.allocate_workspace(32)
+      optimizer_ref, optimizer = SGD(reference, 1e-2), SGD(network, 1e-2)
+
+      for step in range(3):
+        out_ref = self.train_step(reference, optimizer_ref, loss_module, x, y)
+        out = self.train_step(network, optimizer, loss_module, x, y)
+        self.assertLess(rel_error(out, out_ref), 1e-10)
+      for layer, layer_ref in zip(network.layers, reference.layers):
+        if isinstance(layer, LinearModule):
+          self.assertLess(rel_error(layer.params['weight'], layer_ref.params['weight']), 1e-10)
+          self.assertLess(rel_error(layer.grads['bias'], layer_ref.grads['bias']), 1e-10)
+
+  def test_convnet(self):
+    np.random.seed(42)
+    x = np.random.randn(4, 3, 8, 8)
+    y = dense_to_one_hot(np.random.randint(10, size=(4,)), 10)
+    loss_module = SoftmaxCrossEntropyModule()
+
+    np.random.seed(0)
+    reference = ConvNet(3, 10)
+    np.random.seed(0)
+    network = ConvNet(3, 10)
+    network.allocate_workspace(4)
+    optimizer_ref, optimizer = SGD(reference, 1e-2), SGD(network, 1e-2)
+
+    for step in range(2):
+      out_ref = self.train_step(reference, optimizer_ref, loss_module, x, y)
+      out = self.train_step(network, optimizer, loss_module, x, y)
+      self.assertLess(rel_error(out, out_ref), 1e-10)
+
+  def test_no_allocation(self):
+    np.random.seed(42)
+    x = np.random.randn(1000, 300)
+    y = dense_to_one_hot(np.random.randint(10, size=(1000,)), 10)
+    loss_module = SoftmaxCrossEntropyModule()
+
+    for workspace in [False, True]:
+      network = MLP(300, [500, 500], 10, fused_loss=True)
+      if workspace:
+        network.allocate_workspace(1000)
+      optimizer = SGD(network, 1e-2)
+
+      # first step sizes the scratch arrays of the modules
+      self.train_step(network, optimizer, loss_module, x, y)
+
+      tracemalloc.start()
+      for step in range(5):
+        self.train_step(network, optimizer, loss_module, x, y)
+      current, peak = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+
+      # a hidden activation takes 1000 * 500 * 8 bytes, with a workspace only
+      # small Python objects and the fixed-size iteration buffer NumPy uses
+      # for broadcasting operands are allocated, independent of the sizes
+      bound = 2 * 8 * np.getbufsize()
+      if workspace:
+        self.assertLess(peak, bound)
+        self.assertLess(current, 4096)
+      else:
+        self.assertGreater(peak, 1000 * 500 * 8)
+
+class TestPrecision(unittest.TestCase):
+
+  def test_float32(self):
+    np.random.seed(42)
+    x = np.random.randn(16, 40).astype(np.float32)
+    y = dense_to_one_hot(np.random.randint(10, size=(16,)), 10).astype(np.float32)
+    loss_module = SoftmaxCrossEntropyModule()
+
+    for master_weights in [False, True]:
+      network = MLP(40, [20], 10, fused_loss=True, dtype=np.float32,
+                    master_weights=master_weights)
+      network.allocate_workspace(16)
+      out = network.forward(x)
+      network.backward(loss_module.backward(out, y, out=network.workspace['gradients'][-1]))
+      SGD(network, 1e-2).step()
+
+      self.assertEqual(out.dtype, np.float32)
+      for layer in network.layers:
+        if isinstance(layer, LinearModule):
+          self.assertEqual(layer.params['weight'].dtype, np.float32)
+          self.assertEqual(layer.grads['weight'].dtype, np.float32)
+
+  def test_master_weights(self):
+    np.random.seed(42)
+    network = MLP(40, [20], 10, dtype=np.float32, master_weights=True)
+    layer = network.layers[0]
+    layer.grads['weight'][...] = 1
+    weight = layer.params['weight'].astype(np.float64)
+
+    # steps below the float32 resolution of the weights still accumulate
+    optimizer = SGD(network, 1e-12)
+    for step in range(1000):
+      optimizer.step()
+    master_weight = network.master_params[:weight.size].reshape(weight.shape)
+    self.assertLess(rel_error(master_weight, weight - 1e-9), 1e-7)
+
+class TestDataParallel(unittest.TestCase):
+
+  def test_matches_single_process(self):
+    np.random.seed(42)
+    x = np.random.randn(100, 30)
+    y = dense_to_one_hot(np.random.randint(10, size=(100,)), 10)
+    idx = np.random.randint(100, size=(25,))
+    loss_module = SoftmaxCrossEntropyModule()
+
+    np.random.seed(0)
+    reference = MLP(30, [20], 10, fused_loss=True)
+    np.random.seed(0)
+    network = MLP(30, [20], 10, fused_loss=True)
+
+    optimizer_ref, optimizer = SGD(reference, 1e-1), SGD(network, 1e-1)
+    with DataParallelMLP(network, x, y, 3, 25) as parallel:
+      for step in range(3):
+        out = reference.forward(x[idx])
+        dx = loss_module.backward(out, y[idx])
+        reference.backward(dx)
+        optimizer_ref.step()
+        loss, accu, dx_norm = parallel.step(idx, optimizer)
+
+        self.assertAlmostEqual(loss, loss_module.forward(out, y[idx]))
+        self.assertAlmostEqual(dx_norm, np.linalg.norm(dx))
+        self.assertLess(rel_error(network.forward(x), reference.forward(x)), 1e-10)
+
+  def test_raw_images(self):
+    np.random.seed(42)
+    x = np.random.randint(256, size=(100, 30)).astype(np.uint8)
+    mean = x.mean(axis=0)
+    y = np.random.randint(10, size=(100,))
+    idx = np.random.randint(100, size=(25,))
+
+    np.random.seed(0)
+    reference = MLP(30, [20], 10, fused_loss=True)
+    np.random.seed(0)
+    network = MLP(30, [20], 10, fused_loss=True)
+
+    # the workers normalize the raw images of their shards
+    with DataParallelMLP(reference, x - mean, y, 2, 25) as parallel:
+      expected = parallel.step(idx, SGD(reference, 1e-3))
+    with DataParallelMLP(network, x, y, 2, 25, mean) as parallel:
+      results = parallel.step(idx, SGD(network, 1e-3))
+
+    self.assertLess(rel_error(np.array(results), np.array(expected)), 1e-10)
+    self.assertLess(rel_error(network.params, reference.params), 1e-10)
+
+class TestOptimizers(unittest.TestCase):
+
+  def test_matches_pytorch(self):
+    settings = [(SGD, torch.optim.SGD, {}),
+                (Momentum, torch.optim.SGD, {'momentum': 0.9}),
+                (RMSprop, torch.optim.RMSprop, {}),
+                (Adam, torch.optim.Adam, {})]
+
+    for optimizer_class, torch_class, kwargs in settings:
+      np.random.seed(42)
+      network = MLP(20, [10], 5)
+      optimizer = optimizer_class(network, 1e-2)
+      param = torch.tensor(network.params, requires_grad=True)
+      torch_optimizer = torch_class([param], lr=1e-2, **kwargs)
+
+      for step in range(5):
+        network.grads[...] = np.random.randn(*network.grads.shape)
+        param.grad = torch.tensor(network.grads)
+        optimizer.step()
+        torch_optimizer.step()
+
+      self.assertLess(rel_error(network.params, param.detach().numpy()), 1e-10)
+      # layers see the update through their views into the vector
+      self.assertIs(network.layers[0].params['weight'].base, network.params)
+
+  def test_master_weights(self):
+    np.random.seed(42)
+    network = MLP(20, [10], 5, dtype=np.float32, master_weights=True)
+    optimizer = Adam(network, 1e-3)
+    network.grads[...] = 1
+
+    optimizer.step()
+    self.assertEqual(network.master_params.dtype, np.float64)
+    self.assertEqual(network.params.dtype, np.float32)
+    self.assertLess(rel_error(network.params, network.master_params), 1e-6)
+
+  def test_state_dict(self):
+    for optimizer_class in [SGD, Momentum, RMSprop, Adam]:
+      np.random.seed(42)
+      network = MLP(20, [10], 5)
+      other = MLP(20, [10], 5)
+      other.params[...] = network.params
+      optimizer = optimizer_class(network, 1e-2)
+      grads = [np.random.randn(*network.grads.shape) for _ in range(6)]
+
+      for g in grads[:3]:
+        network.grads[...] = g
+        optimizer.step()
+        other.grads[...] = g
+        other.params[...] = network.params
+      restored = optimizer_class(other, 1e-2)
+      restored.load_state_dict(optimizer.state_dict())
+
+      for g in grads[3:]:
+        network.grads[...] = g
+        optimizer.step()
+        other.grads[...] = g
+        restored.step()
+      self.assertTrue(np.array_equal(network.params, other.params))
+
+class TestFlatParameters(unittest.TestCase):
+
+  def test_views(self):
+    np.random.seed(42)
+    network = MLP(30, [20, 10], 5)
+    self.assertEqual(network.params.size, 30 * 20 + 20 + 20 * 10 + 10 + 10 * 5 + 5)
+
+    for layer in network.layers:
+      if isinstance(layer, LinearModule):
+        for name in ['weight', 'bias']:
+          self.assertTrue(np.shares_memory(layer.params[name], network.params))
+          self.assertTrue(np.shares_memory(layer.grads[name], network.grads))
+
+    x = np.random.randn(8, 30)
+    network.backward(network.forward(x) - 1)
+    norm = np.sqrt(sum(np.sum(layer.grads[name] ** 2)
+                       for layer in network.layers if isinstance(layer, LinearModule)
+                       for name in ['weight', 'bias']))
+    self.assertAlmostEqual(network.grad_norm(), norm)
+
+    self.assertAlmostEqual(network.clip_grad_norm(norm / 2), norm)
+    self.assertAlmostEqual(network.grad_norm(), norm / 2)
+
+  def test_save_load(self):
+    np.random.seed(42)
+    network = MLP(30, [20], 5)
+    other = MLP(30, [20], 5)
+    x = np.random.randn(8, 30)
+
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, 'params.npy')
+      network.save(path)
+      other.load(path)
+
+    self.assertTrue(np.array_equal(network.forward(x), other.forward(x)))
+
+class TestEvaluation(unittest.TestCase):
+
+  def setUp(self):
+    np.random.seed(42)
+    images = np.random.randn(250, 3, 4, 4).astype(np.float32)
+    labels = np.eye(5, dtype=np.float32)[np.random.randint(5, size=250)]
+    self.dataset = DataSet(images, labels)
+    self.x = images.reshape(250, -1)
+    self.y = labels
+
+  def test_matches_full_pass(self):
+    network = MLP(48, [20], 5)
+    loss_module = CrossEntropyModule()
+    out = network.forward(self.x)
+    loss = loss_module.forward(out, self.y)
+    accuracy = np.mean(out.argmax(axis=1) == self.y.argmax(axis=1))
+
+    results = evaluate(network, self.dataset, 64, loss_module)
+    self.assertLess(rel_error(results['loss'], loss), 1e-7)
+    self.assertEqual(results['accuracy'], accuracy)
+    self.assertIsNone(results['peak_memory'])
+    results = evaluate(network, self.dataset, 64, trace_memory=True)
+    self.assertLess(results['peak_memory'],
+                    evaluate(network, self.dataset, 250,
+                             trace_memory=True)['peak_memory'])
+
+  def test_matches_full_pass_torch(self):
+    torch.manual_seed(42)
+    network = nn.Sequential(nn.Linear(48, 20), nn.ReLU(), nn.Linear(20, 5))
+    loss_fn = nn.CrossEntropyLoss()
+    with torch.no_grad():
+      out = network(torch.from_numpy(self.x))
+      loss = loss_fn(out, torch.from_numpy(self.y).argmax(dim=1)).item()
+    accuracy = np.mean(out.numpy().argmax(axis=1) == self.y.argmax(axis=1))
+
+    results = evaluate_torch(network, self.dataset, 64, loss_fn,
+                             torch.device('cpu'))
+    self.assertLess(rel_error(results['loss'], loss), 1e-6)
+    self.assertEqual(results['accuracy'], accuracy)
+
+  def test_torch_peak_memory(self):
+    # the peak is measured on top of the memory resident before the
+    # evaluation, which memory freed by other tests may already be part of,
+    # so it is measured in a fresh process, after a warm up pass that sets
+    # up PyTorch. A full pass holds 2000 * 8192 * 4 bytes of activations
+    script = ("import sys\n"
+              "import numpy as np\n"
+              "import torch\n"
+              "import torch.nn as nn\n"
+              "from cifar10_utils import DataSet\n"
+              "from evaluation import evaluate_torch\n"
+              "dataset = DataSet(np.random.randn(2000, 48).astype(np.float32),\n"
+              "                  np.random.randint(5, size=2000))\n"
+              "network = nn.Sequential(nn.Linear(48, 8192), nn.ReLU(),\n"
+              "                        nn.Linear(8192, 5))\n"
+              "args = (nn.CrossEntropyLoss(), torch.device('cpu'))\n"
+              "evaluate_torch(network, DataSet(dataset.images[:50],\n"
+              "                                dataset.labels[:50]), 50, *args)\n"
+              "chunked = evaluate_torch(network, dataset, 50, *args)['peak_memory']\n"
+              "peak = evaluate_torch(network, dataset, 2000, *args)['peak_memory']\n"
+              "if peak is None:\n"
+              "  sys.exit(2)\n"
+              "sys.exit(0 if chunked < peak / 4 and peak > 2000 * 8192 * 4 else 1)\n")
+    code = subprocess.call([sys.executable, '-c', script],
+                           cwd=os.path.dirname(os.path.abspath(__file__)))
+    if code == 2:
+      self.skipTest('resident memory can not be measured')
+    self.assertEqual(code, 0)
+
+  def test_torch_eval_mode(self):
+    torch.manual_seed(42)
+    network = nn.Sequential(nn.Linear(48, 20), nn.BatchNorm1d(20), nn.ReLU(),
+                            nn.Linear(20, 5))
+    network(torch.randn(32, 48))
+    running_mean = network[1].running_mean.clone()
+    loss_fn = nn.CrossEntropyLoss()
+
+    network.eval()
+    with torch.no_grad():
+      out = network(torch.from_numpy(self.x).float())
+      loss = loss_fn(out, torch.from_numpy(self.y).argmax(dim=1)).item()
+    network.train()
+
+    results = evaluate_torch(network, self.dataset, 64, loss_fn,
+                             torch.device('cpu'))
+    self.assertLess(rel_error(results['loss'], loss), 1e-6)
+    self.assertTrue(torch.equal(network[1].running_mean, running_mean))
+    self.assertTrue(network.training)
+    self.assertGreater(results['images_per_sec'], 0)
+
+  def test_sparse_labels(self):
+    sparse = DataSet(self.dataset.images, self.y.argmax(axis=1).astype(np.uint8))
+    network = MLP(48, [20], 5)
+    expected = evaluate(network, self.dataset, 64)
+    results = evaluate(network, sparse, 64)
+    self.assertLess(rel_error(results['loss'], expected['loss']), 1e-7)
+    self.assertEqual(results['accuracy'], expected['accuracy'])
+
+    network = nn.Sequential(nn.Linear(48, 5))
+    expected = evaluate_torch(network, self.dataset, 64, nn.CrossEntropyLoss(),
+                              torch.device('cpu'))
+    results = evaluate_torch(network, sparse, 64, nn.CrossEntropyLoss(),
+                             torch.device('cpu'))
+    self.assertLess(rel_error(results['loss'], expected['loss']), 1e-6)
+    self.assertEqual(results['accuracy'], expected['accuracy'])
+
+class TestInferenceMode(unittest.TestCase):
+
+  def test_matches_training_mode(self):
+    np.random.seed(42)
+    x = np.random.randn(16, 30)
+    for fused_loss in [False, True]:
+      network = MLP(30, [20, 10], 5, fused_loss=fused_loss)
+      expected = network.forward(x).copy()
+
+      network.eval()
+      self.assertFalse(any(hasattr(layer, '_x') or hasattr(layer, '_out')
+                           for layer in network.layers))
+      self.assertLess(rel_error(network.forward(x), expected), 1e-12)
+      self.assertLess(rel_error(network.forward(x[:5]), expected[:5]), 1e-12)
+      self.assertFalse(any(hasattr(layer, '_x') or hasattr(layer, '_out')
+                           for layer in network.layers))
+      with self.assertRaises(AssertionError):
+        network.backward(np.ones_like(expected))
+
+      network.train()
+      network.backward(network.forward(x) - 1)
+
+  def test_no_allocation(self):
+    np.random.seed(42)
+    x = np.random.randn(64, 300)
+    network = MLP(300, [200, 100], 10).eval()
+    network.forward(x)
+
+    tracemalloc.start()
+    network.forward(x)
+    network.forward(x[:32])
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    self.assertLess(current, 4096)
+    self.assertLess(peak, 2 * 8 * np.getbufsize())
+
+def write_cifar10_fixture(directory, num_images=20):
+  """
+  Writes CIFAR10 batch files with num_images random images each, or with
+  num_images[i] images in the i-th file if a list is given.
+  """
+  if isinstance(num_images, int):
+    num_images = [num_images] * len(cifar10_utils.BATCH_FILES)
+  for filename, num_images in zip(cifar10_utils.BATCH_FILES, num_images):
+    batch = {'data': np.random.randint(256, size=(num_images, 3072), dtype=np.uint8),
+             'labels': list(np.random.randint(10, size=num_images))}
+    with open(os.path.join(directory, filename), 'wb') as f:
+      pickle.dump(batch, f)
+
+class TestDataSet(unittest.TestCase):
+
+  def setUp(self):
+    self.images = np.arange(23 * 2, dtype=np.float32).reshape(23, 2)
+    self.labels = np.arange(23)
+
+  def test_epochs(self):
+    np.random.seed(42)
+    dataset = DataSet(self.images, self.labels)
+    seen = np.concatenate([dataset.next_batch(5)[1] for _ in range(4)])
+    self.assertTrue(np.array_equal(seen, np.arange(20)))
+
+    # every epoch is a permutation, the data itself is not reordered
+    for _ in range(3):
+      batches = [dataset.next_batch(5) for _ in range(4)]
+      seen = np.concatenate([labels for _, labels in batches])
+      self.assertEqual(len(np.unique(seen)), 20)
+      for images, labels in batches:
+        self.assertTrue(np.array_equal(images, self.images[labels]))
+    self.assertEqual(dataset.epochs_completed, 3)
+    self.assertTrue(np.array_equal(dataset.labels, self.labels))
+
+  def test_buffers(self):
+    np.random.seed(42)
+    dataset = DataSet(self.images, self.labels)
+    dataset.allocate_buffers(5)
+    images, labels = dataset.next_batch(5, replace=True)
+    self.assertTrue(np.array_equal(images, self.images[labels]))
+
+    tracemalloc.start()
+    other_images, other_labels = dataset.next_batch(5)
+    current = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    self.assertIs(other_images, images)
+    self.assertIs(other_labels, labels)
+    self.assertLess(current, 1024)
+
+  def test_cast_on_gather(self):
+    dataset = DataSet(self.images, self.labels, dtype=np.float64)
+    self.assertIs(dataset.images, self.images)
+    self.assertEqual(dataset.image_dtype, np.float64)
+
+    # the images are only cast batch by batch
+    images, labels = dataset.next_batch(5, replace=True)
+    self.assertEqual(images.dtype, np.float64)
+    self.assertTrue(np.array_equal(images, self.images[labels]))
+    dataset.allocate_buffers(5)
+    images, labels = dataset.next_batch(5, replace=True)
+    self.assertEqual(images.dtype, np.float64)
+    self.assertTrue(np.array_equal(images, self.images[labels]))
+
+  @unittest.skipUnless(torch.cuda.is_available(), 'needs CUDA')
+  def test_pinned_buffers(self):
+    np.random.seed(42)
+    images = np.random.randn(1000, 3, 32, 32).astype(np.float32)
+    dataset = DataSet(images, np.arange(1000))
+    dataset.allocate_buffers(500, pin_memory=True)
+
+    # the asynchronous copies read the buffers while the next batches are
+    # gathered into them
+    copies = []
+    for _ in range(10):
+      x, y = dataset.next_batch(500, replace=True)
+      copies.append((torch.from_numpy(x).cuda(non_blocking=True),
+                     torch.from_numpy(y).cuda(non_blocking=True)))
+    for x, y in copies:
+      self.assertTrue(np.array_equal(x.cpu().numpy(), images[y.cpu().numpy()]))
+
+  def test_replace(self):
+    dataset = DataSet(self.images, self.labels)
+    np.random.seed(42)
+    expected = np.random.randint(23, size=(3, 5))
+    np.random.seed(42)
+    for indices in expected:
+      self.assertTrue(np.array_equal(dataset.next_batch(5, replace=True)[1], indices))
+
+class TestBatchPrefetcher(unittest.TestCase):
+
+  def setUp(self):
+    self.images = np.arange(23 * 2, dtype=np.float32).reshape(23, 2)
+    self.labels = np.arange(23)
+
+  def test_matches_next_batch(self):
+    for replace in [False, True]:
+      np.random.seed(42)
+      dataset = DataSet(self.images, self.labels)
+      expected = [[array.copy() for array in dataset.next_batch(5, replace)]
+                  for _ in range(12)]
+
+      for depth in [0, 1, 3]:
+        np.random.seed(42)
+        dataset = DataSet(self.images, self.labels)
+        with cifar10_utils.BatchPrefetcher(dataset, 5, depth, replace) as batches:
+          for expected_images, expected_labels in expected:
+            images, labels = next(batches)
+            self.assertTrue(np.array_equal(images, expected_images))
+            self.assertTrue(np.array_equal(labels, expected_labels))
+        self.assertEqual(batches.num_batches, len(expected))
+        self.assertGreater(batches.wait_time, 0)
+
+  def test_normalize_on_gather(self):
+    np.random.seed(42)
+    raw = np.random.randint(256, size=(23, 2)).astype(np.uint8)
+    mean = raw.mean(axis=0).astype(np.float32)
+    expected = DataSet(raw.astype(np.float32) - mean, self.labels)
+    dataset = DataSet(raw, self.labels, mean)
+    self.assertEqual(dataset.image_dtype, np.float32)
+
+    indices = np.random.randint(23, size=5)
+    images, labels = dataset.take(indices)
+    self.assertEqual(images.dtype, np.float32)
+    self.assertTrue(np.array_equal(images, expected.take(indices)[0]))
+    self.assertTrue(np.array_equal(dataset.normalize(raw), expected.images))
+
+    with cifar10_utils.BatchPrefetcher(dataset, 5, replace=True) as batches:
+      for _ in range(3):
+        images, labels = next(batches)
+        self.assertTrue(np.array_equal(images, expected.images[labels]))
+
+  def test_transform(self):
+    dataset = DataSet(self.images, self.labels)
+    with cifar10_utils.BatchPrefetcher(dataset, 5, transform=lambda x, y: (torch.from_numpy(x), y)) as batches:
+      images, labels = next(batches)
+      self.assertIsInstance(images, torch.Tensor)
+      self.assertTrue(np.array_equal(images.numpy(), self.images[labels]))
+
+    def fail(images, labels):
+      raise ValueError('transform failed')
+    batches = cifar10_utils.BatchPrefetcher(dataset, 5, transform=fail)
+    # the thread stops on the error, later requests raise it instead of
+    # waiting for a batch
+    for _ in range(3):
+      with self.assertRaises(ValueError):
+        next(batches)
+    batches.close()
+
+  @unittest.skipUnless(torch.cuda.is_available(), 'needs CUDA')
+  def test_pinned_slots(self):
+    np.random.seed(42)
+    images = np.random.randn(1000, 3, 32, 32).astype(np.float32)
+    dataset = DataSet(images, np.arange(1000))
+    to_device = lambda x, y: (torch.from_numpy(x).cuda(non_blocking=True),
+                              torch.from_numpy(y).cuda(non_blocking=True))
+
+    # the batches are kept beyond their slot, so every slot is gathered
+    # into again while the copies from it may still run
+    with cifar10_utils.BatchPrefetcher(dataset, 500, replace=True,
+                                       transform=to_device,
+                                       pin_memory=True) as batches:
+      copies = [next(batches) for _ in range(10)]
+    for x, y in copies:
+      self.assertTrue(np.array_equal(x.cpu().numpy(), images[y.cpu().numpy()]))
+
+class TestBatchSampler(unittest.TestCase):
+
+  def test_seek(self):
+    for replace in [False, True]:
+      sampler = cifar10_utils.BatchSampler(23, 5, seed=7, replace=replace)
+      expected = [next(sampler).copy() for _ in range(12)]
+      self.assertEqual(sampler.step, 12)
+
+      # any step is drawn directly, in any order
+      other = cifar10_utils.BatchSampler(23, 5, seed=7, replace=replace)
+      for step in [11, 3, 0, 7, 4]:
+        self.assertTrue(np.array_equal(other.indices(step), expected[step]))
+
+      other = cifar10_utils.BatchSampler(23, 5, seed=8, replace=replace)
+      self.assertFalse(all(np.array_equal(other.indices(step), expected[step])
+                           for step in range(12)))
+
+  def test_epochs(self):
+    sampler = cifar10_utils.BatchSampler(23, 5, seed=7)
+    self.assertEqual(sampler.batches_per_epoch, 4)
+    epochs = [np.concatenate([next(sampler) for _ in range(4)])
+              for _ in range(2)]
+    self.assertEqual(sampler.epoch, 2)
+    for indices in epochs:
+      self.assertEqual(len(np.unique(indices)), 20)
+    self.assertFalse(np.array_equal(epochs[0], epochs[1]))
+
+    sampler = cifar10_utils.BatchSampler(23, 5, seed=7, replace=True)
+    indices = sampler.indices(10 ** 15)
+    self.assertEqual(indices.shape, (5,))
+    self.assertTrue(np.all((indices >= 0) & (indices < 23)))
+
+  def test_state_dict(self):
+    sampler = cifar10_utils.BatchSampler(23, 5, seed=7)
+    for _ in range(6):
+      next(sampler)
+    other = cifar10_utils.BatchSampler(23, 5)
+    other.load_state_dict(sampler.state_dict())
+    self.assertTrue(np.array_equal(next(other), next(sampler)))
+
+    with self.assertRaises(ValueError):
+      cifar10_utils.BatchSampler(23, 4).load_state_dict(sampler.state_dict())
+
+  def test_prefetcher(self):
+    images = np.arange(23 * 2, dtype=np.float32).reshape(23, 2)
+    dataset = DataSet(images, np.arange(23))
+    sampler = cifar10_utils.BatchSampler(23, 5, seed=7, replace=True)
+    with cifar10_utils.BatchPrefetcher(dataset, 5, sampler=sampler) as batches:
+      for step in range(6):
+        _, labels = next(batches)
+        self.assertTrue(np.array_equal(labels, sampler.indices(step)))
+
+  def test_resume_training(self):
+    np.random.seed(42)
+    dataset = DataSet(np.random.randn(50, 12), np.random.randint(3, size=50))
+    loss_module = SoftmaxCrossEntropyModule()
+
+    def run(network, optimizer, sampler, steps):
+      for _ in range(steps):
+        x, y = dataset.take(next(sampler))
+        out = network.forward(x)
+        network.backward(loss_module.backward(out, y))
+        optimizer.step()
+
+    def create():
+      np.random.seed(0)
+      network = MLP(12, [8], 3, fused_loss=True)
+      sampler = cifar10_utils.BatchSampler(50, 10, seed=3, replace=True)
+      return network, Adam(network, 1e-2), sampler
+
+    network, optimizer, sampler = create()
+    run(network, optimizer, sampler, 10)
+
+    resumed, resumed_optimizer, resumed_sampler = create()
+    run(resumed, resumed_optimizer, resumed_sampler, 5)
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, 'checkpoint.npz')
+      save_checkpoint(path, resumed, resumed_optimizer, resumed_sampler, 5,
+                      {'loss': [np.float32(1.5)]})
+      resumed, resumed_optimizer, resumed_sampler = create()
+      step, history = load_checkpoint(path, resumed, resumed_optimizer,
+                                      resumed_sampler)
+    self.assertEqual(step, 5)
+    self.assertEqual(history, {'loss': [1.5]})
+    run(resumed, resumed_optimizer, resumed_sampler, 5)
+
+    self.assertTrue(np.array_equal(network.params, resumed.params))
+
+class TestCpuExecution(unittest.TestCase):
+
+  def setUp(self):
+    torch.manual_seed(42)
+    self.network = TorchConvNet(3, 10)
+    # non-trivial running statistics
+    with torch.no_grad():
+      self.network(torch.randn(16, 3, 32, 32) * 2 + 1)
+    self.x = torch.randn(6, 3, 32, 32)
+
+  def test_fold_batchnorm(self):
+    folded = fold_batchnorm(self.network)
+    self.assertFalse(any(isinstance(module, nn.BatchNorm2d)
+                         for module in folded.modules()))
+    self.assertTrue(self.network.training)
+
+    self.network.eval()
+    with torch.no_grad():
+      expected = self.network(self.x)
+      self.assertLess(rel_error(folded(self.x).numpy(), expected.numpy()), 1e-4)
+      fused = freeze(self.network, self.x, channels_last=True, optimize=True)
+      self.assertLess(rel_error(fused(self.x[:1]).numpy(), expected[:1].numpy()), 1e-4)
+
+  def test_channels_last_training(self):
+    other = TorchConvNet(3, 10)
+    other.load_state_dict(self.network.state_dict())
+    other.to_channels_last()
+    self.assertTrue(other.layers[0].weight.is_contiguous(memory_format=torch.channels_last))
+
+    y = torch.randint(10, (6,))
+    for network in [self.network, other]:
+      nn.CrossEntropyLoss()(network(self.x), y).backward()
+    # the biases of the convolutions have gradients close to zero under the
+    # batch normalization, so compare with an absolute tolerance
+    for param, other_param in zip(self.network.parameters(), other.parameters()):
+      self.assertTrue(torch.allclose(other_param.grad, param.grad, rtol=1e-3, atol=1e-5))
+
+class TestExport(unittest.TestCase):
+
+  def test_fold_linear(self):
+    torch.manual_seed(42)
+    network = nn.Sequential(nn.Linear(12, 8), nn.BatchNorm1d(8), nn.ReLU(),
+                            nn.Sequential(nn.Linear(8, 6), nn.BatchNorm1d(6)),
+                            nn.Linear(6, 3))
+    with torch.no_grad():
+      network(torch.randn(32, 12) * 3 - 1)
+    folded = fold_batchnorm(network)
+    self.assertFalse(any(isinstance(module, nn.BatchNorm1d)
+                         for module in folded.modules()))
+
+    network.eval()
+    x = torch.randn(5, 12)
+    with torch.no_grad():
+      self.assertLess(rel_error(folded(x).numpy(), network(x).numpy()), 1e-4)
+
+  def test_standalone_artifact(self):
+    torch.manual_seed(42)
+    convnet = TorchConvNet(3, 10)
+    with torch.no_grad():
+      convnet(torch.randn(16, 3, 32, 32) * 2 + 1)
+    settings = [(convnet, torch.randn(4, 3, 32, 32), False),
+                (convnet, torch.randn(4, 3, 32, 32), True),
+                (TorchMLP(48, [20], 5), torch.randn(4, 48), False)]
+
+    for model, x, channels_last in settings:
+      with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'model.pt')
+        folded = export_model(model, x, path, channels_last)
+        results = verify_export(model, folded, load_model(path), x)
+        self.assertTrue(results['bit_exact'])
+        self.assertLess(results['max_error'], 1e-4)
+
+        # the artifact loads in a process that can not import this code
+        with torch.no_grad():
+          torch.save({'x': x, 'out': folded(x)}, os.path.join(directory, 'io.pt'))
+        script = ("import sys, torch\n"
+                  "io = torch.load('io.pt')\n"
+                  "out = torch.jit.load('model.pt')(io['x'])\n"
+                  "sys.exit(0 if torch.equal(out, io['out']) else 1)\n")
+        self.assertEqual(subprocess.call([sys.executable, '-c', script],
+                                         cwd=directory), 0)
+
+        optimized = load_model(path, optimize=True)
+        with torch.no_grad():
+          self.assertLess(rel_error(optimized(x).numpy(), folded(x).numpy()), 1e-4)
+
+class TestQuantization(unittest.TestCase):
+
+  def test_fusion_groups(self):
+    network = TorchConvNet(3, 10)
+    groups = fusion_groups(network.layers)
+    self.assertEqual(len(groups), 8)
+    self.assertEqual(groups[:2], [['0', '1', '2'], ['4', '5', '6']])
+
+    network = TorchMLP(48, [20, 10], 5)
+    self.assertEqual(fusion_groups(network._neural_network), [['0', '1'], ['2', '3']])
+
+  def test_quantize_static(self):
+    np.random.seed(42)
+    torch.manual_seed(42)
+    images = np.random.randint(256, size=(64, 3, 32, 32)).astype(np.uint8)
+    mean = images.mean(axis=0).astype(np.float32)
+    dataset = DataSet(images, np.random.randint(10, size=64), mean)
+    x = torch.from_numpy(dataset.normalize(images[:16]))
+
+    network = TorchConvNet(3, 10)
+    with torch.no_grad():
+      network(x)
+    network.eval()
+    # the engine is a global setting, quantizing leaves it unchanged
+    with quantized_engine('onednn'):
+      quantized = quantize_static(network, dataset, 32, flatten=False, backend='x86')
+      self.assertEqual(torch.backends.quantized.engine, 'onednn')
+    self.assertTrue(any(isinstance(module, nn.BatchNorm2d)
+                        for module in network.modules()))
+
+    with torch.no_grad(), quantized_engine('x86'):
+      expected = network(x)
+      out = quantized(x)
+    self.assertEqual(out.dtype, torch.float32)
+    error = (out - expected).abs().max() / expected.abs().max()
+    self.assertLess(error.item(), 0.1)
+
+    with quantized_engine('x86'):
+      results = compare(network, quantized, dataset, 32, flatten=False)
+    self.assertLess(results['int8']['size'], results['float']['size'] / 3)
+    self.assertLess(abs(results['int8']['loss'] - results['float']['loss']), 0.1)
+
+class TestMetricsRecorder(unittest.TestCase):
+
+  def test_record_save_load(self):
+    metrics = MetricsRecorder(['loss', 'accuracy'], 3)
+    metrics.record(10, loss=torch.tensor(2.5), accuracy=np.float32(0.25))
+    metrics.record(20, loss=1.5)
+    self.assertEqual(len(metrics), 2)
+    self.assertTrue(np.array_equal(metrics['loss'], [2.5, 1.5]))
+    self.assertEqual(metrics.last('loss'), 1.5)
+    self.assertTrue(np.isnan(metrics.last('accuracy')))
+
+    with tempfile.TemporaryDirectory() as directory:
+      path = os.path.join(directory, 'metrics.npz')
+      metrics.save(path)
+      loaded = MetricsRecorder.load(path)
+    self.assertEqual(loaded.names, ['loss', 'accuracy'])
+    self.assertTrue(np.array_equal(loaded.steps, [10, 20]))
+    self.assertEqual(loaded['loss'].dtype, np.float64)
+    self.assertTrue(np.array_equal(loaded['loss'], metrics['loss']))
+
+    metrics.record(30, loss=0.5)
+    with self.assertRaises(ValueError):
+      metrics.record(40, loss=0.5)
+
+  def test_no_graph_retained(self):
+    model = nn.Linear(100, 10)
+    x = torch.randn(64, 100)
+    metrics = MetricsRecorder(['loss'], 2000)
+
+    def step():
+      loss = model(x).logsumexp(dim=1).mean()
+      loss.backward()
+      metrics.record(len(metrics), loss=loss)
+      return weakref.ref(loss)
+
+    refs = [step() for _ in range(10)]
+    self.assertTrue(all(ref() is None for ref in refs))
+
+    # the history does not grow once allocated
+    loss = model(x).logsumexp(dim=1).mean()
+    tracemalloc.start()
+    metrics.record(10, loss=loss)
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(1000):
+      metrics.record(i, loss=loss)
+    growth = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    self.assertLess(growth, 1024)
+
+class TestShardedDataSet(unittest.TestCase):
+
+  def setUp(self):
+    np.random.seed(42)
+    self.images = np.random.randn(103, 3, 4, 4).astype(np.float32)
+    self.labels = np.random.randint(10, size=103).astype(np.uint8)
+    self.directory = tempfile.TemporaryDirectory()
+    # the chunks are not aligned with the shards
+    with cifar10_utils.ShardWriter(self.directory.name, shard_size=25) as writer:
+      for start in range(0, 103, 17):
+        writer.write(self.images[start:start + 17], self.labels[start:start + 17])
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def test_lazy_arrays(self):
+    dataset = cifar10_utils.ShardedDataSet(self.directory.name)
+    self.assertEqual(dataset.index['shard_sizes'], [25, 25, 25, 25, 3])
+    self.assertEqual(dataset.images.shape, self.images.shape)
+    self.assertEqual(dataset.labels.dtype, np.uint8)
+    self.assertTrue(np.array_equal(dataset.images[20:60], self.images[20:60]))
+    self.assertTrue(np.array_equal(dataset.images[-1], self.images[-1]))
+    self.assertTrue(np.array_equal(dataset.labels[::7], self.labels[::7]))
+
+    indices = np.random.randint(103, size=40)
+    images, labels = dataset.take(indices)
+    self.assertTrue(np.array_equal(images, self.images[indices]))
+    self.assertTrue(np.array_equal(labels, self.labels[indices]))
+    self.assertLessEqual(len(dataset.open_shards), 2)
+
+    network = MLP(48, [20], 10)
+    expected = evaluate(network, DataSet(self.images, self.labels), 30)
+    self.assertEqual(evaluate(network, dataset, 30)['loss'], expected['loss'])
+
+  def test_epochs(self):
+    dataset = cifar10_utils.ShardedDataSet(self.directory.name, max_open_shards=1)
+    for epoch in range(3):
+      indices = []
+      for _ in range(10):
+        indices.append(dataset.sample_indices(10))
+        dataset.take(indices[-1])
+        self.assertEqual(len(dataset.open_shards), 1)
+      indices = np.concatenate(indices)
+      self.assertEqual(dataset.epochs_completed, epoch)
+
+      # every example is read at most once and the examples of a shard in
+      # one run, the first epoch reads the shards in order
+      self.assertEqual(len(np.unique(indices)), 100)
+      shards = indices // 25
+      self.assertEqual(np.count_nonzero(np.diff(shards)), len(np.unique(shards)) - 1)
+      self.assertEqual(np.array_equal(indices, np.arange(100)), epoch == 0)
+
+  def test_prefetcher(self):
+    np.random.seed(42)
+    dataset = cifar10_utils.ShardedDataSet(self.directory.name)
+    expected = [[array.copy() for array in dataset.next_batch(8)] for _ in range(30)]
+
+    np.random.seed(42)
+    dataset = cifar10_utils.ShardedDataSet(self.directory.name)
+    with cifar10_utils.BatchPrefetcher(dataset, 8) as batches:
+      for expected_images, expected_labels in expected:
+        images, labels = next(batches)
+        self.assertTrue(np.array_equal(images, expected_images))
+        self.assertTrue(np.array_equal(labels, expected_labels))
+
+  def test_cifar10(self):
+    np.random.seed(42)
+    with tempfile.TemporaryDirectory() as directory:
+      write_cifar10_fixture(directory)
+      expected = cifar10_utils.get_cifar10(directory, one_hot=False, use_cache=False)
+      for shard_size in [30, 30, 100]:
+        data = cifar10_utils.get_sharded_cifar10(directory, shard_size=shard_size)
+        self.assertEqual(data['train'].index['shard_size'], shard_size)
+        for tag in ['train', 'test']:
+          self.assertTrue(np.array_equal(data[tag].images[:], expected[tag].images))
+          self.assertTrue(np.array_equal(data[tag].labels[:], expected[tag].labels))
+
+class TestAugmentation(unittest.TestCase):
+
+  def setUp(self):
+    self.images = np.random.randn(17, 3, 8, 6).astype(np.float32)
+
+  def test_random_crop(self):
+    np.random.seed(42)
+    crops = random_crop(self.images, 2)
+    np.random.seed(42)
+    rows = np.random.randint(5, size=17)
+    cols = np.random.randint(5, size=17)
+    for i in range(17):
+      padded = np.pad(self.images[i], ((0, 0), (2, 2), (2, 2)))
+      expected = padded[:, rows[i]:rows[i] + 8, cols[i]:cols[i] + 6]
+      self.assertTrue(np.array_equal(crops[i], expected))
+
+    # cropping in place with a reused scratch array gives the same crops
+    padded = np.zeros((17, 3, 12, 10), np.float32)
+    images = self.images.copy()
+    np.random.seed(42)
+    random_crop(images, 2, out=images, padded=padded)
+    self.assertTrue(np.array_equal(images, crops))
+
+  def test_random_flip(self):
+    np.random.seed(42)
+    flipped = random_flip(self.images.copy())
+    np.random.seed(42)
+    flip = np.random.rand(17) < 0.5
+    self.assertTrue(flip.any() and not flip.all())
+    self.assertTrue(np.array_equal(flipped[flip], self.images[flip, :, :, ::-1]))
+    self.assertTrue(np.array_equal(flipped[~flip], self.images[~flip]))
+
+  def test_normalize(self):
+    images = 5 * self.images + np.array([1., -2., 3.], np.float32).reshape(1, 3, 1, 1)
+    mean, std = channel_stats(images, chunk_size=4)
+    self.assertLess(rel_error(mean, images.mean(axis=(0, 2, 3))), 1e-5)
+    self.assertLess(rel_error(std, images.std(axis=(0, 2, 3))), 1e-5)
+
+    normalize(images, mean, std)
+    self.assertLess(np.max(np.abs(images.mean(axis=(0, 2, 3)))), 1e-5)
+    self.assertLess(np.max(np.abs(images.std(axis=(0, 2, 3)) - 1)), 1e-5)
+
+  def test_prefetcher_transform(self):
+    labels = np.arange(17)
+    dataset = DataSet(self.images, labels)
+    augment = Augmentation(padding=0, flip=False, mean=[1., 1., 1.],
+                           std=[2., 2., 2.])
+    with cifar10_utils.BatchPrefetcher(dataset, 5, transform=augment) as batches:
+      images, labels = next(batches)
+      self.assertTrue(np.allclose(images, (self.images[labels] - 1) / 2))
+
+  def test_train_matches_eval(self):
+    np.random.seed(42)
+    raw = np.random.randint(256, size=(400, 3, 32, 32)).astype(np.uint8)
+    raw[:, 1] //= 4
+    train_raw, test_raw = raw[:300], raw[300:]
+    mean = train_raw.mean(axis=0).astype(np.float32)
+    std = channel_stats(train_raw, mean_image=mean)[1]
+    train_set = DataSet(train_raw, np.arange(300), mean, std=std)
+    test_set = DataSet(test_raw, np.arange(100), mean, std=std)
+
+    # the augmented training batches and the test images the evaluation
+    # normalizes are standardized with the same statistics, the zeros the
+    # crops pad with only lower the deviation of the training batches a bit
+    with cifar10_utils.BatchPrefetcher(train_set, 100, replace=True,
+                                       transform=Augmentation()) as batches:
+      images = np.concatenate([next(batches)[0] for _ in range(3)])
+    test_images = test_set.normalize(test_set.images)
+    for x in [images, test_images]:
+      self.assertLess(np.max(np.abs(x.mean(axis=(0, 2, 3)))), 0.05)
+    ratio = images.std(axis=(0, 2, 3)) / test_images.std(axis=(0, 2, 3))
+    self.assertLess(np.max(np.abs(ratio - 1)), 0.1)
+    self.assertLess(np.max(np.abs(test_images.std(axis=(0, 2, 3)) - 1)), 0.05)
+
+class TestCifar10Loading(unittest.TestCase):
+
+  def test_matches_preprocessing(self):
+    np.random.seed(42)
+    with tempfile.TemporaryDirectory() as directory:
+      # batches of different sizes regrow the destination
+      write_cifar10_fixture(directory, [20, 20, 35, 5, 20, 15])
+      expected = cifar10_utils.preprocess_cifar10_data(
+        *cifar10_utils.get_cifar10_raw_data(directory))
+
+      tracemalloc.start()
+      arrays = cifar10_utils.load_preprocessed_cifar10(directory)
+      peak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+
+      for array, expected_array in zip(arrays, expected):
+        self.assertTrue(array.flags['C_CONTIGUOUS'])
+        self.assertLess(np.abs(array - expected_array).max(), 1e-4)
+      self.assertEqual(arrays[4].shape, (3, 32, 32))
+      self.assertLess(np.abs(arrays[0].mean(axis=0)).max(), 1e-4)
+      self.assertLess(peak, 2 * sum(array.nbytes for array in arrays))
+
+  def test_parallel_decoding(self):
+    np.random.seed(42)
+    for sizes in [20, [20, 20, 35, 5, 20, 15], [20, 10, 20, 20, 20, 20]]:
+      with tempfile.TemporaryDirectory() as directory:
+        write_cifar10_fixture(directory, sizes)
+        for uint8 in [False, True]:
+          expected = cifar10_utils.load_preprocessed_cifar10(directory, uint8, workers=1)
+          for workers in [2, 6]:
+            arrays = cifar10_utils.load_preprocessed_cifar10(directory, uint8, workers)
+            for array, expected_array in zip(arrays, expected):
+              self.assertEqual(array.dtype, expected_array.dtype)
+              self.assertTrue(np.array_equal(array, expected_array))
+
+  def test_decoding_error(self):
+    np.random.seed(42)
+    with tempfile.TemporaryDirectory() as directory:
+      write_cifar10_fixture(directory)
+      with open(os.path.join(directory, 'data_batch_2'), 'wb') as f:
+        f.write(b'not a pickle')
+      for workers in [1, 3]:
+        with self.assertRaises(pickle.UnpicklingError):
+          cifar10_utils.load_preprocessed_cifar10(directory, workers=workers)
+
+class TestCifar10Cache(unittest.TestCase):
+
+  def test_matches_uncached(self):
+    np.random.seed(42)
+    with tempfile.TemporaryDirectory() as directory:
+      write_cifar10_fixture(directory)
+      expected = cifar10_utils.get_cifar10(directory, use_cache=False)
+      self.assertFalse(os.path.exists(os.path.join(directory, 'cache')))
+
+      for _ in range(2):
+        data = cifar10_utils.get_cifar10(directory)
+        for tag in ['train', 'test']:
+          self.assertIsInstance(data[tag].images, np.memmap)
+          self.assertEqual(data[tag].images.shape, (20 * (5 if tag == 'train' else 1), 3, 32, 32))
+          self.assertTrue(np.array_equal(data[tag].images, expected[tag].images))
+          self.assertTrue(np.array_equal(data[tag].labels, expected[tag].labels))
+
+      arrays = cifar10_utils.load_cifar10_cache(directory, verify=True)
+      self.assertTrue(np.allclose(arrays['mean_image'].mean(), 127.5, atol=5))
+
+      # uint8 images are a quarter of the size and give the same batches
+      raw = cifar10_utils.get_cifar10(directory, uint8=True)
+      for tag in ['train', 'test']:
+        self.assertEqual(raw[tag].images.dtype, np.uint8)
+        self.assertEqual(raw[tag].image_dtype, np.float32)
+        self.assertEqual(4 * raw[tag].images.nbytes, expected[tag].images.nbytes)
+        indices = np.random.randint(raw[tag].num_examples, size=16)
+        for array, expected_array in zip(raw[tag].take(indices), expected[tag].take(indices)):
+          self.assertTrue(np.array_equal(array, expected_array))
+
+      network = MLP(3 * 32 * 32, [20], 10)
+      self.assertEqual(evaluate(network, raw['test'], 7)['loss'],
+                       evaluate(network, expected['test'], 7)['loss'])
+
+      # without one-hot encoding the labels are compact class indices
+      sparse = cifar10_utils.get_cifar10(directory, one_hot=False)
+      for tag in ['train', 'test']:
+        self.assertEqual(sparse[tag].labels.dtype, np.uint8)
+        self.assertTrue(np.array_equal(sparse[tag].labels,
+                                       expected[tag].labels.argmax(axis=1)))
+      self.assertEqual(cifar10_utils.count_classes(sparse['test'].labels), 10)
+
+  def test_invalidation(self):
+    np.random.seed(42)
+    with tempfile.TemporaryDirectory() as directory:
+      write_cifar10_fixture(directory)
+      cifar10_utils.write_cifar10_cache(directory)
+      self.assertIsNotNone(cifar10_utils.load_cifar10_cache(directory))
+
+      # changed batch files make the cache stale
+      write_cifar10_fixture(directory, num_images=10)
+      self.assertIsNone(cifar10_utils.load_cifar10_cache(directory))
+      self.assertEqual(cifar10_utils.get_cifar10(directory)['test'].num_examples, 10)
+
+      # a modified array no longer matches its hash
+      filename = os.path.join(directory, 'cache', 'test_labels.npy')
+      labels = np.load(filename)
+      np.save(filename, labels + 1)
+      with self.assertRaises(ValueError):
+        cifar10_utils.load_cifar10_cache(directory, verify=True)
+
 
 if __name__ == '__main__':
   suite = unittest.TestLoader().loadTestsFromTestCase(TestLosses)
@@ -150,5 +1427,65 @@ if __name__ == '__main__':
   suite = unittest.TestLoader().loadTestsFromTestCase(TestLayers)
   unittest.TextTestRunner(verbosity=2).run(suite)
 
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestConvLayers)
+  unittest.TextTestRunner(verbosity=2).run(suite)
+
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestGradientCheck)
+  unittest.TextTestRunner(verbosity=2).run(suite)
+
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestWorkspace)
+  unittest.TextTestRunner(verbosity=2).run(suite)
+
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestPrecision)
+  unittest.TextTestRunner(verbosity=2).run(suite)
+
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestDataParallel)
+  unittest.TextTestRunner(verbosity=2).run(suite)
+
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestOptimizers)
+  unittest.TextTestRunner(verbosity=2).run(suite)
+
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestFlatParameters)
+  unittest.TextTestRunner(verbosity=2).run(suite)
+
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestEvaluation)
+  unittest.TextTestRunner(verbosity=2).run(suite)
+
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestInferenceMode)
+  unittest.TextTestRunner(verbosity=2).run(suite)
+
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestDataSet)
+  unittest.TextTestRunner(verbosity=2).run(suite)
+
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestBatchPrefetcher)
+  unittest.TextTestRunner(verbosity=2).run(suite)
+
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestBatchSampler)
+  unittest.TextTestRunner(verbosity=2).run(suite)
+
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestCpuExecution)
+  unittest.TextTestRunner(verbosity=2).run(suite)
+
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestExport)
+  unittest.TextTestRunner(verbosity=2).run(suite)
+
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestQuantization)
+  unittest.TextTestRunner(verbosity=2).run(suite)
+
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestMetricsRecorder)
+  unittest.TextTestRunner(verbosity=2).run(suite)
+
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestShardedDataSet)
+  unittest.TextTestRunner(verbosity=2).run(suite)
+
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestAugmentation)
+  unittest.TextTestRunner(verbosity=2).run(suite)
+
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestCifar10Loading)
+  unittest.TextTestRunner(verbosity=2).run(suite)
+
+  suite = unittest.TestLoader().loadTestsFromTestCase(TestCifar10Cache)
+  unittest.TextTestRunner(verbosity=2).run(suite)
+
   suite = unittest.TestLoader().loadTestsFromTestCase(TestBatchNorm)
   unittest.TextTestRunner(verbosity=3).run(suite)